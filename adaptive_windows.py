@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+
+import numpy as np
+
+import event_octree
+
+
+class AdaptiveSubdivision:
+    """Quadtree, or octree, of square cells recursively split into 4, or 8, equal children until no cell holds more
+    than target_count events, so that cells are small where events are dense and large where they are sparse.
+    Events are sorted by their Morton code once, after which the events of any cell are a contiguous range of the
+    sorted events, found by binary search on the codes, and the leaf cells partition the sorted events, ready for
+    statistical_analysis.b_value_batch."""
+
+    def __init__(self, coordinates, target_count, max_depth=16):
+        """Expected input is a NumPy array of event coordinates of shape (n, 2) for a quadtree or (n, 3) for an
+        octree, the largest number of events of a cell that isn't split and the deepest level cells are split to,
+        at most 21. Cells at max_depth are kept even if they hold more than target_count events, e.g. duplicates."""
+        coordinates = np.asarray(coordinates, dtype=float)
+        self.dimensions = coordinates.shape[1]
+        self.max_depth = max_depth
+        self.origin = coordinates.min(axis=0) if len(coordinates) else np.zeros(self.dimensions)
+        extent = np.ptp(coordinates, axis=0).max() if len(coordinates) else 0.0
+        self.size = extent * (1 + 1e-9) or 1.0  # side of the root cell, slightly enlarged to hold the maximum
+        cells = np.zeros((len(coordinates), 3), dtype=np.int64)  # the z bits of a quadtree are all zero
+        scaled = (coordinates - self.origin) / self.size * 2 ** max_depth
+        cells[:, :self.dimensions] = np.clip(scaled.astype(np.int64), 0, 2 ** max_depth - 1)
+        codes = event_octree.morton_codes(cells)
+        self.order = np.argsort(codes, kind="stable")
+        codes = codes[self.order]
+
+        node_codes, starts, ends = np.zeros(1, dtype=np.uint64), np.zeros(1, np.int64), np.full(1, len(codes))
+        leaf_levels, leaf_codes, leaf_starts = [], [], []
+        for level in range(max_depth + 1):
+            split = (ends - starts > target_count) & (level < max_depth)
+            leaf = ~split & (ends > starts)
+            leaf_levels.append(np.full(leaf.sum(), level))
+            leaf_codes.append(node_codes[leaf])
+            leaf_starts.append(starts[leaf])
+            if not split.any():
+                break
+            children = (node_codes[split, None] << np.uint64(3)) | np.arange(8, dtype=np.uint64)
+            shift = np.uint64(3 * (max_depth - level - 1))
+            child_starts = np.searchsorted(codes, children << shift)  # first event of every child
+            child_ends = np.column_stack((child_starts[:, 1:], ends[split]))
+            occupied = child_ends > child_starts
+            node_codes, starts, ends = children[occupied], child_starts[occupied], child_ends[occupied]
+
+        levels, starts = np.concatenate(leaf_levels), np.concatenate(leaf_starts)
+        leaf_order = np.argsort(starts)  # Morton order, the order of the events of the leaves
+        self.levels = levels[leaf_order]
+        self.offsets = np.append(starts[leaf_order], len(codes)).astype(np.int64)
+        leaf_codes = np.concatenate(leaf_codes)[leaf_order]
+        self.cells = np.zeros((len(self.levels), self.dimensions), dtype=np.int64)  # cell coordinates at their level
+        for level in np.unique(self.levels):
+            at_level = self.levels == level
+            self.cells[at_level] = event_octree.morton_cells(leaf_codes[at_level], level)[:, :self.dimensions]
+
+    def __len__(self):
+        return len(self.levels)
+
+    def counts(self):
+        """Returns a NumPy array of the number of events of every leaf cell."""
+        return np.diff(self.offsets)
+
+    def cell_sizes(self):
+        """Returns a NumPy array of the side of every leaf cell."""
+        return self.size / 2.0 ** self.levels
+
+    def bounds(self):
+        """Returns NumPy arrays of the lower and upper corners of every leaf cell, of shape (cells, dimensions)."""
+        lower = self.origin + self.cells * self.cell_sizes()[:, None]
+        return lower, lower + self.cell_sizes()[:, None]
+
+    def raster(self, depth, values):
+        """Spreads leaf cells over the uniform xy grid of the cells of a level depth, 2 ** depth cells along each axis,
+        e.g. for heatmaps. Leaves coarser than the grid cover blocks of grid cells and share their events evenly among
+        them, leaves finer than the grid fall into a single grid cell, as do octree leaves above one another.
+        Expected input is the level and a list of NumPy arrays of per leaf values, nan for none.
+        Returns the 2D NumPy array of the number of events of every grid cell, indexed [x, y], and one 2D NumPy array
+        of every given value, averaged over the leaves of a grid cell weighted by their events and nan for none."""
+        span = 2 ** np.maximum(depth - self.levels, 0)  # grid cells along each axis of every leaf
+        xy = self.cells[:, :2] * span[:, None] // 2 ** np.maximum(self.levels - depth, 0)[:, None]
+        cells_per_leaf = span ** 2
+        leaf = np.repeat(np.arange(len(self)), cells_per_leaf)
+        local = np.arange(len(leaf)) - np.repeat(np.cumsum(cells_per_leaf) - cells_per_leaf, cells_per_leaf)
+        x = xy[leaf, 0] + local // span[leaf]
+        y = xy[leaf, 1] + local % span[leaf]
+        grid_cell = x * 2 ** depth + y
+        weights = (self.counts() / cells_per_leaf)[leaf]
+        num_cells = 4 ** depth
+        grid_counts = np.bincount(grid_cell, weights=weights, minlength=num_cells)
+        grids = []
+        for value in values:
+            valid = np.isfinite(value[leaf])
+            weight_sum = np.bincount(grid_cell[valid], weights=weights[valid], minlength=num_cells)
+            value_sum = np.bincount(grid_cell[valid], weights=(weights * value[leaf])[valid], minlength=num_cells)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                grids.append(np.where(weight_sum > 0, value_sum / weight_sum, np.nan).reshape(2 ** depth, -1))
+        return grid_counts.reshape(2 ** depth, -1), grids
@@ -0,0 +1,408 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+import declustering
+import geospatial_conversion
+import moving_window
+import process_input
+import region_filter
+import spacetime_index
+import spatial_index
+import statistical_analysis
+import synthetic_catalog
+import tiled_analysis
+import time_conversion
+
+DEFAULT_SIZES = [10 ** 4, 10 ** 5, 10 ** 6, 10 ** 7]
+DEFAULT_DATA_DIR = os.path.join(tempfile.gettempdir(), "earthquake-modeling-benchmark")
+
+STAGES = {
+    "process_input.load": (lambda data: process_input.load(data["file_name"], "u", None), None),
+    "geospatial_conversion.get_utm": (
+        lambda data: geospatial_conversion.get_utm(data["latitude"], data["longitude"], data["depth"]), None),
+    "geospatial_conversion.get_cartesian": (
+        lambda data: geospatial_conversion.get_cartesian(data["latitude"], data["longitude"], data["depth"]), None),
+    "statistical_analysis.b_value_maximum_likelihood": (
+        lambda data: statistical_analysis.b_value_maximum_likelihood(data["magnitudes"]), None),
+    "statistical_analysis.b_value_least_squares_regression": (
+        lambda data: statistical_analysis.b_value_least_squares_regression(data["magnitudes"]), None),
+    "moving_window.spatial_window_analysis": (
+        lambda data: moving_window.spatial_window_analysis(data["df"], 0.2, 20, 5, 200), None),
+    "tiled_analysis.tiled_window_analysis": (
+        lambda data: tiled_analysis.tiled_window_analysis(data["df"], 0.2, 20, 5, 200, tile_size=50, backend="serial"),
+        None),
+    "moving_window.adaptive_window_analysis": (
+        lambda data: moving_window.adaptive_window_analysis(data["df"], 0.2, 2000, 200), None),
+    "moving_window.neighbour_window_analysis": (
+        lambda data: moving_window.neighbour_window_analysis(data["df"], 0.2, 200, 5, 20, 50), None),
+    "moving_window.spacetime_window_analysis": (
+        lambda data: moving_window.spacetime_window_analysis(data["df"], 0.2, 20, 5, 365, 30, 200), None),
+    "moving_window.temporal_window_analysis (even)": (
+        lambda data: moving_window.temporal_window_analysis(data["df"], 0.2, window_number=100), None),
+    "moving_window.temporal_window_analysis (sliding)": (
+        lambda data: moving_window.temporal_window_analysis(data["df"], 0.2, window_size=1000, window_step=100), None),
+    "region_filter.apply": (
+        lambda data: region_filter.apply(data["df"], region_filter.all_of(region_filter.depth_range(0, 20),
+                                                                          _region_polygon(data["df"]))), None),
+    "declustering.gardner_knopoff": (lambda data: declustering.gardner_knopoff(data["df"]), None),
+    "declustering.reasenberg": (lambda data: declustering.reasenberg(data["df"]), 10 ** 6),
+    "process_input.remove_outliers_distance_matrix": (
+        lambda data: process_input.remove_outliers_distance_matrix(data["df"]), 2 * 10 ** 4),
+    "process_input.remove_outliers_total_distance": (
+        lambda data: process_input.remove_outliers_total_distance(data["df"]), 10 ** 5),
+    "process_input.remove_outliers_nearest_neighbours": (
+        lambda data: process_input.remove_outliers_nearest_neighbours(data["df"]), None),
+}
+# name: (function of the benchmark data, largest size it is run at or None), quadratic stages are capped
+# spatial_window and temporal_window are timed through their analysis functions, which run without prompts
+# tiles run serially, so that peak memory, only traced in this process, includes that of analysing a tile
+
+
+def catalog(size, seed=0, data_dir=DEFAULT_DATA_DIR):
+    """Returns the file name of the synthetic catalog of size events for a seed, see synthetic_catalog.generate,
+    generating it only if it isn't in data_dir yet."""
+    os.makedirs(data_dir, exist_ok=True)
+    file_name = os.path.join(data_dir, f"synthetic_{size}_{seed}.csv")
+    if not os.path.exists(file_name):
+        synthetic_catalog.write(file_name + ".tmp", size, seed=seed)
+        os.replace(file_name + ".tmp", file_name)  # an interrupted run never leaves a partial catalog behind
+    return file_name
+
+
+def _region_polygon(df, vertices=1000):
+    """Returns a region filter of a circular polygon of many vertices around the middle of a catalog."""
+    angles = np.linspace(0, 2 * np.pi, vertices, endpoint=False)
+    radius = 0.25 * (df["X"].max() - df["X"].min())
+    return region_filter.polygon(np.column_stack((df["X"].median() + radius * np.cos(angles),
+                                                  df["Y"].median() + radius * np.sin(angles))))
+
+
+def measure(function, data, repeat=3):
+    """Runs a function of the benchmark data repeat times and once more while tracing memory allocations, which
+    slows it down. Returns the minimum and median wall times in seconds and the peak traced memory in bytes above
+    that in use when it started, which includes NumPy arrays."""
+    wall_times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(data)
+        wall_times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    try:
+        function(data)
+        peak_memory = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return min(wall_times), statistics.median(wall_times), peak_memory
+
+
+def revision():
+    """Returns the git commit of the code being benchmarked, with a trailing + if it has uncommitted changes, or None
+    outside of a git repository."""
+    directory = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=directory, capture_output=True,
+                                text=True, check=True).stdout.strip()
+        changes = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=directory,
+                                 capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return commit + ("+" if changes else "")
+
+
+def run(sizes=DEFAULT_SIZES, stages=None, repeat=3, seed=0, data_dir=DEFAULT_DATA_DIR, verbose=True):
+    """Times the stages of STAGES, all by default, on synthetic catalogs of each size.
+    Returns a dictionary of the environment and a list of results, one per stage and size, ready to be saved as JSON."""
+    stages = list(STAGES) if stages is None else stages
+    report = {"revision": revision(), "date": time.strftime("%Y-%m-%dT%H:%M:%S"), "python": platform.python_version(),
+              "numpy": np.__version__, "pandas": pd.__version__, "machine": platform.platform(),
+              "processor": platform.processor(), "cpu_count": os.cpu_count(), "repeat": repeat, "seed": seed,
+              "results": []}
+    for size in sizes:
+        file_name = catalog(size, seed, data_dir)
+        raw = pd.read_csv(file_name, usecols=["Latitude", "Longitude", "Depth"])
+        df = process_input.load(file_name, "u", None)
+        data = {"file_name": file_name, "df": df, "magnitudes": df["Magnitude"].to_numpy(),
+                "latitude": raw["Latitude"].to_numpy(), "longitude": raw["Longitude"].to_numpy(),
+                "depth": raw["Depth"].to_numpy()}
+        for stage in stages:
+            function, max_size = STAGES[stage]
+            if max_size is not None and size > max_size:
+                continue
+            min_time, median_time, peak_memory = measure(function, data, repeat)
+            report["results"].append({"stage": stage, "size": size, "min_time": min_time, "median_time": median_time,
+                                      "peak_memory": peak_memory})
+            if verbose:
+                print(f"{stage:<55} {size:>10} {min_time:>10.4f} s {peak_memory / 2 ** 20:>10.1f} MiB", flush=True)
+    return report
+
+
+def compare(baseline, report):
+    """Prints the ratios of minimum wall times and peak memory of a report to those of a baseline report, for stages
+    and sizes found in both, so that ratios above 1 are regressions."""
+    previous = {(result["stage"], result["size"]): result for result in baseline["results"]}
+    print(f"\nCompared to {baseline.get('revision')} from {baseline.get('date')}:")
+    print(f"{'Stage':<55} {'Size':>10} {'Time ratio':>11} {'Memory ratio':>13}")
+    for result in report["results"]:
+        old = previous.get((result["stage"], result["size"]))
+        if old is not None:
+            time_ratio = result["min_time"] / max(old["min_time"], 1e-9)
+            memory_ratio = result["peak_memory"] / max(old["peak_memory"], 1)
+            print(f"{result['stage']:<55} {result['size']:>10} {time_ratio:>11.2f} {memory_ratio:>13.2f}")
+
+
+def _check_batch_estimators(data):
+    """b_value_batch and b_value_histogram_batch against the estimators of single windows, over windows of random
+    lengths, including single events."""
+    magnitudes = data["magnitudes"]
+    rng = np.random.default_rng(0)
+    offsets = np.unique(np.concatenate(([0, 1, 3, len(magnitudes)], rng.integers(0, len(magnitudes), 200))))
+    windows = np.split(magnitudes, offsets[1:-1])
+    with np.errstate(divide="ignore", invalid="ignore"):  # nan estimates of single events, as in the batches
+        expected = np.transpose([statistical_analysis.b_value_least_squares_regression(window, 0.2)
+                                 + statistical_analysis.b_value_maximum_likelihood(window) for window in windows])
+    levels, level = np.unique(magnitudes, return_inverse=True)
+    histograms = np.zeros((len(windows), len(levels)), dtype=int)
+    np.add.at(histograms, (np.repeat(np.arange(len(windows)), np.diff(offsets)), level), 1)
+    for results in (statistical_analysis.b_value_batch(magnitudes, offsets, 0.2),
+                    statistical_analysis.b_value_histogram_batch(histograms, levels, 0.2)):
+        np.testing.assert_allclose(np.array(results), expected, rtol=1e-9)
+
+
+def _check_window_histograms(data):
+    """window_histograms against counting the events of every window, for overlapping and empty windows."""
+    magnitudes = data["magnitudes"]
+    rng = np.random.default_rng(0)
+    starts = rng.integers(0, len(magnitudes), 500)
+    ends = np.minimum(starts + rng.integers(0, len(magnitudes) // 10, 500), len(magnitudes))
+    histograms, levels = statistical_analysis.window_histograms(magnitudes, starts, ends)
+    level = np.searchsorted(levels, statistical_analysis.float64_magnitudes(magnitudes))
+    expected = [np.bincount(level[start:end], minlength=len(levels)) for start, end in zip(starts, ends)]
+    np.testing.assert_array_equal(histograms, expected)
+
+
+def _spatial_windows(df, window_size, window_step):
+    """Returns the window anchors of spatial_window_analysis along X and Y and the edges and windows of each axis, see
+    spatial_index.window_edges."""
+    x_array = np.arange(df["X"].min(), df["X"].max(), window_step)
+    y_array = np.arange(df["Y"].min(), df["Y"].max(), window_step)
+    return x_array, y_array, spatial_index.window_edges(x_array, window_size), \
+        spatial_index.window_edges(y_array, window_size)
+
+
+def _check_spatial_index(data):
+    """spatial_window_analysis, through SpatialIndex, against filtering the events of every window, and histograms of
+    tables of bands of cells against those of a table of the whole grid."""
+    df = data["df"]
+    x, y, z, magnitudes = (df[column].to_numpy() for column in ["X", "Y", "Z", "Magnitude"])
+    df_plot, df_export = moving_window.spatial_window_analysis(df, 0.2, 20, 10, 50)
+    x_array, y_array, (x_edges, x_start, x_end), (y_edges, y_start, y_end) = _spatial_windows(df, 20, 10)
+    counts, rows = [], []
+    for x_anchor in x_array:
+        for y_anchor in y_array:  # windows include both bounds, as Series.between does
+            inside = (x >= x_anchor) & (x <= x_anchor + 20) & (y >= y_anchor) & (y <= y_anchor + 20)
+            counts.append(inside.sum())
+            if counts[-1] >= 50:
+                rows.append([x[inside].min(), x[inside].max(), y[inside].min(), y[inside].max(), z[inside].min(),
+                             z[inside].max(), counts[-1],
+                             *statistical_analysis.b_value_least_squares_regression(magnitudes[inside], 0.2),
+                             *statistical_analysis.b_value_maximum_likelihood(magnitudes[inside])])
+    counts = np.array(counts, dtype=float)
+    np.testing.assert_array_equal(df_plot["Event_count"], np.where(counts >= 50, counts, np.nan))
+    columns = ["X_min", "X_max", "Y_min", "Y_max", "Z_min", "Z_max", "Event_count", "B_lsr", "A_lsr", "B_ml", "A_ml",
+               "Std_err_ml"]
+    np.testing.assert_allclose(df_export[columns].to_numpy(), np.reshape(rows, (-1, len(columns))), rtol=1e-9)
+
+    windows = (np.repeat(x_start, len(y_array)), np.repeat(x_end, len(y_array)), np.tile(y_start, len(x_array)),
+               np.tile(y_end, len(x_array)))
+    dense = spatial_index.SpatialIndex(x, y, magnitudes, x_edges, y_edges)
+    banded = spatial_index.SpatialIndex(x, y, magnitudes, x_edges, y_edges, max_table_entries=1)
+    assert banded.cell_histograms.table is None, "the histograms of a single band table"
+    np.testing.assert_array_equal(banded.histograms(*windows), dense.histograms(*windows))
+
+
+def _check_spacetime_index(data):
+    """spacetime_window_analysis, through SpaceTimeIndex, against filtering the events of every window of every
+    interval, and windows that only track event counts against those that track histograms."""
+    df = data["df"]
+    x, y, magnitudes = (df[column].to_numpy() for column in ["X", "Y", "Magnitude"])
+    times = time_conversion.nanoseconds(df["Time"])
+    cube, _ = moving_window.spacetime_window_analysis(df, 0.2, 20, 10, 365, 180, 20)
+    x_array, y_array, _, _ = _spatial_windows(df, 20, 10)
+    starts, ends = time_conversion.nanoseconds(cube["time"]), time_conversion.nanoseconds(cube["time_end"])
+    expected_counts, expected_b = np.full((2,) + cube["B_ml"].shape, np.nan)
+    for interval, (start, end) in enumerate(zip(starts, ends)):
+        during = (times >= start) & (times < end)
+        for i, x_anchor in enumerate(x_array):
+            for j, y_anchor in enumerate(y_array):
+                inside = during & (x >= x_anchor) & (x <= x_anchor + 20) & (y >= y_anchor) & (y <= y_anchor + 20)
+                if inside.sum() >= 20:
+                    expected_counts[interval, j, i] = inside.sum()
+                    expected_b[interval, j, i] = statistical_analysis.b_value_maximum_likelihood(magnitudes[inside])[0]
+    np.testing.assert_array_equal(cube["Event_count"], expected_counts)
+    np.testing.assert_allclose(cube["B_ml"], expected_b, rtol=1e-9)
+
+    _, _, (x_edges, *x_windows), (y_edges, *y_windows) = _spatial_windows(df, 20, 5)
+    moved = np.sort(np.random.default_rng(0).choice(starts, len(starts) // 2, replace=False))
+    for moved_ends in (moved + 365 * time_conversion.NANOSECONDS["day"], np.full(len(moved), times.max() + 1)):
+        # intervals that overlap or skip ahead, then intervals up to the last event, first holding most events, so
+        # that, with windows overlapping more cells, window histograms are also rebuilt
+        tracked = spacetime_index.SpaceTimeIndex(x, y, times, magnitudes, x_edges, y_edges, x_windows, y_windows)
+        counted = spacetime_index.SpaceTimeIndex(x, y, times, magnitudes, x_edges, y_edges, x_windows, y_windows,
+                                                 max_table_entries=1)
+        assert tracked.tracked and not counted.tracked, "histograms tracked only within max_table_entries"
+        windows = np.arange(len(tracked.event_counts()))
+        for start, end in zip(moved, moved_ends):
+            tracked.move(start, end)
+            counted.move(start, end)
+            np.testing.assert_array_equal(counted.event_counts(), tracked.event_counts())
+            np.testing.assert_array_equal(counted.histograms(windows), tracked.histograms(windows))
+
+
+def _check_tiles(data):
+    """tiled_window_analysis against spatial_window_analysis, and bootstrap intervals, which are drawn from other
+    random streams than those of spatial_window_analysis, of tiles of different sizes against each other."""
+    df = data["df"]
+    untiled = moving_window.spatial_window_analysis(df, 0.2, 20, 10, 50)
+    tiled = tiled_analysis.tiled_window_analysis(df, 0.2, 20, 10, 50, tile_size=50, backend="serial")
+    for tiled_df, untiled_df in zip(tiled, untiled):
+        pd.testing.assert_frame_equal(tiled_df, untiled_df)
+    small, large = (tiled_analysis.tiled_window_analysis(df, 0.2, 20, 10, 50, resamples=20, tile_size=tile_size,
+                                                         backend="serial") for tile_size in (30, 100))
+    for small_df, large_df in zip(small, large):
+        pd.testing.assert_frame_equal(small_df, large_df)
+
+
+def _check_projection(data):
+    """get_utm, with the Krüger series, against the utm package, in the zone of the first event and in the zone of
+    every event, around the world."""
+    try:
+        import utm
+    except ImportError:
+        return "skipped, the utm package isn't installed"
+    latitude, longitude, depth = data["latitude"], data["longitude"], data["depth"]
+    x, y, _ = geospatial_conversion.get_utm(latitude, longitude, depth)
+    zone = geospatial_conversion.get_utm_zone(latitude, longitude)
+    easting, northing = utm.from_latlon(latitude, longitude, *zone)[:2]
+    np.testing.assert_allclose(x * 1000, easting, rtol=0, atol=1e-3)  # within a millimetre
+    np.testing.assert_allclose(y * 1000, northing, rtol=0, atol=1e-3)
+    rng = np.random.default_rng(0)
+    latitude, longitude = rng.uniform(-80, 84, 1000), rng.uniform(-180, 180, 1000)
+    x, y, _ = geospatial_conversion.get_utm(latitude, longitude, np.zeros(1000), zone="event")
+    expected = np.array([utm.from_latlon(*position)[:2] for position in zip(latitude, longitude)])
+    np.testing.assert_allclose(np.column_stack((x, y)) * 1000, expected, rtol=0, atol=1e-3)
+
+
+def _check_time_conversion(data):
+    """get_epoch_nanoseconds against pd.to_datetime, for the times of the catalog and leap seconds."""
+    columns = ["Year", "Month", "Day", "Hour", "Minute", "Second"]
+    times = pd.concat((data["raw"][columns], pd.DataFrame([[2016, 12, 31, 23, 59, 60.5]], columns=columns)))
+    nanoseconds, valid = time_conversion.get_epoch_nanoseconds(*(times[column].to_numpy() for column in columns))
+    assert valid.all(), "every time valid"
+    np.testing.assert_array_equal(nanoseconds, time_conversion.nanoseconds(pd.to_datetime(times)))
+    _, valid = time_conversion.get_epoch_nanoseconds(*np.transpose([[2019, 2, 29, 0, 0, 0], [2020, 13, 1, 0, 0, 0]]))
+    assert not valid.any(), "dates that don't exist flagged"
+
+
+def _check_declustering(data):
+    """gardner_knopoff against comparing every mainshock with every event, and reasenberg through its grid against
+    comparing events directly."""
+    df = data["df"]
+    order, times, x, y, _, magnitudes = declustering._time_order(df)
+    radius, duration = declustering.gardner_knopoff_window(magnitudes)
+    duration = np.rint(duration * time_conversion.NANOSECONDS["day"]).astype(np.int64)
+    cluster = np.zeros(len(times), dtype=np.int64)
+    for i in np.argsort(-magnitudes, kind="stable"):
+        if cluster[i]:
+            continue
+        members = (np.abs(times - times[i]) <= duration[i]) & (cluster == 0) \
+            & ((x - x[i]) ** 2 + (y - y[i]) ** 2 <= radius[i] ** 2)
+        if members.sum() > 1:
+            cluster[members] = i + 1
+    expected = declustering._labels(order, cluster, magnitudes)
+    direct = declustering.reasenberg(df)
+    direct_candidates = declustering.DIRECT_CANDIDATES
+    declustering.DIRECT_CANDIDATES = 0  # every mainshock or event looks up candidates in the grid
+    try:
+        for labels, expected_labels in ((declustering.gardner_knopoff(df), expected),
+                                        (declustering.gardner_knopoff(df, cell_size=2.0), expected),
+                                        (declustering.reasenberg(df, cell_size=2.0), direct)):
+            for values, expected_values in zip(labels, expected_labels):
+                np.testing.assert_array_equal(values, expected_values)
+    finally:
+        declustering.DIRECT_CANDIDATES = direct_candidates
+
+
+CHECKS = {
+    "statistical_analysis.b_value_batch": _check_batch_estimators,
+    "statistical_analysis.window_histograms": _check_window_histograms,
+    "spatial_index.SpatialIndex": _check_spatial_index,
+    "spacetime_index.SpaceTimeIndex": _check_spacetime_index,
+    "tiled_analysis.tiled_window_analysis": _check_tiles,
+    "geospatial_conversion.get_utm": _check_projection,
+    "time_conversion.get_epoch_nanoseconds": _check_time_conversion,
+    "declustering": _check_declustering,
+}
+# name: function of the benchmark data, raising AssertionError if an optimized kernel doesn't give the results of a
+# brute force or reference equivalent, or returning why it was skipped
+
+
+def check(size=10 ** 4, seed=0, data_dir=DEFAULT_DATA_DIR, verbose=True):
+    """Runs the regression checks of CHECKS on the synthetic catalog of size events. Brute force references take
+    quadratic time, so catalogs should be small. Returns the names of the checks that failed."""
+    file_name = catalog(size, seed, data_dir)
+    raw = pd.read_csv(file_name)
+    df = process_input.load(file_name, "u", None)
+    data = {"raw": raw, "df": df, "magnitudes": df["Magnitude"].to_numpy(), "latitude": raw["Latitude"].to_numpy(),
+            "longitude": raw["Longitude"].to_numpy(), "depth": raw["Depth"].to_numpy()}
+    failed = []
+    for name, function in CHECKS.items():
+        try:
+            status = function(data) or "ok"
+        except AssertionError as error:
+            failed.append(name)
+            status = "FAILED " + str(error).strip().splitlines()[0]
+        if verbose:
+            print(f"{name:<55} {status}", flush=True)
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks the analysis stages on seeded synthetic catalogs.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES, help="numbers of events")
+    parser.add_argument("--stages", nargs="+", choices=list(STAGES), metavar="STAGE",
+                        help="stages to run, all by default: " + ", ".join(STAGES))
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs of each stage")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the synthetic catalogs")
+    parser.add_argument("--data-dir", default=DEFAULT_DATA_DIR, help="where synthetic catalogs are kept")
+    parser.add_argument("--output", default="benchmark.json", help="JSON file the results are written to")
+    parser.add_argument("--compare", metavar="JSON", help="results of an earlier run to compare against")
+    parser.add_argument("--check", type=int, nargs="?", const=10 ** 4, metavar="SIZE",
+                        help="instead of timing stages, check the optimized kernels against brute force references on "
+                             "a catalog of SIZE events, 10000 by default, exiting with status 1 on any failure")
+    arguments = parser.parse_args()
+
+    if arguments.check is not None:
+        sys.exit(1 if check(arguments.check, arguments.seed, arguments.data_dir) else 0)
+    report = run(arguments.sizes, arguments.stages, arguments.repeat, arguments.seed, arguments.data_dir)
+    with open(arguments.output, "w") as output:
+        json.dump(report, output, indent=1)
+    if arguments.compare is not None:
+        with open(arguments.compare) as baseline:
+            compare(json.load(baseline), report)
+
+
+if __name__ == "__main__":
+    main()
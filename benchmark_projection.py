@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+
+import argparse
+import time
+
+import numpy as np
+import utm
+
+import geospatial_conversion
+
+
+def benchmark(size, seed=0):
+    """Times geospatial_conversion.get_utm against the utm package on size random positions within one UTM zone, and
+    returns the timings and the largest easting and northing differences in metres."""
+    rng = np.random.default_rng(seed)
+    latitude, longitude = rng.uniform(0, 80, size), rng.uniform(-120, -114, size)  # utm requires one hemisphere
+    depth = rng.uniform(0, 30, size)
+
+    start = time.perf_counter()
+    easting, northing = utm.from_latlon(latitude, longitude)[:2]
+    utm_time = time.perf_counter() - start
+    start = time.perf_counter()
+    x, y, _ = geospatial_conversion.get_utm(latitude, longitude, depth)
+    kernel_time = time.perf_counter() - start
+    start = time.perf_counter()
+    geospatial_conversion.get_utm(latitude, longitude, depth, dtype=np.float32)
+    float32_time = time.perf_counter() - start
+    start = time.perf_counter()
+    geospatial_conversion.get_utm(latitude, longitude, depth, zone="event")
+    event_time = time.perf_counter() - start
+    return (utm_time, kernel_time, float32_time, event_time,
+            np.max(np.abs(x * 1000 - easting)), np.max(np.abs(y * 1000 - northing)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark of the UTM projection against the utm package.")
+    parser.add_argument("sizes", type=int, nargs="*", default=[10 ** 4, 10 ** 5, 10 ** 6, 10 ** 7])
+    arguments = parser.parse_args()
+    print(f"{'Positions':>10} {'utm (s)':>9} {'get_utm (s)':>12} {'float32 (s)':>12} {'per event (s)':>14} "
+          f"{'max dE (m)':>11} {'max dN (m)':>11}")
+    for size in arguments.sizes:
+        utm_time, kernel_time, float32_time, event_time, easting_error, northing_error = benchmark(size)
+        print(f"{size:>10} {utm_time:>9.4f} {kernel_time:>12.4f} {float32_time:>12.4f} {event_time:>14.4f} "
+              f"{easting_error:>11.2e} {northing_error:>11.2e}")
+
+
+if __name__ == "__main__":
+    main()
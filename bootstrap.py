@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+
+import concurrent.futures
+import contextlib
+import itertools
+import multiprocessing
+import os
+import warnings
+
+import numpy as np
+import pandas as pd
+
+import instrumentation
+import statistical_analysis
+
+ESTIMATES = ["B_lsr", "A_lsr", "B_ml", "A_ml"]  # first four results of statistical_analysis.b_value_histogram_batch
+
+
+def _bootstrap_windows(counts, magnitude_levels, seeds, bin_size, precision, resamples, percentiles):
+    """Bootstraps the estimates of a chunk of windows, one window at a time with its own random stream. Resampling
+    the events of a window with replacement is a multinomial draw over its magnitude levels, so all resamples of a
+    window are drawn as one 2D array of histograms and estimated as one batch.
+    Returns a NumPy array of shape (windows, estimates, 2) of lower and upper percentiles, nan for empty windows."""
+    intervals = np.full((len(counts), len(ESTIMATES), 2), np.nan)
+    for window, (histogram, seed) in enumerate(zip(counts, seeds)):
+        neq = histogram.sum()
+        if neq == 0:
+            continue
+        present = histogram > 0  # levels absent from a window can't be resampled, leaving them out keeps rows short
+        samples = np.random.default_rng(seed).multinomial(neq, histogram[present] / neq, size=resamples)
+        estimates = statistical_analysis.b_value_histogram_batch(samples, magnitude_levels[present], bin_size,
+                                                                 precision)[:len(ESTIMATES)]
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", RuntimeWarning)  # windows without any valid estimate give nan
+            intervals[window] = np.nanpercentile(np.array(estimates), percentiles, axis=1).T
+    return intervals
+
+
+def default_processes():
+    """Returns the number of processes bootstrap uses by default: all available cores, or 1 within a worker process,
+    e.g. of tiled_analysis or parameter_sweep, whose own pool already takes every core."""
+    return 1 if multiprocessing.parent_process() is not None else os.cpu_count()
+
+
+@contextlib.contextmanager
+def pool(resamples=1, processes=None):
+    """Context manager giving the executor of bootstrap shared by every chunk of windows of an analysis, so that
+    worker processes are started once, with processes workers, default_processes by default. Gives None, i.e. the
+    calling process, without resamples or with a single process."""
+    processes = processes or default_processes()
+    if not resamples or processes == 1:
+        yield None
+        return
+    with concurrent.futures.ProcessPoolExecutor(processes) as executor:
+        yield executor
+
+
+@instrumentation.instrumented
+def bootstrap(counts, magnitude_levels, bin_size=0.2, precision=3, resamples=1000, confidence=0.95, seed=0,
+              processes=None, first_window=0, executor=None):
+    """Calculates bootstrap percentile intervals of the least squares regression and maximum likelihood b-values and
+    a-values of many windows. Expected input is the 2D NumPy array of histograms and the magnitude levels of
+    statistical_analysis.b_value_histogram_batch, e.g. from spatial_index.SpatialIndex.histograms or
+    statistical_analysis.window_histograms, and optionally the estimator settings, the number of resamples per window,
+    the confidence level of the intervals, a seed and the number of worker processes, see default_processes, or an
+    executor to run on, e.g. from pool, which is left running.
+    Every window gets an independent random stream spawned from the seed, so results don't depend on the number of
+    processes, nor on windows being bootstrapped in chunks, given the index of the first window of a chunk, or an
+    array of the index of every window, e.g. for windows computed in tiles.
+    Returns a Pandas DataFrame with a row per window and columns such as "B_lsr_low" and "B_lsr_high"."""
+    counts = np.asarray(counts)
+    percentiles = 50 * (1 - confidence), 50 * (1 + confidence)
+    windows = first_window + np.arange(len(counts)) if np.ndim(first_window) == 0 else np.asarray(first_window)
+    seeds = [np.random.SeedSequence(seed, spawn_key=(window,)) for window in windows.tolist()]
+    # the same streams as SeedSequence(seed).spawn, from any window on
+    processes = processes or default_processes()
+    chunks = np.array_split(np.arange(len(counts)), min(4 * processes, max(len(counts), 1)))
+    # several chunks per process balance windows of different sizes
+    arguments = ([counts[chunk] for chunk in chunks], itertools.repeat(magnitude_levels),
+                 [[seeds[window] for window in chunk] for chunk in chunks], itertools.repeat(bin_size),
+                 itertools.repeat(precision), itertools.repeat(resamples), itertools.repeat(percentiles))
+    if executor is not None:
+        intervals = list(executor.map(_bootstrap_windows, *arguments))
+    elif processes == 1:
+        intervals = list(map(_bootstrap_windows, *arguments))
+    else:
+        with concurrent.futures.ProcessPoolExecutor(processes) as executor:
+            intervals = list(executor.map(_bootstrap_windows, *arguments))
+    intervals = np.concatenate(intervals) if intervals else np.empty((0, len(ESTIMATES), 2))
+    return pd.DataFrame({f"{estimate}_{bound}": intervals[:, i, j]
+                         for i, estimate in enumerate(ESTIMATES) for j, bound in enumerate(["low", "high"])})
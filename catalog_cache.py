@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+
+import hashlib
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+import time_conversion
+
+CACHE_VERSION = 3  # bump whenever processing changes, so that older cache files are never reused
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "earthquake-modeling")
+DEFAULT_MAX_BYTES = 2 * 1024 ** 3
+ALIGNMENT = 64
+
+
+def file_hash(file_name, cache_dir=DEFAULT_CACHE_DIR):
+    """Returns the SHA-256 content hash of a file. Hashes are remembered by path, size and modification time, so an
+    unchanged file is only read in full once."""
+    stat = os.stat(file_name)
+    path, signature = os.path.abspath(file_name), [stat.st_size, stat.st_mtime_ns]
+    hashes_name = os.path.join(cache_dir, "hashes.json")
+    try:
+        with open(hashes_name) as hashes_file:
+            hashes = json.load(hashes_file)
+    except (OSError, ValueError):
+        hashes = {}
+    if hashes.get(path, [None])[:2] == signature:
+        return hashes[path][2]
+
+    digest = hashlib.sha256()
+    with open(file_name, "rb") as source:
+        for block in iter(lambda: source.read(2 ** 20), b""):
+            digest.update(block)
+    hashes[path] = signature + [digest.hexdigest()]
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(hashes_name + ".tmp", "w") as hashes_file:
+        json.dump(hashes, hashes_file)
+    os.replace(hashes_name + ".tmp", hashes_name)
+    return digest.hexdigest()
+
+
+def write_columns(file_name, df):
+    """Writes the index and numeric or datetime columns of a DataFrame as a columnar binary file: a little-endian
+    uint64 header length, a JSON header describing each column, along with the JSON serialisable DataFrame.attrs,
+    e.g. the UTM zone of a catalog, and the raw column data, each aligned to 64 bytes so that it can be
+    memory-mapped. Times are stored as int64 nanoseconds."""
+    columns = {"__index__": df.index.to_numpy(dtype=np.int64)}
+    for column in df.columns:
+        values = df[column].to_numpy()
+        columns[column] = time_conversion.nanoseconds(values) if values.dtype.kind == "M" else values
+    header, offset = [], 0
+    for column, values in columns.items():
+        header.append({"name": column, "dtype": values.dtype.str, "length": len(values), "offset": offset,
+                       "time": df[column].dtype.kind == "M" if column in df.columns else False})
+        offset += -(-values.nbytes // ALIGNMENT) * ALIGNMENT
+    header = json.dumps({"columns": header, "attrs": df.attrs}).encode()
+    data_start = -(-(8 + len(header)) // ALIGNMENT) * ALIGNMENT
+    with open(file_name + ".tmp", "wb") as cache_file:
+        cache_file.write(np.uint64(len(header)).astype("<u8").tobytes() + header)
+        for entry, values in zip(json.loads(header)["columns"], columns.values()):
+            cache_file.seek(data_start + entry["offset"])
+            cache_file.write(np.ascontiguousarray(values).tobytes())
+    os.replace(file_name + ".tmp", file_name)  # never leave a partially written cache file behind
+
+
+def read_columns(file_name):
+    """Memory-maps a file written by write_columns. Returns a DataFrame of zero-copy read-only views."""
+    with open(file_name, "rb") as cache_file:
+        header_length = int(np.frombuffer(cache_file.read(8), dtype="<u8")[0])
+        header = json.loads(cache_file.read(header_length))
+    data_start = -(-(8 + header_length) // ALIGNMENT) * ALIGNMENT
+    columns = {}
+    for entry in header["columns"]:
+        values = np.memmap(file_name, dtype=np.dtype(entry["dtype"]), mode="r", shape=(entry["length"],),
+                           offset=data_start + entry["offset"]) if entry["length"] else np.empty(0, entry["dtype"])
+        columns[entry["name"]] = values.view("datetime64[ns]") if entry["time"] else values
+    index = columns.pop("__index__")
+    df = pd.DataFrame(columns, index=index, copy=False)
+    df.attrs.update(header["attrs"])
+    return df
+
+
+def evict(cache_dir=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES):
+    """Deletes the least recently used cache files until the cache takes at most max_bytes."""
+    entries = [os.path.join(cache_dir, name) for name in os.listdir(cache_dir) if name.endswith(".catalog")]
+    entries = sorted(((os.stat(entry), entry) for entry in entries), key=lambda entry: entry[0].st_mtime)
+    total = sum(stat.st_size for stat, _ in entries)
+    for stat, entry in entries:
+        if total <= max_bytes:
+            break
+        os.remove(entry)
+        total -= stat.st_size
+
+
+def cached(file_name, settings, build, cache_dir=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES):
+    """Returns the processed catalog built from file_name with the given settings, from the cache when possible.
+    Expected input is the source file, a JSON serialisable dictionary of everything else the result depends on, e.g.
+    projection mode and filters, and a function without arguments that builds the DataFrame on a cache miss.
+    Cache files are keyed by the content hash of the source file, so they are invalidated when it changes."""
+    key = json.dumps([CACHE_VERSION, file_hash(file_name, cache_dir), settings], sort_keys=True)
+    cache_name = os.path.join(cache_dir, hashlib.sha256(key.encode()).hexdigest() + ".catalog")
+    if os.path.exists(cache_name):
+        os.utime(cache_name)  # marking as recently used for eviction
+        return read_columns(cache_name)
+    df = build()
+    if all(dtype.kind in "biufM" for dtype in df.dtypes):  # other columns can't be memory-mapped
+        write_columns(cache_name, df)
+        evict(cache_dir, max_bytes)
+    return df
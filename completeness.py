@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+
+import numpy as np
+
+import instrumentation
+import statistical_analysis
+
+
+def _binned_statistics(counts, magnitude_levels, bin_size, precision):
+    """Bins the magnitude histograms of many windows, see maximum_curvature, and returns 2D NumPy arrays of shape
+    (windows, bins) of the number of events in each bin and, for every bin taken as a candidate magnitude of
+    completeness, the number, mean, minimum and sum of squared deviations of the magnitudes of events in that bin and
+    above, along with the lower edge of every bin. Minimums are always one of the magnitude levels."""
+    counts = np.asarray(counts)
+    magnitude_levels = statistical_analysis.float64_magnitudes(magnitude_levels)
+    scaling_factor = 10 ** precision
+    rescaled_levels = (scaling_factor * magnitude_levels).astype(int)  # same truncation as the b-value estimators
+    bin_size = int(scaling_factor * bin_size)
+    level_bin = (rescaled_levels - rescaled_levels[0]) // bin_size
+    num_bins = level_bin[-1] + 1
+    one_hot = level_bin[:, None] == np.arange(num_bins)  # levels (rows) belonging to each bin (columns)
+
+    binned = counts @ one_hot
+    above = np.cumsum(binned[:, ::-1], axis=1)[:, ::-1]
+    sums = np.cumsum((counts * magnitude_levels) @ one_hot[:, ::-1], axis=1)[:, ::-1]
+    squares = np.cumsum((counts * magnitude_levels ** 2) @ one_hot[:, ::-1], axis=1)[:, ::-1]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean_magnitude = sums / above
+        sum_squared_deviations = np.maximum(squares - sums * mean_magnitude, 0)
+
+    present = np.where(counts > 0, np.arange(len(magnitude_levels)), len(magnitude_levels))
+    next_present = np.minimum.accumulate(present[:, ::-1], axis=1)[:, ::-1]  # first occupied level from each level on
+    first_present = np.take_along_axis(
+        np.column_stack((next_present, np.full(len(counts), len(magnitude_levels)))),
+        np.broadcast_to(np.searchsorted(level_bin, np.arange(num_bins)), binned.shape), axis=1)
+    min_magnitude = np.append(magnitude_levels, np.nan)[first_present]
+    edges = (rescaled_levels[0] + np.arange(num_bins) * bin_size) / scaling_factor
+    return binned, above, mean_magnitude, min_magnitude, sum_squared_deviations, edges
+
+
+@instrumentation.instrumented
+def maximum_curvature(counts, magnitude_levels, bin_size=0.1, precision=3):
+    """Estimates the magnitude of completeness of many windows at once as the magnitude bin with the most events, i.e.
+    the maximum of the first derivative of the frequency-magnitude distribution.
+    Expected input is the 2D NumPy array of histograms and the magnitude levels of
+    statistical_analysis.b_value_histogram_batch, and optionally the size of magnitude bins and the decimal place
+    precision magnitudes are truncated to when binned, as in statistical_analysis.b_value_least_squares_regression.
+    Returns a NumPy array of the magnitude of completeness of each window, which is the smallest magnitude level of the
+    events in that bin, and nan for empty windows."""
+    binned, _, _, min_magnitude, _, _ = _binned_statistics(counts, magnitude_levels, bin_size, precision)
+    if binned.shape[0] == 0:
+        return np.empty(0)
+    mc = min_magnitude[np.arange(len(binned)), binned.argmax(axis=1)]
+    return np.where(binned.any(axis=1), mc, np.nan)
+
+
+@instrumentation.instrumented
+def goodness_of_fit(counts, magnitude_levels, bin_size=0.1, precision=3, fit=95, min_events=50, chunk_windows=4096):
+    """Estimates the magnitude of completeness of many windows at once with the goodness-of-fit test of Wiemer and
+    Wyss (2000): the smallest magnitude bin from which on a Gutenberg-Richter law with the maximum likelihood b-value
+    and a-value of the events in and above that bin explains the observed cumulative counts of all bins above it to
+    within 100 - fit percent, among candidates with at least min_events events. Windows where no candidate fits fall
+    back to maximum_curvature. Windows are processed in chunks of chunk_windows, since every candidate is compared
+    against every bin. Expected input and returned values are as for maximum_curvature."""
+    binned, above, mean_magnitude, min_magnitude, sum_squared_deviations, edges = _binned_statistics(
+        counts, magnitude_levels, bin_size, precision)
+    b_value, a_value, _ = statistical_analysis._maximum_likelihood_batch(above, mean_magnitude, min_magnitude,
+                                                                         sum_squared_deviations)
+    mc = maximum_curvature(counts, magnitude_levels, bin_size, precision)
+    num_bins = len(edges)
+    later = np.arange(num_bins)[None, :] >= np.arange(num_bins)[:, None]  # bins (columns) at or above candidates
+    for first in range(0, len(binned), chunk_windows):
+        part = slice(first, first + chunk_windows)
+        observed = above[part, None, :]
+        with np.errstate(over="ignore", invalid="ignore"):
+            synthetic = 10 ** (a_value[part, :, None] - b_value[part, :, None] * edges)
+            compared = later & (observed > 0)
+            residual = np.sum(np.where(compared, np.abs(observed - synthetic), 0), axis=2)
+            goodness = 100 - 100 * residual / np.sum(np.where(compared, observed, 0), axis=2)
+        fitting = (goodness >= fit) & (above[part] >= min_events) & np.isfinite(b_value[part])
+        found = fitting.any(axis=1)
+        candidate = min_magnitude[part][np.arange(fitting.shape[0]), fitting.argmax(axis=1)]
+        mc[part] = np.where(found, candidate, mc[part])
+    return mc
+
+
+@instrumentation.instrumented
+def b_value_stability(counts, magnitude_levels, bin_size=0.1, precision=3, magnitude_range=0.5, min_events=50):
+    """Estimates the magnitude of completeness of many windows at once by b-value stability (Cao and Gao, 2002, as
+    refined by Woessner and Wiemer, 2005): the smallest magnitude bin whose maximum likelihood b-value lies within its
+    Shi and Bolt uncertainty of the mean b-value of the candidates spanning magnitude_range from it on, among
+    candidates with at least min_events events. Windows where no candidate is stable get nan.
+    Expected input and returned values are as for maximum_curvature."""
+    _, above, mean_magnitude, min_magnitude, sum_squared_deviations, _ = _binned_statistics(
+        counts, magnitude_levels, bin_size, precision)
+    b_value, _, std_err = statistical_analysis._maximum_likelihood_batch(above, mean_magnitude, min_magnitude,
+                                                                         sum_squared_deviations)
+    valid = (above >= min_events) & np.isfinite(b_value)
+    steps = max(int(round(magnitude_range / bin_size)), 1)
+    num_bins = above.shape[1]
+    summed_b_value, summed_valid = np.zeros((len(above), num_bins + 1)), np.zeros((len(above), num_bins + 1), int)
+    np.cumsum(np.where(valid, b_value, 0), axis=1, out=summed_b_value[:, 1:])
+    np.cumsum(valid, axis=1, out=summed_valid[:, 1:])
+    end = np.minimum(np.arange(num_bins) + steps, num_bins)  # running sums over the next steps candidates
+    valid_count = summed_valid[:, end] - summed_valid[:, :-1]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean_b_value = (summed_b_value[:, end] - summed_b_value[:, :-1]) / valid_count
+        stable = valid & (valid_count == steps) & (np.abs(mean_b_value - b_value) <= std_err)
+    found = stable.any(axis=1)
+    mc = min_magnitude[np.arange(len(above)), stable.argmax(axis=1)] if len(above) else np.empty(0)
+    return np.where(found, mc, np.nan)
+
+
+METHODS = {"maxc": maximum_curvature, "gft": goodness_of_fit, "mbs": b_value_stability}
+
+
+def above_completeness(counts, magnitude_levels, mc):
+    """Returns the histograms of many windows with the events below each window's magnitude of completeness removed.
+    Expected input is the 2D NumPy array of histograms and the magnitude levels of
+    statistical_analysis.b_value_histogram_batch and a NumPy array of magnitudes of completeness, as returned by the
+    estimators of this module, nan removes every event of a window."""
+    magnitude_levels = statistical_analysis.float64_magnitudes(magnitude_levels)
+    with np.errstate(invalid="ignore"):
+        return np.where(magnitude_levels >= np.asarray(mc)[:, None], counts, 0)
@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+
+import bisect
+import math
+
+import numpy as np
+
+import instrumentation
+import time_conversion
+
+DIRECT_CANDIDATES = 256  # windows of at most this many events in time are checked without the grid
+
+
+class EventGrid:
+    """Events binned in square cells of the xy-plane, kept in time order within every cell, so that the events of a
+    space-time window are found with two binary searches per cell of the window rather than by checking every event
+    in its time interval. Events are referred to by their index in time order."""
+
+    def __init__(self, x, y, cell_size):
+        """Expected input is NumPy arrays of event coordinates in km, in time order, and the cell size in km, e.g. the
+        smallest window radius."""
+        self.cell_size = cell_size
+        self.origin = (x.min(), y.min()) if len(x) else (0, 0)
+        cell_x = ((x - self.origin[0]) // cell_size).astype(np.int64)
+        cell_y = ((y - self.origin[1]) // cell_size).astype(np.int64)
+        self.shape = (int(cell_x.max()) + 1, int(cell_y.max()) + 1) if len(x) else (1, 1)
+        self.events = len(x)
+        keys = (cell_x * self.shape[1] + cell_y) * self.events + np.arange(len(x))  # by cell, then by time
+        self.order = np.argsort(keys)
+        self.keys = keys[self.order]
+
+    def candidates(self, x, y, radius, first, last):
+        """Returns a NumPy array of the events from first up to, but excluding, last in time order that lie in the
+        cells overlapping the square of radius km around (x, y), a superset of the events within radius of it."""
+        (low_x, high_x), (low_y, high_y) = (
+            (max(int((centre - radius - origin) // self.cell_size), 0),
+             min(int((centre + radius - origin) // self.cell_size), size - 1))
+            for centre, origin, size in zip((x, y), self.origin, self.shape))  # scalar arithmetic, called per event
+        cells = (np.arange(low_x, high_x + 1)[:, None] * self.shape[1] + np.arange(low_y, high_y + 1)).ravel()
+        starts = np.searchsorted(self.keys, cells * self.events + first)
+        sizes = np.searchsorted(self.keys, cells * self.events + last) - starts
+        offsets = np.arange(sizes.sum()) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+        return self.order[np.repeat(starts, sizes) + offsets]
+
+
+def _time_order(df):
+    """Returns the order of the events of a catalog by time and their times in nanoseconds, coordinates and magnitudes
+    in that order, as NumPy arrays."""
+    times = time_conversion.nanoseconds(df["Time"])
+    order = np.argsort(times, kind="stable")
+    x, y, z, magnitudes = (df[column].to_numpy(dtype=float)[order] for column in ["X", "Y", "Z", "Magnitude"])
+    return order, times[order], x, y, z, magnitudes
+
+
+def _labels(order, cluster, magnitudes):
+    """Returns the cluster labels and mainshock flags of events in their original order, from clusters given as any
+    integers, 0 for none, of events in time order. Clusters are numbered from 1 in the order of their first event and
+    their mainshock is their largest event, the first one on ties."""
+    ids, inverse = np.unique(cluster, return_inverse=True)
+    labels = inverse + (0 if len(ids) and ids[0] == 0 else 1)  # 0 stays 0 for independent events
+    mainshock = labels == 0
+    clustered = np.flatnonzero(labels)
+    by_size = clustered[np.lexsort((-magnitudes[clustered], labels[clustered]))]  # largest first within a cluster
+    if len(by_size):
+        mainshock[by_size[np.r_[True, labels[by_size][1:] != labels[by_size][:-1]]]] = True
+    first_event = np.full(labels.max(initial=0) + 1, len(labels))
+    np.minimum.at(first_event, labels, np.arange(len(labels)))
+    renumber = np.zeros(len(first_event), dtype=np.int64)
+    renumber[np.argsort(first_event[1:], kind="stable") + 1] = np.arange(1, len(first_event))
+    result_labels, result_mainshock = np.empty_like(labels), np.empty_like(mainshock)
+    result_labels[order], result_mainshock[order] = renumber[labels], mainshock
+    return result_labels, result_mainshock
+
+
+def gardner_knopoff_window(magnitudes):
+    """Returns NumPy arrays of the radius in km and duration in days of the Gardner and Knopoff (1974) windows of
+    magnitudes, as tabulated by Gardner and Knopoff and fit by van Stiphout et al. (2012)."""
+    magnitudes = np.asarray(magnitudes, dtype=float)
+    radius = 10 ** (0.1238 * magnitudes + 0.983)
+    duration = np.where(magnitudes >= 6.5, 10 ** (0.032 * magnitudes + 2.7389), 10 ** (0.5409 * magnitudes - 0.547))
+    return radius, duration
+
+
+@instrumentation.instrumented
+def gardner_knopoff(df, foreshock_fraction=1.0, hypocentral=False, cell_size=None):
+    """Declusters a catalog with the windows of Gardner and Knopoff (1974). Events are taken as mainshocks from the
+    largest down, and every event not yet in a cluster within the radius and duration of a mainshock, see
+    gardner_knopoff_window, joins its cluster, including foreshocks up to foreshock_fraction of the duration before
+    it. Distances are epicentral, along X and Y, or with hypocentral also along Z, e.g. for Earth centred
+    coordinates.
+    Expected input is a Pandas DataFrame with columns "Time", "X", "Y", "Z" and "Magnitude". Every mainshock only
+    checks the events of its time interval in the cells of an EventGrid, of cell_size km, by default the smallest
+    radius, within its radius, so large catalogs take far less than quadratic time.
+    Returns NumPy arrays of the cluster of every event, 0 for independent events, and whether it is a mainshock,
+    either independent or the largest event of its cluster."""
+    order, times, x, y, z, magnitudes = _time_order(df)
+    radius, duration = gardner_knopoff_window(magnitudes)
+    duration = np.rint(duration * time_conversion.NANOSECONDS["day"]).astype(np.int64)
+    grid = EventGrid(x, y, cell_size or (radius.min() if len(radius) else 1))
+    cluster = np.zeros(len(times), dtype=np.int64)
+    time_list, duration_list = times.tolist(), duration.tolist()
+    for i in np.argsort(-magnitudes, kind="stable").tolist():  # larger events first, earlier ones first on ties
+        if cluster[i]:
+            continue
+        first = bisect.bisect_left(time_list, time_list[i] - int(foreshock_fraction * duration_list[i]))
+        last = bisect.bisect_right(time_list, time_list[i] + duration_list[i])
+        if last - first <= 1:  # alone in its time interval
+            continue
+        candidates = np.arange(first, last) if last - first <= DIRECT_CANDIDATES else \
+            grid.candidates(x[i], y[i], radius[i], first, last)
+        candidates = candidates[cluster[candidates] == 0]
+        distances = (x[candidates] - x[i]) ** 2 + (y[candidates] - y[i]) ** 2
+        if hypocentral:
+            distances += (z[candidates] - z[i]) ** 2
+        members = candidates[distances <= radius[i] ** 2]
+        if len(members) > 1:  # the event itself is always a member
+            cluster[members] = i + 1
+    return _labels(order, cluster, magnitudes)
+
+
+def crack_radius(magnitudes):
+    """Returns a NumPy array of the radius in km of the circular crack of each magnitude, after Kanamori and Anderson
+    (1975), as used by Reasenberg (1985)."""
+    return 0.011 * 10 ** (0.4 * np.asarray(magnitudes, dtype=float))
+
+
+@instrumentation.instrumented
+def reasenberg(df, tau_min=1.0, tau_max=10.0, probability=0.95, xk=0.5, xmeff=1.5, rfact=10, horizontal_error=1.5,
+               depth_error=2.0, max_radius=30.0, cell_size=None):
+    """Declusters a catalog with the algorithm of Reasenberg (1985). Events are swept in time order and every event
+    links the later events of its interaction zone to its cluster, merging clusters as needed:
+    - in time, up to tau_min days after independent events, and for events of a cluster the look-ahead time in days
+      within which another event is expected with the given probability, from Omori's law, after the largest event of
+      the cluster, with a minimum magnitude of xmeff raised by xk of the magnitude of the largest event, clipped to
+      tau_min to tau_max days,
+    - in space, within rfact crack radii of the event, see crack_radius, plus one crack radius of the largest event of
+      its cluster, at most max_radius km, of hypocentral distance less the location errors in km.
+    The parameters are the defaults of Reasenberg's CLUSTER program. Expected input is a Pandas DataFrame with columns
+    "Time", "X", "Y", "Z" and "Magnitude" in projected coordinates, see process_input.load. Events only check the
+    later events of their look-ahead time within their zone, directly or through the cells of an EventGrid, of
+    cell_size km, by default an eighth of max_radius.
+    Returns NumPy arrays as gardner_knopoff does."""
+    order, times, x, y, z, magnitudes = _time_order(df)
+    days = time_conversion.NANOSECONDS["day"]
+    grid = EventGrid(x, y, cell_size or max_radius / 8)
+    cluster = np.zeros(len(times), dtype=np.int64)  # a root of parent, 0 for none
+    parent = [0]  # union-find forest of cluster ids, parent[id] == id for roots
+    largest = [0]  # event index of the largest event of each root cluster
+
+    def root(label):
+        while parent[label] != label:
+            parent[label] = parent[parent[label]]  # path halving
+            label = parent[label]
+        return label
+
+    time_list, magnitude_list, cracks = times.tolist(), magnitudes.tolist(), crack_radius(magnitudes).tolist()
+    # Python scalars, as the sweep looks up single events far more often than it computes on arrays
+    for i in range(len(time_list)):
+        label = root(int(cluster[i])) if cluster[i] else 0
+        radius = rfact * cracks[i]
+        tau = tau_min
+        if label:
+            big = largest[label]
+            radius += cracks[big]
+            elapsed = (time_list[i] - time_list[big]) / days
+            if elapsed > 0:
+                expected = 10 ** (((1 - xk) * magnitude_list[big] - xmeff - 1) * 2 / 3)
+                tau = min(max(-math.log(1 - probability) * elapsed / expected, tau_min), tau_max)
+        radius = min(radius, max_radius)
+        last = bisect.bisect_right(time_list, time_list[i] + int(tau * days), i + 1)
+        if last - i <= 1:
+            continue
+        candidates = np.arange(i + 1, last) if last - i <= DIRECT_CANDIDATES else \
+            grid.candidates(x[i], y[i], radius + horizontal_error, i + 1, last)
+        if label:
+            candidates = candidates[cluster[candidates] != label]
+            # linking events already in the cluster changes nothing, which saves most of the work in long sequences
+        horizontal = np.maximum(np.hypot(x[candidates] - x[i], y[candidates] - y[i]) - horizontal_error, 0)
+        vertical = np.maximum(np.abs(z[candidates] - z[i]) - depth_error, 0)
+        linked = candidates[horizontal ** 2 + vertical ** 2 <= radius ** 2]
+        if not len(linked):
+            continue
+        if not label:
+            label = len(parent)
+            parent.append(label)
+            largest.append(i)
+            cluster[i] = label
+        for other in {root(other) for other in set(cluster[linked].tolist()) - {0}} - {label}:
+            parent[other] = label  # merging the clusters of linked events
+            if magnitude_list[largest[other]] > magnitude_list[largest[label]]:
+                largest[label] = largest[other]
+        cluster[linked] = label
+        biggest = int(linked[np.argmax(magnitudes[linked])])
+        if magnitude_list[biggest] > magnitude_list[largest[label]]:
+            largest[label] = biggest
+    roots = np.array([root(label) for label in range(len(parent))], dtype=np.int64)
+    return _labels(order, roots[cluster], magnitudes)
+
+
+METHODS = {"gk": gardner_knopoff, "reasenberg": reasenberg}
+
+
+@instrumentation.instrumented
+def label(df, method="gk", **parameters):
+    """Returns a copy of a catalog with the columns "Cluster", the cluster of every event from 1 or 0 for independent
+    events, and "Mainshock", whether it is independent or the largest event of its cluster, from a declustering
+    method of METHODS with its keyword parameters. Labels can be used as filters ahead of any window analysis, e.g.
+    region_filter.value_range("Cluster", 0, 0) for independent events only."""
+    cluster, mainshock = METHODS[method](df, **parameters)
+    return df.assign(Cluster=cluster, Mainshock=mainshock)
+
+
+@instrumentation.instrumented
+def decluster(df, method="gk", **parameters):
+    """Removes the events of clusters other than their mainshocks, see label."""
+    return df[METHODS[method](df, **parameters)[1]]
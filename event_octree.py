@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+
+import numpy as np
+
+
+def _spread_bits(values):
+    """Spreads the lowest 21 bits of each integer so that two zero bits separate consecutive bits, for Morton codes."""
+    values = values.astype(np.uint64) & np.uint64(0x1FFFFF)
+    for shift, mask in ((32, 0x1F00000000FFFF), (16, 0x1F0000FF0000FF), (8, 0x100F00F00F00F00F),
+                        (4, 0x10C30C30C30C30C3), (2, 0x1249249249249249)):
+        values = (values | (values << np.uint64(shift))) & np.uint64(mask)
+    return values
+
+
+def morton_codes(cells):
+    """Returns the Morton (Z-order) codes of integer cell coordinates. Expected input is a NumPy array of shape (n, 3).
+    Sorting by Morton code places the events of every octree node in one contiguous range."""
+    return _spread_bits(cells[:, 0]) | (_spread_bits(cells[:, 1]) << np.uint64(1)) | \
+        (_spread_bits(cells[:, 2]) << np.uint64(2))
+
+
+def morton_cells(codes, depth):
+    """Returns the integer cell coordinates, as a NumPy array of shape (n, 3), of the Morton codes of cells of an
+    octree level depth, i.e. codes of 3 * depth bits. Inverse of morton_codes."""
+    cells = np.zeros((len(codes), 3), dtype=np.int64)
+    for bit in range(depth):
+        for axis in range(3):
+            cells[:, axis] |= ((codes >> np.uint64(3 * bit + axis)) & np.uint64(1)).astype(np.int64) << bit
+    return cells
+
+
+class EventOctree:
+    """Octree of events for level-of-detail rendering. Space is split into tiles at tile_depth, which are the unit
+    of drawing, and below them into nodes down to max_depth. Every event gets a level of detail: the shallowest level
+    at which it is among the points_per_node most important events of its node, where importance is a random key
+    weighted by 10 ** (b_value * magnitude) so that large events are kept at every level. The events of each tile are
+    stored in order of level of detail, so the events to draw at any level are a prefix of the tile's events."""
+
+    def __init__(self, positions, magnitudes, tile_depth=3, max_depth=10, points_per_node=32, b_value=1.0, seed=0):
+        """Expected input is a NumPy array of event positions of shape (n, 3), a NumPy array of magnitudes, and
+        optionally the depths of tiles and of the deepest nodes, the events per node at each level, the weighting
+        of magnitudes and the seed of the random importance keys."""
+        self.tile_depth, self.max_depth = tile_depth, max_depth
+        low, high = positions.min(axis=0), positions.max(axis=0)
+        self.size = max(np.max(high - low), 1e-9) * (1 + 1e-9)  # side of the root cube
+        self.origin = low
+        cells = ((positions - low) / self.size * 2 ** max_depth).astype(np.int64)
+        codes = morton_codes(np.minimum(cells, 2 ** max_depth - 1))
+
+        rng = np.random.default_rng(seed)
+        weight = 10 ** (b_value * (magnitudes - np.max(magnitudes, initial=0)))
+        priority = np.log(rng.random(len(magnitudes))) / np.maximum(weight, 1e-300)
+        # weighted sampling keys (Efraimidis-Spirakis), a larger key is more important
+        rank = np.empty(len(priority), dtype=np.uint64)
+        rank[np.argsort(-priority)] = np.arange(len(priority), dtype=np.uint64)
+        # importance ranks packed below node ids into single sort keys, which leaves room for max_depth up to 10
+
+        self.levels = np.full(len(codes), max_depth + 1)  # level of detail of each event
+        candidates = np.arange(len(codes))
+        for level in range(max_depth, tile_depth - 1, -1):
+            node = codes[candidates] >> np.uint64(3 * (max_depth - level))
+            order = np.argsort((node << np.uint64(32)) | rank[candidates])
+            sorted_node = node[order]
+            group_start = np.searchsorted(sorted_node, sorted_node, side="left")
+            candidates = candidates[order[np.arange(len(order)) - group_start < points_per_node]]
+            self.levels[candidates] = level
+            # a top event of a node is a top event of its children, so only those are candidates at the next level
+
+        tiles = codes >> np.uint64(3 * (max_depth - tile_depth))
+        self.order = np.argsort((tiles << np.uint64(36)) | (self.levels.astype(np.uint64) << np.uint64(32)) | rank)
+        # events sorted by tile, then level of detail, then importance
+        self.tiles, tile_starts = np.unique(tiles[self.order], return_index=True)
+        self.tile_offsets = np.append(tile_starts, len(codes))
+        tile_of_event = np.repeat(np.arange(len(self.tiles)), np.diff(self.tile_offsets))
+        counts = np.zeros((len(self.tiles), max_depth + 2 - tile_depth), dtype=np.int64)
+        np.add.at(counts, (tile_of_event, self.levels[self.order] - tile_depth), 1)
+        self.level_counts = np.cumsum(counts, axis=1)
+        # level_counts[tile, level - tile_depth] is the number of events to draw for the tile at that level
+
+        tile_cells = morton_cells(self.tiles, tile_depth)
+        self.tile_size = self.size / 2 ** tile_depth
+        self.tile_centres = self.origin + (tile_cells + 0.5) * self.tile_size
+
+    def tile_events(self, tile):
+        """Returns the indices of the events of a tile in order of level of detail."""
+        return self.order[self.tile_offsets[tile]:self.tile_offsets[tile + 1]]
+
+    def counts(self, levels):
+        """Returns the number of events to draw for each tile at the given levels, one per tile. Levels deeper than
+        max_depth draw every event of the tile."""
+        levels = np.clip(levels, self.tile_depth, self.max_depth + 1) - self.tile_depth
+        return self.level_counts[np.arange(len(self.tiles)), levels]
+
+    def view_levels(self, camera, direction, fov, height, node_pixels=64):
+        """Chooses a level of detail for every tile from the camera position and viewing direction (NumPy arrays),
+        the vertical field of view in degrees and the viewport height in pixels: deep enough that nodes, each drawn
+        with up to points_per_node events, span at most node_pixels pixels. Tiles outside of the view get level -1,
+        i.e. are hidden."""
+        offset = self.tile_centres - camera
+        distance = np.maximum(np.linalg.norm(offset, axis=1), 1e-9)
+        radius = self.tile_size * np.sqrt(3) / 2
+        angle = np.arccos(np.clip(offset @ direction / (distance * np.linalg.norm(direction)), -1, 1))
+        visible = (distance <= radius) | (angle <= np.radians(fov) + np.arcsin(np.minimum(radius / distance, 1)))
+        # generous cone around the view direction, widened for the aspect ratio and the extent of each tile
+        tile_pixels = self.tile_size / distance * height / (2 * np.tan(np.radians(fov) / 2))
+        levels = self.tile_depth + np.ceil(np.log2(np.maximum(tile_pixels / node_pixels, 1)))
+        return np.where(visible, levels, -1).astype(int)
@@ -1,28 +1,155 @@
 #!/usr/bin/env python3
 
 import numpy as np
-import utm
 
+import instrumentation
 
-def get_cartesian(latitude, longitude, depth):
+CHUNK_SIZE = 2 ** 16  # positions converted at a time, small enough for the temporary arrays to stay in cache
+
+# WGS84 ellipsoid and UTM constants
+SEMI_MAJOR_AXIS = 6378137.0
+FLATTENING = 1 / 298.257223563
+SCALE_FACTOR = 0.9996
+FALSE_EASTING = 500000.0
+FALSE_NORTHING = 10000000.0  # southern hemisphere only
+ZONE_LETTERS = "CDEFGHJKLMNPQRSTUVWXX"
+
+
+def _kruger_coefficients():
+    """Returns the rectifying radius and the coefficients of the Krüger series for the transverse Mercator projection,
+    accurate to well under a millimetre within a UTM zone."""
+    n = FLATTENING / (2 - FLATTENING)
+    radius = SEMI_MAJOR_AXIS / (1 + n) * (1 + n ** 2 / 4 + n ** 4 / 64 + n ** 6 / 256)
+    alpha = np.array([
+        n / 2 - 2 * n ** 2 / 3 + 5 * n ** 3 / 16 + 41 * n ** 4 / 180 - 127 * n ** 5 / 288 + 7891 * n ** 6 / 37800,
+        13 * n ** 2 / 48 - 3 * n ** 3 / 5 + 557 * n ** 4 / 1440 + 281 * n ** 5 / 630 - 1983433 * n ** 6 / 1935360,
+        61 * n ** 3 / 240 - 103 * n ** 4 / 140 + 15061 * n ** 5 / 26880 + 167603 * n ** 6 / 181440,
+        49561 * n ** 4 / 161280 - 179 * n ** 5 / 168 + 6601661 * n ** 6 / 7257600,
+        34729 * n ** 5 / 80640 - 3418889 * n ** 6 / 1995840,
+        212378941 * n ** 6 / 319334400])
+    return n, radius, alpha
+
+
+N, RECTIFYING_RADIUS, ALPHA = _kruger_coefficients()
+
+
+@instrumentation.instrumented
+def get_cartesian(latitude, longitude, depth, out=None):
     """Converts spherical to Cartesian coordinates using WGS84 ellipsoid constants,
     adapted from https://www.mathworks.com/matlabcentral/fileexchange/7942-covert-lat-lon-alt-to-ecef-cartesian
-    Expected inputs are NumPy arrays."""
-    latitude = (latitude * np.pi) / 180  # converting to radians
-    longitude = (longitude * np.pi) / 180  # converting to radians
+    Expected inputs are NumPy arrays and, optionally, a tuple of three NumPy arrays of the same length to write x, y
+    and z into, e.g. float32 arrays or columns of an existing array. Positions are converted in chunks that reuse the
+    same few temporary arrays, so memory beyond the output doesn't grow with the number of positions."""
+    if out is None:
+        out = tuple(np.empty(len(latitude)) for _ in range(3))
+    x, y, z = out
     a = 6378.137
     e = 8.1819190842622e-2
-    N = a / np.sqrt(1 - e**2 * np.sin(latitude)**2)
-    K = (N - depth) * np.cos(latitude)
-    x = K * np.cos(longitude)
-    y = K * np.sin(longitude)
-    z = ((1 - e**2) * N - depth) * np.sin(latitude)
+    buffers = [np.empty(min(CHUNK_SIZE, len(latitude))) for _ in range(4)]
+    for start in range(0, len(latitude), CHUNK_SIZE):
+        end = min(start + CHUNK_SIZE, len(latitude))
+        lat, lon, n, k = (buffer[:end - start] for buffer in buffers)
+        np.radians(latitude[start:end], out=lat)  # converting to radians
+        np.radians(longitude[start:end], out=lon)
+        np.sin(lat, out=n)
+        np.cos(lat, out=lat)  # the latitude itself is no longer needed, only its sine and cosine
+        np.multiply(n, n, out=k)
+        np.multiply(k, -e**2, out=k)
+        np.add(k, 1, out=k)
+        np.sqrt(k, out=k)
+        np.divide(a, k, out=k)  # k is now N = a / sqrt(1 - e**2 * sin(latitude)**2)
+        np.multiply(k, 1 - e**2, out=z[start:end])
+        np.subtract(z[start:end], depth[start:end], out=z[start:end])
+        np.multiply(z[start:end], n, out=z[start:end])  # ((1 - e**2) * N - depth) * sin(latitude)
+        np.subtract(k, depth[start:end], out=k)
+        np.multiply(k, lat, out=k)  # K = (N - depth) * cos(latitude)
+        np.cos(lon, out=n)
+        np.multiply(k, n, out=x[start:end])
+        np.sin(lon, out=n)
+        np.multiply(k, n, out=y[start:end])
     return x, y, z
 
 
-def get_utm(latitude, longitude, depth):
-    """Converts spherical to UTM coordinates. Expected inputs are NumPy arrays."""
-    x, y = utm.from_latlon(latitude, longitude)[:2]
-    # get first two values from UTM coordinates, easting and northing
+def get_geographic(x, y, z):
+    """Converts the Cartesian coordinates of get_cartesian back to latitude and longitude in degrees with Bowring's
+    formula, accurate to a few centimetres for events within the crust. Expected inputs are NumPy arrays in km."""
+    a = 6378.137
+    e = 8.1819190842622e-2
+    b = a * np.sqrt(1 - e**2)
+    p = np.hypot(x, y)
+    theta = np.arctan2(z * a, p * b)
+    latitude = np.arctan2(z + e**2 / (1 - e**2) * b * np.sin(theta) ** 3, p - e**2 * a * np.cos(theta) ** 3)
+    return np.degrees(latitude), np.degrees(np.arctan2(y, x))
+
+
+def get_utm_zones(latitude, longitude):
+    """Returns NumPy arrays of the UTM zone number and whether the zone is northern of each position, including the
+    exceptions around Norway and Svalbard. Expected inputs are NumPy arrays."""
+    latitude, longitude = np.asarray(latitude), np.asarray(longitude)
+    longitude = (longitude % 360 + 540) % 360 - 180  # normalizing to [-180, 180)
+    zone_number = ((longitude + 180) // 6).astype(int) + 1
+    zone_number[(56 <= latitude) & (latitude < 64) & (3 <= longitude) & (longitude < 12)] = 32
+    svalbard = (72 <= latitude) & (latitude <= 84) & (longitude >= 0)
+    for zone, low, high in ((31, 0, 9), (33, 9, 21), (35, 21, 33), (37, 33, 42)):
+        zone_number[svalbard & (low <= longitude) & (longitude < high)] = zone
+    return zone_number, latitude >= 0
+
+
+def get_utm_zone(latitude, longitude):
+    """Returns the UTM zone number and letter of the first position, which get_utm uses for all positions by
+    default, or None without any position. Expected inputs are NumPy arrays."""
+    if not latitude.size:  # e.g. an empty catalog, or a chunk whose events were all removed
+        return None
+    zone_number = get_utm_zones(latitude.flat[:1], longitude.flat[:1])[0][0]
+    return int(zone_number), ZONE_LETTERS[int(latitude.flat[0] + 80) >> 3]
+
+
+def _transverse_mercator(latitude, longitude, central_longitude, northern, easting, northing):
+    """Projects positions in degrees onto UTM eastings and northings in kilometres with the Krüger series, writing into
+    the given output arrays. The central longitude and hemisphere are scalars or arrays of the same length."""
+    latitude, longitude = np.radians(latitude), np.radians(longitude - central_longitude)
+    longitude = (longitude + np.pi) % (2 * np.pi) - np.pi  # wrapping across the antimeridian
+    sin_latitude = np.sin(latitude)
+    c = 2 * np.sqrt(N) / (1 + N)
+    t = np.sinh(np.arctanh(sin_latitude) - c * np.arctanh(c * sin_latitude))
+    xi = np.arctan2(t, np.cos(longitude))
+    eta = np.arctanh(np.sin(longitude) / np.sqrt(1 + t ** 2))
+    sin_2xi, cos_2xi = np.sin(2 * xi), np.cos(2 * xi)
+    exp_2eta = np.exp(2 * eta)
+    cosh_2eta, sinh_2eta = (exp_2eta + 1 / exp_2eta) / 2, (exp_2eta - 1 / exp_2eta) / 2
+    cos_real, cos_imag = 2 * cos_2xi * cosh_2eta, -2 * sin_2xi * sinh_2eta  # 2 * cos(2 * zeta)
+    b1_real, b1_imag, b2_real, b2_imag = 0, 0, 0, 0
+    for alpha in ALPHA[::-1]:
+        b1_real, b1_imag, b2_real, b2_imag = (alpha + cos_real * b1_real - cos_imag * b1_imag - b2_real,
+                                              cos_real * b1_imag + cos_imag * b1_real - b2_imag, b1_real, b1_imag)
+    sin_real, sin_imag = sin_2xi * cosh_2eta, cos_2xi * sinh_2eta  # sin(2 * zeta)
+    xi += b1_real * sin_real - b1_imag * sin_imag
+    eta += b1_real * sin_imag + b1_imag * sin_real
+    # Clenshaw summation of the series of alpha_j * sin(2 * j * zeta) for the complex zeta = xi + i * eta, with
+    # three trigonometric calls instead of 24, written out in real arithmetic which NumPy evaluates faster
+    easting[:] = (FALSE_EASTING + SCALE_FACTOR * RECTIFYING_RADIUS * eta) / 1000
+    northing[:] = (SCALE_FACTOR * RECTIFYING_RADIUS * xi + np.where(northern, 0, FALSE_NORTHING)) / 1000
+
+
+@instrumentation.instrumented
+def get_utm(latitude, longitude, depth, zone=None, dtype=np.float64):
+    """Converts spherical to UTM coordinates. Expected inputs are NumPy arrays and, optionally, the zone policy and the
+    output dtype, e.g. np.float32 to halve memory (calculations are still done in float64).
+    By default every position is projected into the zone of the first position, as the utm package does for arrays.
+    The zone can instead be forced with a zone number and letter pair, e.g. to project a catalog in chunks
+    consistently, or be "event" to project each position into its own zone, which is only distortion free within
+    each zone since eastings restart at every zone boundary, see get_utm_zones.
+    Positions are projected in chunks to keep temporary arrays in cache. Empty input gives empty arrays."""
+    if zone is None:
+        zone = get_utm_zone(latitude, longitude)
+    x, y = np.empty(len(latitude), dtype=dtype), np.empty(len(latitude), dtype=dtype)
+    for start in range(0, len(latitude), CHUNK_SIZE):
+        part = slice(start, start + CHUNK_SIZE)
+        if zone == "event":
+            zone_number, northern = get_utm_zones(latitude[part], longitude[part])
+        else:
+            zone_number, northern = zone[0], zone[1].upper() >= "N"
+        _transverse_mercator(latitude[part], longitude[part], (zone_number - 1) * 6 - 180 + 3, northern,
+                             x[part], y[part])  # x and y are in kilometres
     z = -depth  # z is negative of depth
-    return x / 1000, y / 1000, z  # rescale x and y to be in kilometres
+    return x, y, z.astype(dtype, copy=False)
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+
+import atexit
+import contextlib
+import functools
+import json
+import os
+import threading
+import time
+import tracemalloc
+
+TRACE_VARIABLE = "EARTHQUAKE_MODELING_TRACE"  # environment variable naming a trace file, enables instrumentation
+
+_state = {"enabled": False, "memory": False, "origin": 0.0}
+_events = []  # Chrome trace events of finished stages
+_statistics = {}  # stage name: [calls, total seconds, rows, peak bytes]
+_stack = threading.local()  # open stages of each thread, for memory peaks of nested stages
+
+
+def enable(memory=True):
+    """Starts recording stages. With memory, allocations are traced with tracemalloc to find the peak memory of each
+    stage, which slows down Python heavy code such as Pandas but includes NumPy arrays."""
+    _state["enabled"], _state["memory"] = True, memory
+    _state["origin"] = time.perf_counter()
+    if memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+def disable():
+    """Stops recording stages, keeping what was recorded."""
+    _state["enabled"] = False
+    if _state["memory"] and tracemalloc.is_tracing():
+        tracemalloc.stop()
+
+
+def reset():
+    """Forgets every recorded stage."""
+    _events.clear()
+    _statistics.clear()
+
+
+def enabled():
+    """Returns whether stages are being recorded."""
+    return _state["enabled"]
+
+
+@contextlib.contextmanager
+def _recorded_stage(name, rows):
+    """Records the wall time, rows and peak memory of the enclosed code as one call of a stage."""
+    frames = _stack.__dict__.setdefault("frames", [])
+    memory = _state["memory"] and tracemalloc.is_tracing()
+    frame = {"memory": 0, "peak": 0}
+    if memory:
+        current, peak = tracemalloc.get_traced_memory()
+        if frames:
+            frames[-1]["peak"] = max(frames[-1]["peak"], peak)  # the enclosing stage's peak so far
+        tracemalloc.reset_peak()
+        frame = {"memory": current, "peak": current}
+    frames.append(frame)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        end = time.perf_counter()
+        frames.pop()
+        peak_memory = 0
+        if memory:
+            peak = max(frame["peak"], tracemalloc.get_traced_memory()[1])
+            peak_memory = peak - frame["memory"]
+            if frames:
+                frames[-1]["peak"] = max(frames[-1]["peak"], peak)
+        arguments = {"rows": rows} if rows is not None else {}
+        if memory:
+            arguments["peak_memory"] = peak_memory
+        _events.append({"name": name, "ph": "X", "ts": (start - _state["origin"]) * 1e6, "dur": (end - start) * 1e6,
+                        "pid": os.getpid(), "tid": threading.get_ident(), "args": arguments})
+        statistics = _statistics.setdefault(name, [0, 0.0, 0, 0])
+        statistics[0] += 1
+        statistics[1] += end - start
+        statistics[2] += rows or 0
+        statistics[3] = max(statistics[3], peak_memory)
+
+
+def stage(name, rows=None):
+    """Context manager recording the enclosed code as a stage with the number of rows it processed, if instrumentation
+    is enabled, and doing nothing otherwise."""
+    if not _state["enabled"]:
+        return contextlib.nullcontext()
+    return _recorded_stage(name, rows)
+
+
+def instrumented(function):
+    """Decorator recording every call of a function as a stage named after its module and name, with the length of
+    its first argument, e.g. a DataFrame or an array, as rows. When instrumentation is disabled the only overhead is
+    one flag check per call."""
+    name = function.__module__ + "." + function.__qualname__
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if not _state["enabled"]:
+            return function(*args, **kwargs)
+        rows = len(args[0]) if args and hasattr(args[0], "__len__") and not isinstance(args[0], str) else None
+        with _recorded_stage(name, rows):
+            return function(*args, **kwargs)
+    return wrapper
+
+
+def summary():
+    """Returns a list of dictionaries of the statistics of every recorded stage, slowest first."""
+    rows = [{"stage": name, "calls": calls, "total_time": total, "rows": rows, "peak_memory": peak}
+            for name, (calls, total, rows, peak) in _statistics.items()]
+    return sorted(rows, key=lambda row: row["total_time"], reverse=True)
+
+
+def print_summary():
+    """Prints a table of the statistics of every recorded stage. Times of nested stages are also part of the times of
+    the stages enclosing them."""
+    print(f"\n{'Stage':<60} {'Calls':>7} {'Total (s)':>10} {'Mean (ms)':>10} {'Rows':>11} {'Peak (MiB)':>11}")
+    for row in summary():
+        mean_time, peak_memory = row["total_time"] / row["calls"] * 1000, row["peak_memory"] / 2 ** 20
+        print(f"{row['stage']:<60} {row['calls']:>7} {row['total_time']:>10.4f} {mean_time:>10.3f} {row['rows']:>11} "
+              f"{peak_memory:>11.1f}")
+
+
+def write_trace(file_name):
+    """Writes the recorded stages as a Chrome trace file, which chrome://tracing and https://ui.perfetto.dev open, with
+    the summary statistics under an extra "summary" key. Stages run in worker processes are not recorded."""
+    with open(file_name, "w") as trace_file:
+        json.dump({"traceEvents": _events, "displayTimeUnit": "ms", "summary": summary()}, trace_file)
+
+
+def _trace_at_exit(file_name):
+    """Writes the trace and prints the summary when the program exits."""
+    write_trace(file_name)
+    print_summary()
+
+
+if os.environ.get(TRACE_VARIABLE):  # instrumenting interactive runs, e.g. of moving_window.py, without code changes
+    enable()
+    atexit.register(_trace_at_exit, os.environ[TRACE_VARIABLE])
@@ -5,21 +5,40 @@ import itertools
 
 import numpy as np
 import pandas as pd
-from PyQt5.QtWidgets import QApplication, QFileDialog
 
+import adaptive_windows
+import bootstrap
+import completeness
+import instrumentation
 import plot_b_value
 import process_input
+import result_cache
+import result_writers
+import spacetime_index
+import spatial_index
 import statistical_analysis
+import time_conversion
 
 
-def spatial_window_export(exported_data):
-    """Exports data from spatial moving window analysis."""
-    file_name = QFileDialog.getSaveFileName(filter="CSV Files (*.csv);;All Files (*)")[0]  # technically a path object
-    if file_name != "":
-        df_export = pd.DataFrame(exported_data,
-                                 columns=["X_min", "X_max", "Y_min", "Y_max", "Z_min", "Z_max", "Event_count",
-                                          "B_lsr", "A_lsr", "B_ml", "A_ml", "Std_err_ml"])
-        df_export.to_csv(file_name, encoding="utf-8", index=False)
+def export_results(df_export, file_name):
+    """Writes exported data with the result_writers.ResultWriter of the extension of file_name, CSV by default."""
+    with result_writers.writer(file_name) as writer:
+        writer.write(df_export)
+
+
+def spatial_window_export(df_export, df_plot=None):
+    """Exports data from spatial moving window analysis, or the gridded values of df_plot to a NetCDF or NumPy file,
+    see result_writers.write_grid."""
+    from PyQt5.QtWidgets import QFileDialog
+    file_name = QFileDialog.getSaveFileName(filter="CSV Files (*.csv);;Parquet Files (*.parquet);;HDF5 Files (*.h5);;"
+                                                   "NetCDF Grids (*.nc);;NumPy Grids (*.npz);;All Files (*)")[0]
+    # technically a path object
+    if file_name == "":
+        return
+    if file_name.lower().endswith((".nc", ".npz")) and df_plot is not None:
+        result_writers.write_grid(file_name, df_plot)
+    else:
+        export_results(df_export, file_name)
 
 
 def spatial_window_menu():
@@ -49,111 +68,543 @@ def spatial_window_menu():
     return window_step, window_size, window_min_count
 
 
-def spatial_window(df, bin_size):
-    """Analyses b-values of spacial windows."""
-    window_step, window_size, window_min_count = spatial_window_menu()
-    plotted_data = []
-    exported_data = []
+def bootstrap_menu():
+    """Interactive handler for the number of bootstrap resamples, 0 for none."""
+    resamples = None
+    while type(resamples) is not int:
+        try:
+            resamples = input("Enter the number of bootstrap resamples for confidence intervals or leave the input "
+                              "blank for none: ")
+            resamples = int(resamples)
+        except ValueError:
+            if resamples == "":
+                resamples = 0
+    return resamples
+
+
+def completeness_menu():
+    """Interactive handler for the per window magnitude of completeness method, None for none."""
+    mc_method = None
+    while mc_method not in {"", *completeness.METHODS}:
+        mc_method = input("Enter maxc (maximum curvature), gft (goodness-of-fit) or mbs (b-value stability) to "
+                          "estimate the magnitude of completeness of each window, or leave the input blank for none: ")
+    return mc_method or None
+
+
+def _window_estimates(histograms, magnitude_levels, bin_size, resamples=0, mc_method=None, first_window=0,
+                      results=None, executor=None):
+    """Returns a Pandas DataFrame of the estimates of windows, the columns "B_lsr", "A_lsr", "B_ml", "A_ml" and
+    "Std_err_ml", from their histograms and magnitude levels, see statistical_analysis.b_value_histogram_batch, or as
+    given in results, e.g. by statistical_analysis.b_value_batch. Histograms are only needed without results or with
+    mc_method or resamples.
+    With an mc_method of completeness.METHODS, every window only uses events at or above its own magnitude of
+    completeness, given first as "Mc", followed by the number of events at or above it as "Mc_count", 0 for windows
+    without an estimate, whose other estimates are nan. With resamples, 95% bootstrap intervals of the estimates
+    follow, see bootstrap.bootstrap, where first_window is the index of the first window when windows are estimated in
+    chunks, or an array of the index of every window, and executor is that of bootstrap.pool shared by all chunks."""
+    columns = {}
+    if mc_method is not None:  # estimated for all windows at once from their histograms
+        mc = completeness.METHODS[mc_method](histograms, magnitude_levels)
+        histograms = completeness.above_completeness(histograms, magnitude_levels, mc)
+        columns["Mc"] = mc
+        columns["Mc_count"] = histograms.sum(axis=1)  # the events estimates are based on, unlike "Event_count"
+        results = None
+    if results is None:
+        results = statistical_analysis.b_value_histogram_batch(histograms, magnitude_levels, bin_size)
+    columns.update(zip(["B_lsr", "A_lsr", "B_ml", "A_ml", "Std_err_ml"], results))
+    df_estimates = pd.DataFrame(columns)
+    if resamples:
+        df_estimates = df_estimates.join(bootstrap.bootstrap(histograms, magnitude_levels, bin_size,
+                                                             resamples=resamples, first_window=first_window,
+                                                             executor=executor))
+    return df_estimates
+
+
+def _chunk_size(chunk_windows, magnitude_levels):
+    """Returns the number of windows to estimate at a time, at most chunk_windows and fewer with many magnitude
+    levels, e.g. of fine precision, so that the histograms of a chunk hold at most 2 ** 22 counts."""
+    return max(min(chunk_windows, 2 ** 22 // max(len(magnitude_levels), 1)), 1)
+
+
+def _collect(df_chunk, writer, chunks):
+    """Writes a chunk of exported data with a result_writers.ResultWriter, or keeps it in a list without one."""
+    if writer is not None:
+        writer.write(df_chunk)
+    else:
+        chunks.append(df_chunk)
+
+
+@instrumentation.instrumented
+def spatial_window_analysis(df, bin_size, window_size, window_step, window_min_count=500, resamples=0,
+                            mc_method=None, writer=None, chunk_windows=65536):
+    """Calculates b-values of square spatial windows of window_size km, anchored every window_step km along X and Y,
+    that hold at least window_min_count events. Returns a Pandas DataFrame for plot_b_value.graph_xy with a row for
+    every window, and a Pandas DataFrame of exported data with a row for every window with enough events.
+    With resamples, the exported data also has 95% bootstrap intervals of the estimates, see bootstrap.bootstrap.
+    With an mc_method of completeness.METHODS, every window only uses events at or above its own magnitude of
+    completeness, which is exported as "Mc" along with the number of events used, "Mc_count".
+    Windows are estimated chunk_windows at a time, fewer with many magnitude levels. With a
+    result_writers.ResultWriter, exported data is written chunk by chunk as it is computed and None is returned in its
+    place, so memory doesn't grow with the number of windows.
+    See tiled_analysis.tiled_window_analysis for the same windows computed tile by tile across worker processes."""
     x_array = np.arange(df["X"].min(), df["X"].max(), window_step)
     y_array = np.arange(df["Y"].min(), df["Y"].max(), window_step)
+    return anchored_window_analysis(df, bin_size, x_array, y_array, window_size, window_min_count, resamples,
+                                    mc_method, writer, chunk_windows)
+
+
+def anchored_window_analysis(df, bin_size, x_array, y_array, window_size, window_min_count=500, resamples=0,
+                             mc_method=None, writer=None, chunk_windows=65536, levels=None, window_numbers=None):
+    """Calculates the windows of spatial_window_analysis anchored at every combination of the sorted NumPy arrays of
+    anchors x_array and y_array, e.g. those of one tile of a larger grid, which only needs the events of the tile and
+    its windows. Optionally, the magnitude levels of the whole catalog, see spatial_index.SpatialIndex, and the index
+    of every window in the larger grid, which seeds its bootstrap resamples, make the results of a tile independent
+    of the tiling. Returns the same as spatial_window_analysis."""
     coordinates = np.array(list(itertools.product(x_array, y_array)))  # all bottom right window anchor positions
-    windows = [df[(df["X"].between(x, x + window_size)) &  # & instead of and is required
-                  (df["Y"].between(y, y + window_size))] for x, y in coordinates]
-    for i, window in enumerate(windows):
-        b_value_lsr, b_value_ml, event_count = None, None, None
-        if len(window) >= window_min_count:
-            event_count = len(window)  # some redundancy for proper heatmap display
-            # print("From", str(window["X"].min()), "to", str(window["X"].max()),
-            #      "in X and", str(window["Y"].min()), "to", str(window["Y"].max()), " in Y the b-value is: ")
-            b_value_lsr, a_value_lsr = statistical_analysis.b_value_least_squares_regression(window["Magnitude"]
-                                                                                             .to_numpy(), bin_size)
-            b_value_ml, a_value_ml, std_err_ml = statistical_analysis.b_value_maximum_likelihood(
-                window["Magnitude"].to_numpy())
-            exported_data.append((window["X"].min(), window["X"].max(), window["Y"].min(), window["Y"].max(),
-                                  window["Z"].min(), window["Z"].max(), event_count,
-                                  b_value_lsr, a_value_lsr, b_value_ml, a_value_ml, std_err_ml))
-            # print(b_value_lsr, "from least squares regression and", b_value_ml, "from maximum likelihood")
-        plotted_data.append((coordinates[i, 0] + 0.5 * window_size, coordinates[i, 1] + 0.5 * window_size,
-                             b_value_lsr, b_value_ml, event_count))
-    if not exported_data:  # the previous if statement was never executed, i.e. len(window) < window_min_count for all
+    x_edges, x_start, x_end = spatial_index.window_edges(x_array, window_size)
+    y_edges, y_start, y_end = spatial_index.window_edges(y_array, window_size)
+    x_start, x_end = np.repeat(x_start, len(y_array)), np.repeat(x_end, len(y_array))  # same order as coordinates
+    y_start, y_end = np.tile(y_start, len(x_array)), np.tile(y_end, len(x_array))
+    with instrumentation.stage("moving_window.spatial_index", len(df)):
+        index = spatial_index.SpatialIndex(df["X"].to_numpy(), df["Y"].to_numpy(), df["Magnitude"].to_numpy(),
+                                           x_edges, y_edges, df["Z"].to_numpy(), levels)
+    # every window is answered from summed-area tables instead of filtering the DataFrame once per window
+    event_counts = index.event_counts(x_start, x_end, y_start, y_end)
+    counted = np.flatnonzero(event_counts >= window_min_count)
+    plotted_data = np.full((len(coordinates), 3), np.nan)  # null values for windows without enough events
+    chunks = []
+    chunk_windows = _chunk_size(chunk_windows, index.levels)
+    with bootstrap.pool(resamples) as executor:  # worker processes are started once per analysis
+        for first in range(0, max(len(counted), 1), chunk_windows):
+            chunk = counted[first:first + chunk_windows]
+            windows = x_start[chunk], x_end[chunk], y_start[chunk], y_end[chunk]
+            with instrumentation.stage("moving_window.window_histograms", len(chunk)):
+                histograms = index.histograms(*windows)
+            with instrumentation.stage("moving_window.window_extents", len(chunk)):
+                extents = [*index.extents("X", *windows), *index.extents("Y", *windows), *index.extents("Z", *windows)]
+            df_chunk = pd.DataFrame(dict(zip(["X_min", "X_max", "Y_min", "Y_max", "Z_min", "Z_max", "Event_count"],
+                                             [*extents, event_counts[chunk]])))
+            first_window = first if window_numbers is None else window_numbers[chunk]
+            df_chunk = df_chunk.join(_window_estimates(histograms, index.levels, bin_size, resamples, mc_method,
+                                                       first_window, executor=executor))
+            plotted_data[chunk] = np.transpose([df_chunk["B_lsr"], df_chunk["B_ml"], event_counts[chunk]])
+            _collect(df_chunk, writer, chunks)
+    plotted_data = np.column_stack((coordinates + 0.5 * window_size, plotted_data))
+    df_plot = pd.DataFrame(plotted_data, columns=["Window_x", "Window_y", "B_lsr", "B_ml", "Event_count"])
+    return df_plot, None if writer is not None else pd.concat(chunks, ignore_index=True)
+
+
+@instrumentation.instrumented
+def adaptive_window_analysis(df, bin_size, target_count=2000, window_min_count=500, octree=False, max_depth=16,
+                             raster_depth=8, resamples=0, mc_method=None, writer=None):
+    """Calculates b-values of the cells of an adaptive_windows.AdaptiveSubdivision of the xy-plane, or of xyz space
+    with octree, split until no cell holds more than target_count events, for cells that hold at least
+    window_min_count events. Returns a Pandas DataFrame for plot_b_value.graph_xy of the cells spread over a uniform
+    grid, see AdaptiveSubdivision.raster, of at most raster_depth levels, along with the side of its cells, and a
+    multi-resolution Pandas DataFrame of exported data with a row for every cell with enough events, giving its level,
+    bounds and the extents of its events. Resamples, mc_method and writer are as for
+    spatial_window_analysis, cells are few enough to be estimated at once."""
+    columns = ["X", "Y", "Z"] if octree else ["X", "Y"]
+    with instrumentation.stage("moving_window.adaptive_subdivision", len(df)):
+        subdivision = adaptive_windows.AdaptiveSubdivision(df[columns].to_numpy(), target_count, max_depth)
+    magnitudes = df["Magnitude"].to_numpy()[subdivision.order]
+    event_counts = subdivision.counts()
+    counted = event_counts >= window_min_count
+    starts, ends = subdivision.offsets[:-1][counted], subdivision.offsets[1:][counted]
+    histograms, levels, results = None, None, None
+    if mc_method is not None or resamples:
+        histograms, levels = statistical_analysis.window_histograms(magnitudes, starts, ends)
+    if mc_method is None:  # leaves with enough events are concatenated, the others are never estimated
+        results = statistical_analysis.b_value_batch(magnitudes[np.repeat(counted, event_counts)],
+                                                     np.concatenate(([0], np.cumsum(event_counts[counted]))), bin_size)
+    df_estimates = _window_estimates(histograms, levels, bin_size, resamples, mc_method, results=results)
+
+    with instrumentation.stage("moving_window.window_extents", len(starts)):
+        lower, upper = subdivision.bounds()
+        bounds = {}
+        for axis, name in enumerate(columns):
+            bounds["Cell_" + name.lower() + "_min"] = lower[counted, axis]
+            bounds["Cell_" + name.lower() + "_max"] = upper[counted, axis]
+        extents = {}
+        for name in ["X", "Y", "Z"]:
+            values = df[name].to_numpy()[subdivision.order]
+            extents[name + "_min"] = np.minimum.reduceat(values, starts) if len(starts) else np.empty(0)
+            extents[name + "_max"] = np.maximum.reduceat(values, starts) if len(starts) else np.empty(0)
+    df_export = pd.DataFrame({"Level": subdivision.levels[counted], **bounds, **extents,
+                              "Event_count": event_counts[counted]}).join(df_estimates)
+    if writer is not None:
+        writer.write(df_export)
+        df_export = None
+
+    depth = min(int(subdivision.levels.max(initial=0)), raster_depth)
+    leaf_values = []
+    for column in ["B_lsr", "B_ml"]:
+        values = np.full(len(subdivision), np.nan)
+        values[counted] = df_estimates[column]
+        leaf_values.append(values)
+    grid_counts, (grid_lsr, grid_ml) = subdivision.raster(depth, leaf_values)
+    cell_size = subdivision.size / 2 ** depth
+    x, y = np.meshgrid(np.arange(2 ** depth), np.arange(2 ** depth), indexing="ij")
+    df_plot = pd.DataFrame({"Window_x": subdivision.origin[0] + (x.ravel() + 0.5) * cell_size,
+                            "Window_y": subdivision.origin[1] + (y.ravel() + 0.5) * cell_size,
+                            "B_lsr": grid_lsr.ravel(), "B_ml": grid_ml.ravel(),
+                            "Event_count": np.where(grid_counts.ravel() > 0, grid_counts.ravel(), np.nan)})
+    return df_plot, cell_size, df_export
+
+
+@instrumentation.instrumented
+def neighbour_window_analysis(df, bin_size, neighbours, window_step, max_radius=None, window_min_count=None,
+                              node_z=None, chunk_nodes=4096, resamples=0, mc_method=None, writer=None):
+    """Calculates b-values of the neighbours nearest events of grid nodes every window_step km along X and Y, the
+    constant event number windows of b-value maps, optionally only counting events within max_radius km of a node.
+    Nodes with fewer than window_min_count such events, by default neighbours, are left out.
+    Neighbours are found in the xy-plane, or in xyz space with nodes at Z = node_z, with one scipy cKDTree queried in
+    multi-threaded batches of chunk_nodes nodes, and their magnitudes go straight into the batch estimators.
+    Returns a Pandas DataFrame for plot_b_value.graph_xy with a row for every node, and a Pandas DataFrame of exported
+    data with a row for every node with enough events, giving its position and the radius of its window, i.e. the
+    distance to its farthest neighbour. Resamples, mc_method and writer are as for spatial_window_analysis, with nodes
+    estimated and written chunk by chunk."""
+    from scipy.spatial import cKDTree
+    window_min_count = neighbours if window_min_count is None else window_min_count
+    columns = ["X", "Y"] if node_z is None else ["X", "Y", "Z"]
+    x_array = np.arange(df["X"].min(), df["X"].max() + window_step, window_step)
+    y_array = np.arange(df["Y"].min(), df["Y"].max() + window_step, window_step)
+    nodes = np.array(list(itertools.product(x_array, y_array)))
+    if node_z is not None:
+        nodes = np.column_stack((nodes, np.full(len(nodes), node_z)))
+    with instrumentation.stage("moving_window.neighbour_tree", len(df)):
+        tree = cKDTree(df[columns].to_numpy())
+    magnitudes = statistical_analysis.float64_magnitudes(df["Magnitude"].to_numpy())
+    neighbours = min(neighbours, len(df))
+    upper_bound = np.inf if max_radius is None else max_radius
+
+    levels = np.unique(magnitudes)
+    level = np.searchsorted(levels, magnitudes)  # histogram column of every event
+    plotted_data = np.full((len(nodes), 3), np.nan)  # null values for nodes without enough events
+    chunks, first_window = [], 0
+    with bootstrap.pool(resamples) as executor:
+        for first in range(0, max(len(nodes), 1), chunk_nodes):
+            with instrumentation.stage("moving_window.neighbour_query", min(chunk_nodes, len(nodes) - first)):
+                distances, indices = tree.query(nodes[first:first + chunk_nodes], k=max(neighbours, 1),
+                                                distance_upper_bound=upper_bound, workers=-1)
+            distances, indices = distances.reshape(len(distances), -1), indices.reshape(len(indices), -1)
+            found = indices < len(df)  # missing neighbours beyond max_radius have the index len(df)
+            counts = found.sum(axis=1)
+            enough = counts >= max(window_min_count, 1)
+            found &= enough[:, None]
+            window_indices = indices[found]  # row by row, i.e. the events of every node with enough are contiguous
+            histograms, results = None, None
+            if mc_method is not None or resamples:
+                rows = np.repeat(np.arange(enough.sum()), counts[enough])
+                histograms = np.bincount(rows * len(levels) + level[window_indices],
+                                         minlength=enough.sum() * len(levels)).reshape(-1, len(levels))
+            if mc_method is None:
+                results = statistical_analysis.b_value_batch(
+                    magnitudes[window_indices], np.concatenate(([0], np.cumsum(counts[enough]))), bin_size)
+            chunk_nodes_found = first + np.flatnonzero(enough)
+            node_data = {"Node_" + name.lower(): nodes[chunk_nodes_found, axis] for axis, name in enumerate(columns)}
+            df_chunk = pd.DataFrame({**node_data, "Radius": np.max(np.where(found, distances, 0), axis=1)[enough],
+                                     "Event_count": counts[enough]})
+            df_chunk = df_chunk.join(_window_estimates(histograms, levels, bin_size, resamples, mc_method, first_window,
+                                                       results, executor))
+            plotted_data[chunk_nodes_found] = np.transpose([df_chunk["B_lsr"], df_chunk["B_ml"], counts[enough]])
+            first_window += len(df_chunk)
+            _collect(df_chunk, writer, chunks)
+    df_plot = pd.DataFrame(np.column_stack((nodes[:, :2], plotted_data)),
+                           columns=["Window_x", "Window_y", "B_lsr", "B_ml", "Event_count"])
+    return df_plot, None if writer is not None else pd.concat(chunks, ignore_index=True)
+
+
+def adaptive_window_menu():
+    """Interactive handler for adaptive spatial window settings."""
+    target_count = None
+    while type(target_count) is not int:
+        try:
+            target_count = int(input("Enter the number of events above which a window is split in smaller ones: "))
+        except ValueError:
+            pass
+    window_min_count = None
+    window_min_count_default = min(500, target_count)
+    while type(window_min_count) is not int:
+        try:
+            window_min_count = input("Enter the minimum number of events per window or leave the input blank "
+                                     "for the default " + str(window_min_count_default) + ": ")
+            window_min_count = int(window_min_count)
+        except ValueError:
+            if window_min_count == "":
+                window_min_count = window_min_count_default
+    octree = None
+    while octree not in {"y", "n"}:
+        octree = input("Enter y to also split windows along Z (octree), n for the xy-plane only (quadtree): ")
+    return target_count, window_min_count, octree == "y"
+
+
+def neighbour_window_menu():
+    """Interactive handler for nearest neighbour window settings."""
+    neighbours = None
+    while type(neighbours) is not int:
+        try:
+            neighbours = int(input("Enter the number of nearest events per window: "))
+        except ValueError:
+            pass
+    window_step = None
+    while type(window_step) is not float:
+        try:
+            window_step = float(input("Enter the spacing of the grid of window centres in km: "))
+        except ValueError:
+            pass
+    max_radius = None
+    while type(max_radius) is not float:
+        try:
+            max_radius = input("Enter the maximum radius of the windows in km or leave the input blank for none: ")
+            max_radius = float(max_radius)
+        except ValueError:
+            if max_radius == "":
+                max_radius = None
+                break
+    window_min_count = neighbours
+    if max_radius is not None:
+        window_min_count = None
+        while type(window_min_count) is not int:
+            try:
+                window_min_count = int(input("Enter the minimum number of events per window: "))
+            except ValueError:
+                pass
+    return neighbours, window_step, max_radius, window_min_count
+
+
+def spatial_window(df, bin_size):
+    """Analyses b-values of spacial windows."""
+    mode_window = None
+    while mode_window not in {"g", "a", "n"}:
+        mode_window = input("Enter g for a grid of square windows, a for adaptive windows split where events are "
+                            "dense, n for windows of the nearest events of grid nodes: ")
+    if mode_window == "n":
+        neighbours, window_step, max_radius, window_min_count = neighbour_window_menu()
+        df_plot, df_export = result_cache.cached(
+            neighbour_window_analysis, df, bin_size, neighbours=neighbours, window_step=window_step,
+            max_radius=max_radius, window_min_count=window_min_count, resamples=bootstrap_menu(),
+            mc_method=completeness_menu())
+    elif mode_window == "a":
+        target_count, window_min_count, octree = adaptive_window_menu()
+        df_plot, window_step, df_export = result_cache.cached(
+            adaptive_window_analysis, df, bin_size, target_count=target_count, window_min_count=window_min_count,
+            octree=octree, resamples=bootstrap_menu(), mc_method=completeness_menu())
+    else:
+        window_step, window_size, window_min_count = spatial_window_menu()
+        df_plot, df_export = result_cache.cached(
+            spatial_window_analysis, df, bin_size, window_size=window_size, window_step=window_step,
+            window_min_count=window_min_count, resamples=bootstrap_menu(), mc_method=completeness_menu())
+    # results are remembered, so repeating or narrowing an analysis of the same catalog doesn't recompute its windows
+    if df_export.empty:  # len(window) < window_min_count for all windows
         print("No window has the minimum number of events required, try again with different window settings")
         return
-    df_plot = pd.DataFrame(plotted_data, columns=["Window_x", "Window_y", "B_lsr", "B_ml", "Event_count"])
     plot_b_value.graph_xy(df_plot, df, window_step)
-    spatial_window_export(exported_data)
+    spatial_window_export(df_export, df_plot)
+
+
+@instrumentation.instrumented
+def spacetime_window_analysis(df, bin_size, window_size, window_step, time_window, time_step, window_min_count=500,
+                              resamples=0, mc_method=None, writer=None):
+    """Calculates maps of b-values of square spatial windows, as in spatial_window_analysis, of the events of time
+    intervals of time_window days starting every time_step days from the first event, e.g. to see a map change after
+    a large event. The window histograms are moved from one interval to the next, only adding and removing the events
+    entering and leaving it, see spacetime_index.SpaceTimeIndex.
+    Returns a dictionary of the map cube, with NumPy arrays "B_lsr", "B_ml" and "Event_count" of shape (intervals,
+    y windows, x windows), nan for windows without enough events, along with the interval starts "time" and ends
+    "time_end" and the window centres "x" and "y", as used by result_writers.write_cube and
+    plot_b_value.animate_maps, and a Pandas DataFrame of exported data with a row for every window of every interval
+    with enough events. Resamples, mc_method and writer are as for spatial_window_analysis, with a chunk per
+    interval, or several with many magnitude levels."""
+    x_array = np.arange(df["X"].min(), df["X"].max(), window_step)
+    y_array = np.arange(df["Y"].min(), df["Y"].max(), window_step)
+    x_edges, *x_windows = spatial_index.window_edges(x_array, window_size)
+    y_edges, *y_windows = spatial_index.window_edges(y_array, window_size)
+    times = time_conversion.nanoseconds(df["Time"])
+    with instrumentation.stage("moving_window.spacetime_index", len(df)):
+        index = spacetime_index.SpaceTimeIndex(df["X"].to_numpy(), df["Y"].to_numpy(), times,
+                                               df["Magnitude"].to_numpy(), x_edges, y_edges, x_windows, y_windows)
+    time_window = int(round(time_window * time_conversion.NANOSECONDS["day"]))  # days to nanoseconds
+    time_step = int(round(time_step * time_conversion.NANOSECONDS["day"]))
+    first_time, last_time = (times.min(), times.max()) if len(times) else (0, 0)
+    interval_starts = first_time + time_step * np.arange(max((last_time - first_time - time_window) // time_step, 0)
+                                                         + 1)
+    cube = {"time": time_conversion.to_datetime64(interval_starts),
+            "time_end": time_conversion.to_datetime64(interval_starts + time_window),
+            "x": x_array + 0.5 * window_size, "y": y_array + 0.5 * window_size}
+    for column in ["B_lsr", "B_ml", "Event_count"]:
+        cube[column] = np.full((len(interval_starts), len(y_array), len(x_array)), np.nan)
+    chunks, first_window = [], 0
+    with bootstrap.pool(resamples) as executor:
+        for interval, start in enumerate(interval_starts):
+            with instrumentation.stage("moving_window.spacetime_move"):
+                index.move(start, start + time_window)
+            event_counts = index.event_counts()  # windows in x-major order
+            counted = np.flatnonzero(event_counts >= window_min_count)
+            chunk_windows = _chunk_size(max(len(counted), 1), index.levels)
+            for first in range(0, max(len(counted), 1), chunk_windows):
+                chunk = counted[first:first + chunk_windows]
+                df_estimates = _window_estimates(index.histograms(chunk), index.levels, bin_size, resamples,
+                                                 mc_method, first_window, executor=executor)
+                first_window += len(chunk)
+                x_index, y_index = chunk // len(y_array), chunk % len(y_array)
+                for column, values in (("B_lsr", df_estimates["B_lsr"]), ("B_ml", df_estimates["B_ml"]),
+                                       ("Event_count", event_counts[chunk])):
+                    cube[column][interval, y_index, x_index] = values
+                df_chunk = pd.DataFrame({"Time_min": np.repeat(cube["time"][interval], len(chunk)),
+                                         "Time_max": np.repeat(cube["time_end"][interval], len(chunk)),
+                                         "Window_x": cube["x"][x_index], "Window_y": cube["y"][y_index],
+                                         "Event_count": event_counts[chunk]})
+                _collect(df_chunk.join(df_estimates), writer, chunks)
+    return cube, None if writer is not None else pd.concat(chunks, ignore_index=True)
 
 
-def temporal_window_export(exported_data):
+def spacetime_window_menu():
+    """Interactive handler for the time intervals of spatio-temporal windows, in days."""
+    time_window = None
+    while type(time_window) is not float:
+        try:
+            time_window = float(input("Enter the length of the time intervals in days: "))
+        except ValueError:
+            pass
+    time_step = None
+    while type(time_step) is not float:
+        try:
+            time_step = float(input("Enter the increment of consecutive time intervals in days: "))
+        except ValueError:
+            pass
+    return time_window, time_step
+
+
+def spacetime_window_export(df_export, cube):
+    """Exports data from spatio-temporal window analysis, or the map cube to a NetCDF or NumPy file, see
+    result_writers.write_cube."""
+    from PyQt5.QtWidgets import QFileDialog
+    file_name = QFileDialog.getSaveFileName(filter="NetCDF Cubes (*.nc);;NumPy Cubes (*.npz);;CSV Files (*.csv);;"
+                                                   "Parquet Files (*.parquet);;HDF5 Files (*.h5);;All Files (*)")[0]
+    # technically a path object
+    if file_name == "":
+        return
+    if file_name.lower().endswith((".nc", ".npz")):
+        result_writers.write_cube(file_name, cube)
+    else:
+        export_results(df_export, file_name)
+
+
+def spacetime_window(df, bin_size):
+    """Analyses b-value maps over sliding time intervals."""
+    window_step, window_size, window_min_count = spatial_window_menu()
+    time_window, time_step = spacetime_window_menu()
+    cube, df_export = spacetime_window_analysis(df, bin_size, window_size, window_step, time_window, time_step,
+                                                window_min_count, bootstrap_menu(), completeness_menu())
+    if df_export.empty:
+        print("No window has the minimum number of events required, try again with different window settings")
+        return
+    plot_b_value.animate_maps(cube)
+    spacetime_window_export(df_export, cube)
+
+
+def temporal_window_export(df_export):
     """Exports data from temporal moving window analysis."""
-    file_name = QFileDialog.getSaveFileName(filter="CSV Files (*.csv);;All Files (*)")[0]  # technically a path object
+    from PyQt5.QtWidgets import QFileDialog
+    file_name = QFileDialog.getSaveFileName(filter="CSV Files (*.csv);;Parquet Files (*.parquet);;HDF5 Files (*.h5);;"
+                                                   "All Files (*)")[0]  # technically a path object
     if file_name != "":
-        df_export = pd.DataFrame(exported_data, columns=["Time_min", "Time_max", "Event_count",
-                                                         "B_lsr", "A_lsr", "B_ml", "A_ml", "Std_err_ml"])
-        df_export.to_csv(file_name + ".csv", encoding="utf-8", index=False)
-
+        export_results(df_export, file_name)
 
-def temporal_window_menu(df):
-    """Interactive handler for temporal moving window settings."""
-    df = df.sort_values(by="Time")
 
+def temporal_window_menu():
+    """Interactive handler for temporal moving window settings. Returns the number of evenly split windows, or None
+    and the size and increment of sliding windows."""
     mode_window = None
-    windows = []
+    window_number, window_size, window_step = None, None, None
 
     while mode_window not in {"e", "s"}:
         mode_window = input("Enter e for evenly split windows, s for sliding windows: ")
 
     if mode_window == "e":
-        window_number = None
         while type(window_number) is not int:
             try:
                 window_number = int(input("Enter the number of windows: "))
             except ValueError:
                 pass
-        windows = np.array_split(df, window_number)
 
     elif mode_window == "s":
-        window_size = None
         while type(window_size) is not int:
             try:
                 window_size = int(input("Enter the size of the windows: "))
             except ValueError:
                 pass
-        window_step = None
         while type(window_step) is not int:
             try:
                 window_step = int(input("Enter the increment of consecutive windows: "))
             except ValueError:
                 pass
-        window_counter = 0
-        while window_counter + window_size <= len(df):  # append windows while there are still remaining ones
-            windows.append(df.iloc[window_counter:window_counter + window_size])
-            window_counter += window_step
-    return windows
+    return window_number, window_size, window_step
 
 
-def temporal_window(df, bin_size):
-    """Analyses b-values of temporal windows."""
-    windows = temporal_window_menu(df)
-    plotted_data = []
-    exported_data = []
-    for window in windows:
-        # print("From", str(window.iloc[0]["Time"]), "to", str(window.iloc[-1]["Time"]), "the b-value is: ")
-        min_time, max_time = window.iloc[0]["Time"], window.iloc[-1]["Time"]
-        b_value_lsr, a_value_lsr = statistical_analysis.b_value_least_squares_regression(window["Magnitude"]
-                                                                                         .to_numpy(), bin_size)
+@instrumentation.instrumented
+def temporal_window_analysis(df, bin_size, window_number=None, window_size=None, window_step=None, resamples=0,
+                             mc_method=None, writer=None, chunk_windows=65536):
+    """Calculates b-values of temporal windows, either window_number evenly split windows or sliding windows of
+    window_size events every window_step events. Returns a Pandas DataFrame for plot_b_value.scatter_plot_time and a
+    Pandas DataFrame of exported data, both with a row for every window.
+    With resamples, both also have 95% bootstrap intervals of the estimates, see bootstrap.bootstrap.
+    With an mc_method of completeness.METHODS, every window only uses events at or above its own magnitude of
+    completeness, which is exported as "Mc" along with the number of events used, "Mc_count". Chunk_windows and
+    writer are as for spatial_window_analysis."""
+    times, magnitudes = time_conversion.nanoseconds(df["Time"]), df["Magnitude"].to_numpy()
+    if np.any(times[1:] < times[:-1]):  # catalogs are usually in time order already, then nothing is copied
+        order = np.argsort(times, kind="stable")
+        times, magnitudes = times[order], magnitudes[order]
+    if window_number is not None:
+        window_sizes = np.full(window_number, len(df) // window_number)
+        window_sizes[:len(df) % window_number] += 1  # same split as np.array_split
+        offsets = np.concatenate(([0], np.cumsum(window_sizes)))
+        starts, ends = offsets[:-1], offsets[1:]
+    else:
+        starts = np.arange(0, len(df) - window_size + 1, window_step)
+        ends = starts + window_size
 
-        b_value_ml, a_value_ml, std_err_ml = statistical_analysis.b_value_maximum_likelihood(window["Magnitude"]
-                                                                                             .to_numpy())
+    seconds = np.concatenate(([0], np.cumsum((times - times[:1]) / time_conversion.NANOSECONDS["second"])))
+    mean_times = time_conversion.to_datetime64(times[:1] + np.rint((seconds[ends] - seconds[starts]) / (ends - starts)
+                                                                    * time_conversion.NANOSECONDS["second"]))
+    min_times, max_times = time_conversion.to_datetime64(times[starts]), time_conversion.to_datetime64(times[ends - 1])
+    levels = np.unique(statistical_analysis.float64_magnitudes(magnitudes))  # the same histogram columns for all chunks
+    plotted, chunks = [], []
+    with bootstrap.pool(resamples) as executor:
+        for first in range(0, max(len(starts), 1), chunk_windows):
+            chunk = slice(first, first + chunk_windows)
+            low, high = (starts[chunk][0], ends[chunk][-1]) if len(starts) else (0, 0)  # the events of the chunk
+            histograms, results = None, None
+            if mc_method is not None or resamples or window_number is None:
+                histograms, _ = statistical_analysis.window_histograms(magnitudes[low:high], starts[chunk] - low,
+                                                                       ends[chunk] - low, levels)
+                # overlapping sliding windows are differences of cumulative histograms, estimated all at once
+            if mc_method is None and window_number is not None:
+                chunk_offsets = offsets[first:first + chunk_windows + 1] - low
+                results = statistical_analysis.b_value_batch(magnitudes[low:high], chunk_offsets, bin_size)
+            df_chunk = pd.DataFrame({"Time_min": min_times[chunk], "Time_max": max_times[chunk],
+                                     "Event_count": ends[chunk] - starts[chunk]})
+            df_chunk = df_chunk.join(_window_estimates(histograms, levels, bin_size, resamples, mc_method, first,
+                                                       results, executor))
+            plotted.append(df_chunk.filter(["B_lsr", "B_ml", "B_lsr_low", "B_lsr_high", "B_ml_low", "B_ml_high"]))
+            _collect(df_chunk, writer, chunks)
 
-        plotted_data.append((window["Time"].mean(), b_value_lsr, b_value_ml, min_time, max_time))
-        exported_data.append((min_time, max_time, len(window),
-                              b_value_lsr, a_value_lsr, b_value_ml, a_value_ml, std_err_ml))
+    df_plot = pd.concat([pd.DataFrame({"Window": mean_times, "Min_time": min_times, "Max_time": max_times}),
+                         pd.concat(plotted, ignore_index=True)], axis=1)
+    df_plot = df_plot[["Window", "B_lsr", "B_ml", "Min_time", "Max_time", *df_plot.columns[5:]]]
+    return df_plot, None if writer is not None else pd.concat(chunks, ignore_index=True)
 
-        # print(b_value_lsr, "from least squares regression and", b_value_ml, "from maximum likelihood")
 
-    df_plot = pd.DataFrame(plotted_data, columns=["Window", "B_lsr", "B_ml", "Min_time", "Max_time"])
+def temporal_window(df, bin_size):
+    """Analyses b-values of temporal windows."""
+    window_number, window_size, window_step = temporal_window_menu()
+    df_plot, df_export = result_cache.cached(
+        temporal_window_analysis, df, bin_size, window_number=window_number, window_size=window_size,
+        window_step=window_step, resamples=bootstrap_menu(), mc_method=completeness_menu())
     plot_b_value.scatter_plot_time(df_plot)
-    temporal_window_export(exported_data)
+    temporal_window_export(df_export)
 
 
 def menu(df):
@@ -171,8 +622,9 @@ def menu(df):
     while True:
         try:
             i = None
-            while i not in {"s", "t"}:
-                i = input("Enter t for temporal variability, s for spatial variability along the xy-plane: ")
+            while i not in {"s", "t", "c"}:
+                i = input("Enter t for temporal variability, s for spatial variability along the xy-plane, c for "
+                          "spatial variability over sliding time intervals: ")
             if i == "t":
                 while True:
                     try:
@@ -187,19 +639,27 @@ def menu(df):
                     except KeyboardInterrupt:
                         print("\n")
                         break
+            elif i == "c":
+                while True:
+                    try:
+                        spacetime_window(df, bin_size)
+                    except KeyboardInterrupt:
+                        print("\n")
+                        break
         except KeyboardInterrupt:
             print("\n")
             break
 
 
-def plot_regression(df):
+def plot_regression(df, file_name=None):
     """Plots the least squares regression and maximum likelihood of b and a values for the entire data set"""
     b_value_lsr, a_value_lsr = statistical_analysis.b_value_least_squares_regression(df["Magnitude"].to_numpy())
     b_value_ml, a_value_ml, std_err_ml = statistical_analysis.b_value_maximum_likelihood(df["Magnitude"].to_numpy())
-    plot_b_value.line_plot_regression(df, b_value_lsr, a_value_lsr, b_value_ml, a_value_ml)
+    plot_b_value.line_plot_regression(df, b_value_lsr, a_value_lsr, b_value_ml, a_value_ml, file_name)
 
 
 def main():
+    from PyQt5.QtWidgets import QApplication, QFileDialog
     app = QApplication(sys.argv)  # just to keep QApplication in memory, a gui event loop with exec_() isn't needed
     print("Enter CTRL+C to go back to a previous menu at any input prompt")
     while True:
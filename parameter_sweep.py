@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+
+import concurrent.futures
+import itertools
+from multiprocessing import shared_memory
+
+import numpy as np
+import pandas as pd
+
+import moving_window
+
+_catalog = {}  # the worker's view of the shared catalog, set up once per process by _attach
+
+
+def _share(df, columns):
+    """Copies the given columns of a DataFrame into shared memory blocks, once. Times are shared as int64 nanoseconds.
+    Returns the blocks and a description of each column that workers use to attach to them."""
+    blocks, description = [], {}
+    for column in columns:
+        values = df[column].to_numpy()
+        if np.issubdtype(values.dtype, np.datetime64):
+            values = values.astype("datetime64[ns]")
+        block = shared_memory.SharedMemory(create=True, size=max(values.nbytes, 1))
+        np.ndarray(values.shape, dtype=values.dtype, buffer=block.buf)[:] = values
+        blocks.append(block)
+        description[column] = block.name, values.shape, values.dtype.str
+    return blocks, description
+
+
+def _attach(description):
+    """Worker initializer building a DataFrame of zero-copy views into the shared memory blocks."""
+    blocks, columns = [], {}
+    for column, (name, shape, dtype) in description.items():
+        block = shared_memory.SharedMemory(name=name)
+        blocks.append(block)  # the blocks must outlive the views
+        columns[column] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf)
+    _catalog["blocks"] = blocks
+    _catalog["df"] = pd.DataFrame(columns, copy=False)
+
+
+def _analyse(analysis, parameters):
+    """Runs one combination of parameters on the shared catalog and returns its exported data."""
+    parameters = dict(parameters)
+    bin_size = parameters.pop("bin_size", 0.2)
+    if analysis == "spatial":
+        df_export = moving_window.spatial_window_analysis(_catalog["df"], bin_size, **parameters)[1]
+    else:
+        df_export = moving_window.temporal_window_analysis(_catalog["df"], bin_size, **parameters)[1]
+    return df_export
+
+
+def sweep(df, grid, analysis="spatial", processes=None):
+    """Runs moving_window.spatial_window_analysis or temporal_window_analysis for every combination of a parameter
+    grid across a pool of worker processes. Expected input is a Pandas DataFrame of a processed catalog, a dictionary
+    of parameter names (bin_size and the keyword arguments of the analysis) to lists of values, "spatial" or
+    "temporal", and optionally the number of processes, all available cores by default.
+    The catalog columns are placed in shared memory once instead of being pickled to every worker.
+    Returns one Pandas DataFrame of the exported data of all combinations, with a leading column per parameter."""
+    columns = ["X", "Y", "Z", "Magnitude"] if analysis == "spatial" else ["Time", "Magnitude"]
+    combinations = [dict(zip(grid, values)) for values in itertools.product(*grid.values())]
+    blocks, description = _share(df, columns)
+    try:
+        with concurrent.futures.ProcessPoolExecutor(processes, initializer=_attach,
+                                                    initargs=(description,)) as executor:
+            exports = list(executor.map(_analyse, itertools.repeat(analysis), combinations))
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
+    results = [df_export.assign(**parameters)[list(parameters) + list(df_export.columns)]
+               for parameters, df_export in zip(combinations, exports)]
+    return pd.concat(results, ignore_index=True)
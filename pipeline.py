@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+
+import argparse
+import functools
+import json
+
+import catalog_cache
+import completeness
+import declustering
+import instrumentation
+import moving_window
+import process_input
+import region_filter
+import result_writers
+import tiled_analysis
+
+DEFAULT_CONFIG = {
+    "file_name": None,
+    "mode": "u",
+    "magnitude_of_completeness": None,
+    "bounds": {},
+    "region": None,
+    "decluster": None,
+    "bin_size": 0.2,
+    "spatial": None,
+    "temporal": None,
+    "adaptive": None,
+    "neighbours": None,
+    "spacetime": None,
+    "tiles": None,
+    "output": "results",
+    "format": "csv",
+    "grid": None,
+    "figures": False,
+    "figure_format": "png",
+    "cache_dir": catalog_cache.DEFAULT_CACHE_DIR,
+    "chunk_size": None,
+    "trace": None,
+}
+# spatial takes the keys window_size, window_step and optionally window_min_count, resamples and mc_method of
+# moving_window.spatial_window_analysis, temporal takes either window_number or window_size and window_step and
+# optionally resamples and mc_method of moving_window.temporal_window_analysis, adaptive and neighbours take the
+# keyword arguments of moving_window.adaptive_window_analysis and moving_window.neighbour_window_analysis, spacetime
+# those of moving_window.spacetime_window_analysis, with time intervals in days, bounds maps column names to
+# [minimum, maximum] pairs, region is a filter of region_filter or the name of a JSON file of one, applied along with
+# bounds, decluster is a method of declustering.METHODS or a dictionary of a "method" and its keyword arguments,
+# keeping only independent events and mainshocks of the filtered catalog, and a cache_dir of None disables the
+# processed catalog cache, while a chunk_size streams the file through process_input.load_chunked, and a trace file
+# name turns on instrumentation, see run, tiles takes the keys tile_size, backend and workers of
+# tiled_analysis.tiled_window_analysis, which then runs the spatial windows tile by tile across worker processes
+
+
+def process(config):
+    """Loads and filters the catalog of a configuration, see run."""
+    if config["chunk_size"] is not None:
+        df = process_input.load_chunked(config["file_name"], config["mode"], config["magnitude_of_completeness"],
+                                        config["bounds"], config["chunk_size"], config["region"])
+    else:
+        df = process_input.load(config["file_name"], config["mode"], None)
+        region = region_filter.from_bounds(config["bounds"])
+        if config["magnitude_of_completeness"] is not None:
+            region = region_filter.all_of(region, region_filter.magnitude_range(config["magnitude_of_completeness"]))
+        if config["region"] is not None:
+            region = region_filter.all_of(region, config["region"])
+        df = region_filter.apply(df, region)  # a single pass and copy for all filters
+    if config["decluster"] is not None:
+        parameters = {"method": config["decluster"]} if isinstance(config["decluster"], str) else config["decluster"]
+        df = declustering.decluster(df, **parameters)
+    return df
+
+
+def run(config):
+    """Runs the whole analysis without any prompts or windows: processing, spatial, adaptive, nearest neighbour,
+    spatio-temporal and/or temporal windows and export to files named after config["output"] in the format of
+    config["format"], see result_writers.FORMATS. Expected input is a dictionary with the keys of DEFAULT_CONFIG,
+    missing keys take their default values. With config["grid"], "nc" or "npz", spatial maps and spatio-temporal
+    cubes are also exported as gridded arrays, and figures of spatio-temporal windows are gif animations.
+    Returns a dictionary of the number of exported windows of each analysis.
+    With a trace file name, the stages of the run are timed and written to it as a Chrome trace, and a summary table is
+    printed at the end, see instrumentation."""
+    config = {**DEFAULT_CONFIG, **config}
+    if isinstance(config["region"], str):
+        config["region"] = region_filter.load(config["region"])  # cached by its content, not its file name
+    if config["trace"] is not None:
+        instrumentation.reset()
+        instrumentation.enable()
+        try:
+            return run({**config, "trace": None})
+        finally:
+            instrumentation.disable()
+            instrumentation.write_trace(config["trace"])
+            instrumentation.print_summary()
+    if config["figures"]:
+        import matplotlib
+        matplotlib.use("Agg")  # figures are only saved to file, no display is needed
+    figure_name = lambda name: config["output"] + "_" + name + "." + config["figure_format"]
+
+    if config["cache_dir"] is None:
+        df = process(config)
+    else:
+        settings = {key: config[key] for key in ["mode", "magnitude_of_completeness", "bounds", "region",
+                                                 "decluster", "chunk_size"]}
+        df = catalog_cache.cached(config["file_name"], settings, lambda: process(config), config["cache_dir"])
+    if config["figures"]:
+        moving_window.plot_regression(df, figure_name("regression"))
+
+    analyses = {"spatial": moving_window.spatial_window_analysis, "adaptive": moving_window.adaptive_window_analysis,
+                "neighbours": moving_window.neighbour_window_analysis,
+                "spacetime": moving_window.spacetime_window_analysis,
+                "temporal": moving_window.temporal_window_analysis}
+    if config["tiles"] is not None:  # the same windows, computed in tiles with halos by a pool of workers
+        analyses["spatial"] = functools.partial(tiled_analysis.tiled_window_analysis, **config["tiles"])
+    results = {}
+    for name, analysis in analyses.items():
+        if config[name] is None:
+            continue
+        with result_writers.writer(config["output"] + "_" + name + "." + config["format"]) as writer:
+            plotted = analysis(df, config["bin_size"], **config[name], writer=writer)
+        # windows are written as they are computed, so an interrupted run keeps those done so far
+        results[name] = writer.rows
+        df_plot = plotted[0]
+        if name == "spacetime":  # a stack of maps, exported as a cube and animated
+            if config["grid"] is not None:
+                result_writers.write_cube(config["output"] + "_" + name + "." + config["grid"], df_plot)
+            if config["figures"] and writer.rows:
+                moving_window.plot_b_value.animate_maps(df_plot, file_name=config["output"] + "_" + name + ".gif")
+            continue
+        if name == "temporal":
+            if config["figures"]:
+                moving_window.plot_b_value.scatter_plot_time(df_plot, figure_name(name))
+            continue
+        if config["grid"] is not None:
+            result_writers.write_grid(config["output"] + "_" + name + "." + config["grid"], df_plot)
+        if config["figures"] and writer.rows:
+            window_interval = plotted[1] if name == "adaptive" else config[name]["window_step"]
+            moving_window.plot_b_value.graph_xy(df_plot, df, window_interval, figure_name(name))
+    return results
+
+
+def parse_arguments(arguments=None):
+    """Builds a configuration for run from command line arguments, which override those of an optional JSON config
+    file."""
+    parser = argparse.ArgumentParser(description="Headless b-value analysis of an earthquake catalog.")
+    parser.add_argument("file_name", nargs="?", help="csv catalog, see process_input.process")
+    parser.add_argument("--config", help="JSON file with the keys of pipeline.DEFAULT_CONFIG")
+    parser.add_argument("--mode", choices=["u", "e"], help="u for UTM, e for Earth centred coordinates")
+    parser.add_argument("--moc", type=float, dest="magnitude_of_completeness",
+                        help="magnitude of completeness, events below it are removed")
+    parser.add_argument("--region", help="JSON file of a region filter, see region_filter.py")
+    parser.add_argument("--decluster", choices=sorted(declustering.METHODS),
+                        help="keep only independent events and mainshocks, see declustering.py")
+    parser.add_argument("--bin-size", type=float, dest="bin_size", help="bin size for least squares regression")
+    parser.add_argument("--spatial", type=float, nargs=2, metavar=("SIZE", "STEP"),
+                        help="size and increment of square spatial windows in km")
+    parser.add_argument("--adaptive", type=int, metavar="COUNT",
+                        help="adaptive spatial windows, split while they hold more than this many events")
+    parser.add_argument("--octree", action="store_true", help="also split adaptive windows along Z")
+    parser.add_argument("--neighbours", type=float, nargs=2, metavar=("COUNT", "STEP"),
+                        help="windows of the nearest events of grid nodes every STEP km")
+    parser.add_argument("--max-radius", type=float, help="maximum radius of nearest neighbour windows in km")
+    parser.add_argument("--node-z", type=float, help="find nearest neighbours in 3D, with grid nodes at this Z")
+    parser.add_argument("--spacetime", type=float, nargs=4, metavar=("SIZE", "STEP", "DAYS", "STEP_DAYS"),
+                        help="maps of square spatial windows over time intervals of DAYS every STEP_DAYS days")
+    parser.add_argument("--tiles", type=float, metavar="SIZE",
+                        help="compute spatial windows in tiles of about SIZE km, see tiled_analysis.py")
+    parser.add_argument("--backend", choices=sorted(tiled_analysis.BACKENDS), help="executor of tiles, process by "
+                        "default")
+    parser.add_argument("--workers", type=int, help="number of worker processes of tiles, all cores by default")
+    parser.add_argument("--min-count", type=int, help="minimum number of events per spatial, adaptive, nearest "
+                        "neighbour or spatio-temporal window")
+    parser.add_argument("--temporal-windows", type=int, metavar="NUMBER", help="number of evenly split windows")
+    parser.add_argument("--temporal-sliding", type=int, nargs=2, metavar=("SIZE", "STEP"),
+                        help="size and increment of sliding temporal windows in events")
+    parser.add_argument("--resamples", type=int, help="bootstrap resamples for confidence intervals of each window")
+    parser.add_argument("--mc-method", choices=sorted(completeness.METHODS),
+                        help="estimate the magnitude of completeness of each window, see completeness.py")
+    parser.add_argument("--output", help="prefix of the exported files")
+    parser.add_argument("--format", choices=[extension[1:] for extension in result_writers.FORMATS],
+                        help="file format of the exported windows, csv by default")
+    parser.add_argument("--grid", choices=["nc", "npz"], help="also export spatial maps, and spatio-temporal cubes, "
+                        "as gridded arrays")
+    parser.add_argument("--figures", action="store_true", default=None, help="also save figures, see --figure-format")
+    parser.add_argument("--figure-format", choices=["png", "svg", "pdf"], help="file format of saved figures")
+    parser.add_argument("--chunk-size", type=int, help="read the catalog in chunks of this many rows")
+    parser.add_argument("--trace", help="write a Chrome trace of the run's stages to this JSON file")
+    parser.add_argument("--no-cache", action="store_true", help="always reprocess the catalog, see catalog_cache")
+    arguments = parser.parse_args(arguments)
+
+    config = {}
+    if arguments.config is not None:
+        with open(arguments.config) as config_file:
+            config = json.load(config_file)
+    for key in ["file_name", "mode", "magnitude_of_completeness", "region", "decluster", "bin_size", "output", "format",
+                "grid", "figures", "figure_format", "chunk_size", "trace"]:
+        if getattr(arguments, key) is not None:
+            config[key] = getattr(arguments, key)
+    if arguments.no_cache:
+        config["cache_dir"] = None
+    if arguments.spatial is not None:
+        config["spatial"] = {"window_size": arguments.spatial[0], "window_step": arguments.spatial[1]}
+    if arguments.adaptive is not None:
+        config["adaptive"] = {"target_count": arguments.adaptive, "octree": arguments.octree}
+    if arguments.neighbours is not None:
+        config["neighbours"] = {"neighbours": int(arguments.neighbours[0]), "window_step": arguments.neighbours[1],
+                                "max_radius": arguments.max_radius, "node_z": arguments.node_z}
+    if arguments.spacetime is not None:
+        config["spacetime"] = dict(zip(["window_size", "window_step", "time_window", "time_step"], arguments.spacetime))
+    if arguments.tiles is not None:
+        config["tiles"] = {"tile_size": arguments.tiles}
+        for key in ["backend", "workers"]:
+            if getattr(arguments, key) is not None:
+                config["tiles"][key] = getattr(arguments, key)
+    if arguments.min_count is not None:
+        analyses = [analysis for analysis in ["spatial", "adaptive", "neighbours", "spacetime"]
+                    if config.get(analysis) is not None]
+        if not analyses:
+            parser.error("--min-count requires a window analysis")
+        for analysis in analyses:
+            config[analysis]["window_min_count"] = arguments.min_count
+    if arguments.temporal_windows is not None:
+        config["temporal"] = {"window_number": arguments.temporal_windows}
+    elif arguments.temporal_sliding is not None:
+        config["temporal"] = {"window_size": arguments.temporal_sliding[0],
+                              "window_step": arguments.temporal_sliding[1]}
+    for key in ["resamples", "mc_method"]:
+        if getattr(arguments, key) is not None:
+            analyses = [analysis for analysis in ["spatial", "adaptive", "neighbours", "spacetime", "temporal"]
+                        if config.get(analysis) is not None]
+            if not analyses:
+                parser.error("--" + key.replace("_", "-") + " requires a window analysis")
+            for analysis in analyses:
+                config[analysis][key] = getattr(arguments, key)
+    if config.get("file_name") is None:
+        parser.error("a catalog file is required, either as an argument or in the config file")
+    return config
+
+
+def main():
+    for name, rows in run(parse_arguments()).items():
+        print(name.capitalize(), "windows:", rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,58 +1,122 @@
 #!/usr/bin/env python3
 
-import seaborn as sns
-import matplotlib.pyplot as plt
 import numpy as np
 
+import instrumentation
 
-def graph_xy(df, all_data, window_interval):
-    """Displays a bar graph of b-values against their respective xy windows. Expected input is a Pandas DataFrame
+
+def _show(file_name):
+    """Shows the current figure, or saves it to file_name and closes it when given, e.g. for batch runs."""
+    import matplotlib.pyplot as plt
+    if file_name is None:
+        plt.show()
+    else:
+        plt.savefig(file_name)
+        plt.close()
+
+
+def window_grid(df, window_interval, columns):
+    """Returns 2D NumPy arrays, indexed [y, x], of the values of windows on a regular grid, nan where there is no
+    window, and the (left, right, bottom, top) extent of the grid. Expected input is a Pandas DataFrame with columns
+    "Window_x", "Window_y", denoting middle x and y coordinates, and the given columns, the scalar spacing of window
+    centres and a list of column names. Windows are placed by their index along each axis, without pivot tables."""
+    x, y = df["Window_x"].to_numpy(dtype=float), df["Window_y"].to_numpy(dtype=float)
+    x_index = np.rint((x - x.min()) / window_interval).astype(int)
+    y_index = np.rint((y - y.min()) / window_interval).astype(int)
+    grids = []
+    for column in columns:
+        grid = np.full((y_index.max() + 1, x_index.max() + 1), np.nan)
+        grid[y_index, x_index] = df[column].to_numpy(dtype=float)
+        grids.append(grid)
+    extent = (x.min() - 0.5 * window_interval, x.min() + (x_index.max() + 0.5) * window_interval,
+              y.min() - 0.5 * window_interval, y.min() + (y_index.max() + 0.5) * window_interval)
+    return grids, extent
+
+
+@instrumentation.instrumented
+def graph_xy(df, all_data, window_interval, file_name=None, density_bins=1024):
+    """Displays maps of b-values against their respective xy windows. Expected input is a Pandas DataFrame
         with columns "Window_x", "Window_y", "B_lsr", "B_ml", "Event_count", denoting middle x and y coordinates,
         b-value of least squares regression, b-value of maximum likelihood, and events per window respectively.
         Additionally, a Pandas dataframe containing the entire dataset with columns "X" and "Y" and a scalar denoting
         window interval, assuming square windows.
+        Maps are drawn as images and all events as a 2D histogram of at most density_bins cells along each axis, so
+        the cost barely grows with the number of windows or events. With a file_name the figure is saved instead, in
+        the format of its extension, e.g. png or svg, which needs no display with a non-interactive backend.
     """
-    fig, axes = plt.subplots(ncols=4, nrows=2, gridspec_kw={"width_ratios": [15, 1, 15, 1]})  # columns for colour bars
+    import matplotlib.pyplot as plt
+    from matplotlib.colors import LogNorm
+    fig, axes = plt.subplots(ncols=4, nrows=2, figsize=(12, 8), gridspec_kw={"width_ratios": [15, 1, 15, 1]})
+    # columns for colour bars
     fig.suptitle("B-values of Windows")
     axes[0, 0].set_title("B-value from Least Squares Regression")
     axes[0, 2].set_title("B-value from Maximum Likelihood")
     axes[1, 0].set_title("Event Count")
     axes[1, 2].set_title("All Events")
-    axes[1, 3].remove()  # redundant axe since the scatter plot doesn't have a colour bar
-    df = df.astype({"Window_x": int, "Window_y": int})  # converting to integers for neater display
-    df_lsr = df[["Window_x", "Window_y", "B_lsr"]].reset_index().pivot(
-        index="Window_y", columns="Window_x", values="B_lsr").sort_index(ascending=False)
-    # converting to wide-spread form for LSR visualisation
-    # sorting by descending order to make heatmap coordinates match geographical coordinates
-    df_ml = df[["Window_x", "Window_y", "B_ml"]].reset_index().pivot(
-        index="Window_y", columns="Window_x", values="B_ml").sort_index(ascending=False)
-    df_count = df[["Window_x", "Window_y", "Event_count"]].reset_index().pivot(
-        index="Window_y", columns="Window_x", values="Event_count").sort_index(ascending=False)
-
-    sns.heatmap(df_lsr, cmap="viridis", square=True, ax=axes[0, 0], cbar_ax=axes[0, 1])
-    sns.heatmap(df_ml, cmap="viridis", square=True, ax=axes[0, 2], cbar_ax=axes[0, 3])
-    sns.heatmap(df_count, cmap="viridis", square=True, ax=axes[1, 0], cbar_ax=axes[1, 1])
-    # default behaviour of not colouring in null values is good
-    axes[1, 2].scatter(all_data["X"], all_data["Y"], s=1)  # scatter plot of all data points
-    axes[1, 2].set_xlim(df["Window_x"].min() - 0.5 * window_interval, df["Window_x"].max() + 0.5 * window_interval)
-    axes[1, 2].set_ylim(df["Window_y"].min() - 0.5 * window_interval, df["Window_y"].max() + 0.5 * window_interval)
-    # cannot just copy lims of other axes, heatmaps are discrete and use window numbers as indices internally
-    # more accurate to window heatmaps than just taking min and max of all_data
-    axes[1, 2].set_aspect(axes[0, 0].get_aspect())
-    # match display of other three axes
-    axes[0, 0].set(xlabel="X (km)", ylabel="Y (km)")
-    axes[0, 2].set(xlabel="X (km)", ylabel="Y (km)")
-    axes[1, 0].set(xlabel="X (km)", ylabel="Y (km)")
-    axes[1, 2].set(xlabel="X (km)", ylabel="Y (km)")
-    plt.tight_layout()  # padding so that all text fits on default window, mostly
-    plt.show()
-
-
-def scatter_plot_time(df):
+    (grid_lsr, grid_ml, grid_count), extent = window_grid(df, window_interval, ["B_lsr", "B_ml", "Event_count"])
+    for axe, colour_bar_axe, grid in ((axes[0, 0], axes[0, 1], grid_lsr), (axes[0, 2], axes[0, 3], grid_ml),
+                                      (axes[1, 0], axes[1, 1], grid_count)):
+        image = axe.imshow(grid, cmap="viridis", origin="lower", extent=extent, interpolation="nearest")
+        fig.colorbar(image, cax=colour_bar_axe)
+    # null values are transparent, as windows without enough events were left blank before
+
+    bins = min(density_bins, max(int(np.ceil(4 * (extent[1] - extent[0]) / window_interval)), 1)), \
+        min(density_bins, max(int(np.ceil(4 * (extent[3] - extent[2]) / window_interval)), 1))
+    density = np.histogram2d(all_data["Y"].to_numpy(), all_data["X"].to_numpy(), bins=bins[::-1],
+                             range=[extent[2:], extent[:2]])[0]  # indexed [y, x] like the maps
+    image = axes[1, 2].imshow(np.ma.masked_equal(density, 0), cmap="viridis", origin="lower", extent=extent,
+                              interpolation="nearest", norm=LogNorm())
+    fig.colorbar(image, cax=axes[1, 3], label="Events")
+    for axe in (axes[0, 0], axes[0, 2], axes[1, 0], axes[1, 2]):
+        axe.set(xlabel="X (km)", ylabel="Y (km)")
+    fig.subplots_adjust(left=0.07, right=0.95, bottom=0.07, top=0.9, wspace=0.4, hspace=0.3)
+    # fixed padding so that all text fits, tight_layout would draw the whole figure once more to measure it
+    _show(file_name)
+
+
+@instrumentation.instrumented
+def animate_maps(cube, column="B_ml", file_name=None, interval=500):
+    """Displays an animation of a map over time intervals, one frame per interval. Expected input is a dictionary as
+    returned by moving_window.spacetime_window_analysis, with 3D NumPy arrays indexed [time, y, x], interval starts
+    "time" and ends "time_end" and window centres "x" and "y", the name of the map to animate and the delay between
+    frames in milliseconds. Colour limits are fixed over all frames so that they can be compared.
+    With a file_name the animation is saved instead, as a gif with Pillow for a .gif extension, or with the writer
+    matplotlib picks for others, e.g. ffmpeg for mp4."""
+    import matplotlib.pyplot as plt
+    from matplotlib.animation import FuncAnimation
+    maps = cube[column]
+    x, y = cube["x"], cube["y"]
+    step = x[1] - x[0] if len(x) > 1 else y[1] - y[0] if len(y) > 1 else 1
+    extent = (x[0] - 0.5 * step, x[-1] + 0.5 * step, y[0] - 0.5 * step, y[-1] + 0.5 * step) if len(x) and len(y) \
+        else None
+    limits = (np.nanmin(maps), np.nanmax(maps)) if np.isfinite(maps).any() else (0, 1)
+    fig, axe = plt.subplots()
+    axe.set(xlabel="X (km)", ylabel="Y (km)")
+    image = axe.imshow(maps[0] if len(maps) else np.full((len(y), len(x)), np.nan), cmap="viridis", origin="lower",
+                       extent=extent, interpolation="nearest", vmin=limits[0], vmax=limits[1])
+    fig.colorbar(image, ax=axe, label=column)
+
+    def frame(i):
+        image.set_data(maps[i])
+        axe.set_title(f"{column} from {str(cube['time'][i])[:19]} to {str(cube['time_end'][i])[:19]}")
+        return image,
+
+    animation = FuncAnimation(fig, frame, frames=len(maps), interval=interval, repeat=file_name is None)
+    if file_name is None:
+        plt.show()
+    else:
+        animation.save(file_name, writer="pillow" if file_name.lower().endswith(".gif") else None)
+        plt.close(fig)
+    return animation
+
+
+@instrumentation.instrumented
+def scatter_plot_time(df, file_name=None):
     """Displays a scatter plot of b-values against their respective time windows. Expected input is a Pandas
     DataFrame with columns "Window", "B_lsr", "B_ml", "Min_time", "Max_time", denoting average event time,
     b-value of least squares regression, b-value of maximum likelihood, minimum and maximum event times of the window
-    respectively. """
+    respectively, and optionally "B_lsr_low", "B_lsr_high", "B_ml_low", "B_ml_high" for confidence intervals. """
+    import matplotlib.pyplot as plt
     plt.title("B-values Across Time Windows")
     plt.xlabel("Time Window")
     plt.ylabel("B-value")
@@ -60,17 +124,24 @@ def scatter_plot_time(df):
 
     error_bar = [df.Window - df.Min_time,
                  df.Max_time - df.Window]
-    plt.errorbar(df.Window, df.B_lsr, xerr=error_bar, fmt="o", c="red", label="Least Squares Regression")
-    plt.errorbar(df.Window, df.B_ml, xerr=error_bar, fmt="o", c="blue", label="Maximum Likelihood")
+    for estimate, colour, label in (("B_lsr", "red", "Least Squares Regression"),
+                                    ("B_ml", "blue", "Maximum Likelihood")):
+        y_error_bar = None
+        if estimate + "_low" in df:  # confidence intervals, clipped as percentiles may not contain the estimate
+            y_error_bar = [np.maximum(df[estimate] - df[estimate + "_low"], 0),
+                           np.maximum(df[estimate + "_high"] - df[estimate], 0)]
+        plt.errorbar(df.Window, df[estimate], xerr=error_bar, yerr=y_error_bar, fmt="o", c=colour, label=label)
 
     plt.legend()
     plt.tight_layout()  # padding so that all text fits on default window
-    plt.show()
+    _show(file_name)
 
 
-def line_plot_regression(df, b_value_lsr, a_value_lsr, b_value_mlk, a_value_mlk):
+@instrumentation.instrumented
+def line_plot_regression(df, b_value_lsr, a_value_lsr, b_value_mlk, a_value_mlk, file_name=None):
     """Displays the line plot for b-value calculations. Expected input is a Pandas DataFrame with a "Magnitude"
     column and appropriately named scalars"""
+    import matplotlib.pyplot as plt
     df = df.sort_values(by="Magnitude", ascending=False, ignore_index=True)
 
     plt.xlabel("Magnitude")
@@ -87,4 +158,4 @@ def line_plot_regression(df, b_value_lsr, a_value_lsr, b_value_mlk, a_value_mlk)
     plt.plot(x, y, label="Maximum Likelihood")
 
     plt.legend(loc="upper right")
-    plt.show()
+    _show(file_name)
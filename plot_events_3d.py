@@ -5,9 +5,19 @@ import sys
 import matplotlib.pyplot as plt
 import numpy as np
 import pyqtgraph.opengl as gl  # opengl needs to be installed (as pyopengl) manually
-from PyQt5.QtWidgets import QApplication, QFileDialog
+from PyQt5.QtCore import Qt, QTimer
+from PyQt5.QtWidgets import QApplication, QFileDialog, QHBoxLayout, QLabel, QPushButton, QSlider, QVBoxLayout, QWidget
 
+import event_octree
 import process_input
+import time_conversion
+
+LOD_THRESHOLD = 200000  # catalogs with more events are drawn through an event_octree.EventOctree
+CAMERA_INTERVAL = 100  # milliseconds between checks of the camera for level-of-detail updates
+EARTH_MESH_DETAIL = ((4, 30, 60), (2, 90, 180), (0, 180, 360))
+# (camera distance from the centre of the Earth in Earth radii, rows, columns) of the sphere mesh, coarser from afar
+PLAYBACK_STEPS = 1000  # positions of the time slider
+PLAYBACK_INTERVAL = 30  # milliseconds between frames of playback, which advances one slider position per frame
 
 
 def draw_utm_north_pointer(view, y_range, x_centre, y_centre):
@@ -79,42 +89,212 @@ def draw_earth(view):
     zgrid.setSpacing(200, 200)
     # Grid lines are 200 units (kilometres) apart
 
-    sphere_mesh = gl.MeshData.sphere(rows=180, cols=360, radius=6371)
-    view.addItem(gl.GLMeshItem(meshdata=sphere_mesh, shader=None, smooth=False, glOptions="translucent",
-                               drawFaces=False, drawEdges=True, edgeColor=(1, 1, 1, 0.1)))
+    sphere = gl.GLMeshItem(meshdata=gl.MeshData.sphere(rows=180, cols=360, radius=6371), shader=None, smooth=False,
+                           glOptions="translucent", drawFaces=False, drawEdges=True, edgeColor=(1, 1, 1, 0.1))
+    view.addItem(sphere)
     # Wireframe sphere to represent Earth - not an ellipsoid so inconsistent with calculated positions
+    return sphere
+
+
+def _camera(view):
+    """Returns the camera position and viewing direction of a view as NumPy arrays."""
+    position, centre = view.cameraPosition(), view.opts["center"]
+    camera = np.array([position.x(), position.y(), position.z()])
+    return camera, np.array([centre.x(), centre.y(), centre.z()]) - camera
+
+
+def watch_camera(view, callback):
+    """Calls callback(camera, direction) now and whenever the camera of a view has moved, checking every
+    CAMERA_INTERVAL milliseconds."""
+    state = {"camera": None}
+
+    def check():
+        camera, direction = _camera(view)
+        key = (tuple(camera), tuple(direction), view.opts["fov"], view.height())
+        if key != state["camera"]:  # nothing to do while the camera is still
+            state["camera"] = key
+            callback(camera, direction)
+
+    check()
+    timer = QTimer(view)
+    timer.timeout.connect(check)
+    timer.start(CAMERA_INTERVAL)
+    view.camera_timers = getattr(view, "camera_timers", []) + [timer]  # keeping references for the view's lifetime
+
+
+def adapt_earth_mesh(view, sphere):
+    """Rebuilds the sphere mesh of draw_earth whenever the camera distance calls for another resolution of
+    EARTH_MESH_DETAIL."""
+    state = {"detail": (180, 360)}
+
+    def update(camera, direction):
+        distance = np.linalg.norm(camera) / 6371
+        detail = next((rows, cols) for limit, rows, cols in EARTH_MESH_DETAIL if distance >= limit)
+        if detail != state["detail"]:
+            sphere.setMeshData(meshdata=gl.MeshData.sphere(rows=detail[0], cols=detail[1], radius=6371))
+            state["detail"] = detail
 
+    watch_camera(view, update)
 
-def draw_plot(df, mode="u"):
-    """Draws a 3D scatter plot. The mode is the projection: Earth or UTM.
-    Expected input is a Pandas DataFrame object that has "X", "Y", "Z", "Time", and "Magnitude" columns."""
+
+def draw_events(view, positions, colours, sizes):
+    """Draws all events as one scatter plot item."""
+    data = gl.GLScatterPlotItem(pos=positions, pxMode=False, size=sizes, color=colours)
+    # Enabling pxMode (and rescaling sizes to not have division by 100) results in faster rendering with less precision
+    view.addItem(data)
+
+
+def draw_events_lod(view, positions, colours, sizes, magnitudes):
+    """Draws events with level of detail: an event_octree.EventOctree splits them into tiles, each drawn as its own
+    scatter plot item with only the most important events of each octree node when zoomed out, favouring large
+    magnitudes, and every event of tiles close to the camera. Tiles outside of the view are hidden.
+    Whenever the camera moves only the tiles whose level changed are uploaded again."""
+    octree = event_octree.EventOctree(positions, magnitudes)
+    positions, colours, sizes = positions[octree.order], colours[octree.order], sizes[octree.order]
+    # sorted by tile and level of detail so that the events drawn for a tile are always a prefix of its slice
+    items = [gl.GLScatterPlotItem(pxMode=False) for _ in octree.tiles]
+    for item in items:
+        view.addItem(item)
+    drawn = np.full(len(items), -1)
+
+    def update(camera, direction):
+        levels = octree.view_levels(camera, direction, view.opts["fov"], max(view.height(), 1))
+        counts = np.where(levels >= 0, octree.counts(levels), 0)
+        for tile in np.flatnonzero(counts != drawn):
+            start, count = octree.tile_offsets[tile], counts[tile]
+            items[tile].setVisible(count > 0)
+            if count > 0:
+                part = slice(start, start + count)
+                items[tile].setData(pos=positions[part], color=colours[part], size=sizes[part])
+        drawn[:] = counts
+
+    watch_camera(view, update)
+
+
+class TimeLapseScatterPlotItem(gl.GLScatterPlotItem):
+    """Scatter plot of events sorted by time that draws only the events before a given index.
+    Every event is uploaded into the vertex buffers once, after which revealing more or fewer events only changes how
+    many vertices are drawn: the item's arrays are replaced by views of the first rows of the full arrays, and
+    whenever pyqtgraph uploads them the full arrays are uploaded instead. No array is ever copied or rebuilt.
+    This relies on the upload_vbo method of pyqtgraph 0.14, which isn't public. With versions without it, revealed
+    events are passed to setData and uploaded every time instead."""
+
+    def __init__(self, positions, colours, sizes):
+        """Expected input is float32 NumPy arrays of positions of shape (n, 3), RGBA colours of shape (n, 4) and
+        sizes, all sorted by time."""
+        super().__init__(pos=positions, color=colours, size=sizes, pxMode=False)
+        self.events = positions, colours, sizes
+
+    def upload_vbo(self, vbo, array):
+        """Uploads the full array of which array is a view, see pyqtgraph.opengl.GLScatterPlotItem.paint, or array
+        itself when it isn't a view of any, e.g. when it is empty or pyqtgraph passes a copy."""
+        full = next((events for events in self.events if len(array) and np.may_share_memory(events, array)), array)
+        super().upload_vbo(vbo, full)
+
+    def reveal(self, count):
+        """Draws the first count events from the next frame on."""
+        revealed = (events[:count] for events in self.events)
+        if hasattr(gl.GLScatterPlotItem, "upload_vbo"):
+            self.pos, self.color, self.size = revealed
+            self.update()
+        else:
+            self.setData(**dict(zip(["pos", "color", "size"], revealed)))
+
+
+def draw_playback(view, positions, colours, sizes, times):
+    """Draws events as a time-lapse: returns a widget with the view above a play button and a time slider, where
+    events are revealed in chronological order up to the time of the slider.
+    Expected input is float32 NumPy arrays of positions, RGBA colours and sizes as well as a NumPy array of times as
+    integers, e.g. nanoseconds, all sorted by time."""
+    data = TimeLapseScatterPlotItem(positions, colours, sizes)
+    view.addItem(data)
+
+    widget = QWidget()
+    layout = QVBoxLayout(widget)
+    layout.addWidget(view, stretch=1)
+    controls = QHBoxLayout()
+    layout.addLayout(controls)
+    button = QPushButton("Play")
+    slider = QSlider(Qt.Horizontal)
+    slider.setRange(0, PLAYBACK_STEPS)
+    label = QLabel()
+    for control in (button, slider, label):
+        controls.addWidget(control)
+
+    def show_time(step):
+        time = times[0] + int((times[-1] - times[0]) * (step / PLAYBACK_STEPS))  # int64 products could overflow
+        data.reveal(np.searchsorted(times, time, side="right"))  # events are sorted, so a binary search suffices
+        label.setText(str(np.datetime64(int(time), "ns").astype("datetime64[s]")).replace("T", " "))
+
+    def advance():
+        if slider.value() >= PLAYBACK_STEPS:
+            toggle()
+        else:
+            slider.setValue(slider.value() + 1)
+
+    def toggle():
+        if timer.isActive():
+            timer.stop()
+            button.setText("Play")
+        else:
+            if slider.value() >= PLAYBACK_STEPS:  # restarting from the beginning once finished
+                slider.setValue(0)
+            timer.start(PLAYBACK_INTERVAL)
+            button.setText("Pause")
+
+    timer = QTimer(widget)
+    timer.timeout.connect(advance)
+    button.clicked.connect(toggle)
+    slider.valueChanged.connect(show_time)
+    slider.setValue(PLAYBACK_STEPS)
+    show_time(PLAYBACK_STEPS)  # all events are shown until playback starts
+    return widget
+
+
+def draw_plot(df, mode="u", playback=False):
+    """Draws a 3D scatter plot. The mode is the projection: Earth or UTM. Playback adds controls to reveal events in
+    chronological order, see draw_playback, otherwise large catalogs are drawn with level of detail.
+    Expected input is a Pandas DataFrame object that has "X", "Y", "Z", "Time", and "Magnitude" columns.
+    Returns the shown widget, which has to be kept referenced."""
 
     view = gl.GLViewWidget()
-    view.show()
 
     centre = df["X"].mean(), df["Y"].mean(), df["Z"].mean()
     view.pan(*centre)  # unpacking values
     # Centering camera
 
     if mode == "e":
-        draw_earth(view)
+        adapt_earth_mesh(view, draw_earth(view))
     elif mode == "u":
         draw_utm(view, df)
 
-    df["Colour"] = (df["Time"] - df["Time"].min()) / (df["Time"].max() - df["Time"].min())  # normalizing to [0,1]
-    scatter_plot_colours = plt.cm.plasma(df["Colour"])
+    times = time_conversion.nanoseconds(df["Time"])
+    order = np.argsort(times, kind="stable") if playback else slice(None)  # playback needs events sorted by time
+    times = times[order]
+    colour = (times - times.min()) / max(times.max() - times.min(), 1)  # normalizing to [0,1]
+    scatter_plot_colours = plt.cm.plasma(colour).astype(np.float32)
     scatter_plot_colours[:, 3] = 0.5
     # Data points are scaled from 0 to 1 by relative time for colouring
     # Blue denotes closer to beginning, yellow denotes closer to end
     # Transparency reset to the default value
 
-    data = gl.GLScatterPlotItem(pos=np.transpose([df["X"], df["Y"], df["Z"]]), pxMode=False,
-                                size=np.squeeze(np.transpose([df["Magnitude"]])) ** 2 / 100,
-                                color=scatter_plot_colours)
-    # Enabling pxMode (and rescaling sizes to not have division by 100) results in faster rendering with less precision
+    positions = np.empty((len(df), 3), dtype=np.float32)
+    for axis, column in enumerate(["X", "Y", "Z"]):
+        positions[:, axis] = df[column].to_numpy()[order]
+    magnitudes = df["Magnitude"].to_numpy()[order]
+    sizes = (magnitudes ** 2 / 100).astype(np.float32)
     # Scatter plot point size chosen empirically, it may be better to normalize by df["Mw"].mean() in general
     # Squaring the size parameter highlights large magnitudes
-    view.addItem(data)
+    if playback:
+        widget = draw_playback(view, positions, scatter_plot_colours, sizes, times)
+    elif len(df) > LOD_THRESHOLD:
+        draw_events_lod(view, positions, scatter_plot_colours, sizes, magnitudes)
+        widget = view
+    else:
+        draw_events(view, positions, scatter_plot_colours, sizes)
+        widget = view
+    widget.show()
+    return widget
 
 
 def main():
@@ -130,7 +310,8 @@ def main():
         mode = input("Enter e for projecting data relative to a spherical Earth model, "
                      "u for projecting data relative to a UTM coordinate model: ")
     df = process_input.process(file_name, mode)
-    draw_plot(df, mode)
+    playback = input("Enter p for a time-lapse playback, anything else for a static plot: ") == "p"
+    widget = draw_plot(df, mode, playback)  # keeping a reference until the application exits
 
     print("\nGoodbye!")
     sys.exit(app.exec_())
@@ -1,11 +1,21 @@
 #!/usr/bin/env python3
 
-import matplotlib.pyplot as plt
+import warnings
+
+import numpy as np
 import pandas as pd
 
+import catalog_cache
+import declustering
 import geospatial_conversion
+import instrumentation
+import region_filter
+import time_conversion
+
+TIME_COLUMNS = ["Year", "Month", "Day", "Hour", "Minute", "Second"]
 
 
+@instrumentation.instrumented
 def magnitude_of_completeness(df):
     """Removes data below the magnitude of completeness."""
     moc = None
@@ -20,9 +30,11 @@ def magnitude_of_completeness(df):
     return df
 
 
+@instrumentation.instrumented
 def remove_outliers_distance_matrix(df, remove=0.01):
     """Removes outliers using a distance matrix analysis.
-    The parameter remove controls the fraction of data to be removed as outliers. Not feasible for large datasets."""
+    The parameter remove controls the fraction of data to be removed as outliers. Not feasible for large datasets,
+    see remove_outliers_total_distance and remove_outliers_nearest_neighbours."""
     from scipy.spatial import distance_matrix
     location_vectors = df.loc[:, ["X", "Y", "Z"]]
     d_matrix = pd.DataFrame(distance_matrix(location_vectors, location_vectors), columns=df.index, index=df.index)
@@ -34,8 +46,69 @@ def remove_outliers_distance_matrix(df, remove=0.01):
     return df
 
 
+def _remove_largest(df, scores, remove):
+    """Removes the rows whose scores are in the top remove fraction, with the same threshold as
+    remove_outliers_distance_matrix. Expected input is a Pandas DataFrame and a NumPy array of scores, one per row."""
+    scores = pd.Series(scores, index=df.index)
+    return df[scores < scores.quantile(1-remove)]
+
+
+def total_distances(location_vectors, memory_limit=2 ** 27):
+    """Returns the sum of distances from each location to all locations, computed in blocks of rows so that no more
+    than memory_limit bytes of distances are held at once. Expected input is a 2D NumPy array of locations.
+    Exact, but the time taken still grows quadratically with the number of locations."""
+    from scipy.spatial.distance import cdist
+    block_size = max(memory_limit // (8 * max(len(location_vectors), 1)), 1)
+    totals = np.empty(len(location_vectors))
+    for start in range(0, len(location_vectors), block_size):
+        totals[start:start + block_size] = cdist(location_vectors[start:start + block_size], location_vectors).sum(1)
+    return totals
+
+
+def approximate_total_distances(location_vectors, cells=16, memory_limit=2 ** 27):
+    """Returns the approximate sum of distances from each location to all locations, by treating the locations in
+    each cell of a cells x cells x cells grid over their bounding box as a point mass at their centroid.
+    The error is at most the total distance of locations from their centroids, and the time taken grows linearly with
+    the number of locations. Expected input is a 2D NumPy array of locations."""
+    from scipy.spatial.distance import cdist
+    low, high = location_vectors.min(axis=0), location_vectors.max(axis=0)
+    cell = np.minimum(((location_vectors - low) / np.where(high > low, high - low, 1) * cells).astype(int), cells - 1)
+    cell = np.ravel_multi_index(cell.T, (cells,) * location_vectors.shape[1])
+    cell, inverse, counts = np.unique(cell, return_inverse=True, return_counts=True)
+    centroids = np.column_stack([np.bincount(inverse, weights=axis) for axis in location_vectors.T]) / counts[:, None]
+    block_size = max(memory_limit // (8 * len(centroids)), 1)
+    totals = np.empty(len(location_vectors))
+    for start in range(0, len(location_vectors), block_size):
+        totals[start:start + block_size] = cdist(location_vectors[start:start + block_size], centroids) @ counts
+    return totals
+
+
+@instrumentation.instrumented
+def remove_outliers_total_distance(df, remove=0.01, approximate=False, memory_limit=2 ** 27):
+    """Removes outliers with the same criterion as remove_outliers_distance_matrix, the sum of distances to all other
+    events, without ever holding more than memory_limit bytes of distances. The parameter approximate trades the
+    exact quadratic time calculation for a linear time approximation, see approximate_total_distances."""
+    location_vectors = df.loc[:, ["X", "Y", "Z"]].to_numpy(dtype=float)
+    if approximate:
+        return _remove_largest(df, approximate_total_distances(location_vectors, memory_limit=memory_limit), remove)
+    return _remove_largest(df, total_distances(location_vectors, memory_limit), remove)
+
+
+@instrumentation.instrumented
+def remove_outliers_nearest_neighbours(df, remove=0.01, k=10):
+    """Removes outliers using the distance to the k-th nearest neighbour, found with a KD-tree in O(n log n) time and
+    linear memory. The parameter remove controls the fraction of data to be removed as outliers."""
+    from scipy.spatial import cKDTree
+    location_vectors = df.loc[:, ["X", "Y", "Z"]].to_numpy(dtype=float)
+    distances = cKDTree(location_vectors).query(location_vectors, k=[k + 1], workers=-1)[0][:, 0]
+    # the nearest neighbour of every event is itself
+    return _remove_largest(df, distances, remove)
+
+
+@instrumentation.instrumented
 def remove_outliers_cropping(df):
-    """Removes outliers using manual cropping."""
+    """Removes outliers using manual cropping, or a region filter saved by an earlier run, see region_filter."""
+    import matplotlib.pyplot as plt
     fig, (ax1, ax2, ax3) = plt.subplots(3)
     fig.suptitle("Spread of Data in Spatial Dimensions")
 
@@ -56,12 +129,25 @@ def remove_outliers_cropping(df):
     plt.show(block=False)
     plt.pause(0.01)
 
+    region = None
+    while region is None:
+        file_name = input("Enter a region filter file to load, see region_filter.py, or leave the input blank to crop "
+                          "manually: ")
+        if file_name == "":
+            break
+        try:
+            region = region_filter.load(file_name)
+        except (OSError, ValueError):
+            print("The file could not be read as a region filter, try again")
+    if region is not None:
+        plt.close()
+        return region_filter.apply(df, region)
+
     x_min, x_max, y_min, y_max, z_min, z_max = None, None, None, None, None, None
     while type(x_min) is not float:
         try:
             x_min = input("Enter minimum X value or leave the input blank for no cropping: ")
             x_min = float(x_min)
-            df = df.drop(df.loc[df["X"] < x_min].index)
         except ValueError:
             if x_min == "":
                 break
@@ -69,7 +155,6 @@ def remove_outliers_cropping(df):
         try:
             x_max = input("Enter maximum X value or leave the input blank for no cropping: ")
             x_max = float(x_max)
-            df = df.drop(df.loc[df["X"] > x_max].index)
         except ValueError:
             if x_max == "":
                 break
@@ -77,7 +162,6 @@ def remove_outliers_cropping(df):
         try:
             y_min = input("Enter minimum Y value or leave the input blank for no cropping: ")
             y_min = float(y_min)
-            df = df.drop(df.loc[df["Y"] < y_min].index)
         except ValueError:
             if y_min == "":
                 break
@@ -85,7 +169,6 @@ def remove_outliers_cropping(df):
         try:
             y_max = input("Enter maximum Y value or leave the input blank for no cropping: ")
             y_max = float(y_max)
-            df = df.drop(df.loc[df["Y"] > y_max].index)
         except ValueError:
             if y_max == "":
                 break
@@ -93,7 +176,6 @@ def remove_outliers_cropping(df):
         try:
             z_min = input("Enter minimum Z value or leave the input blank for no cropping: ")
             z_min = float(z_min)
-            df = df.drop(df.loc[df["Z"] < z_min].index)
         except ValueError:
             if z_min == "":
                 break
@@ -101,30 +183,126 @@ def remove_outliers_cropping(df):
         try:
             z_max = input("Enter maximum Z value or leave the input blank for no cropping: ")
             z_max = float(z_max)
-            df = df.drop(df.loc[df["Z"] > z_max].index)
         except ValueError:
             if z_max == "":
                 break
 
+    bound = lambda value: value if type(value) is float else None  # left blank for no cropping
+    region = region_filter.from_bounds({"X": (bound(x_min), bound(x_max)), "Y": (bound(y_min), bound(y_max)),
+                                        "Z": (bound(z_min), bound(z_max))})
+    df = region_filter.apply(df, region)  # a single pass and copy for all bounds
+    file_name = input("Enter a file name to save these bounds to for later runs, or leave the input blank: ")
+    if file_name != "":
+        region_filter.save(region, file_name)
+
     plt.close()
     return df
 
 
-def process(file_name, mode="u"):
-    """Converts data for statistical analysis as necessary. Expected file format is a csv file with the columns
-    "Year", "Month", "Day", "Hour", "Minute", "Second", "latitude", "Longitude", "Depth", and "Magnitude".
-    Depth is to be expressed in kilometres."""
-    df = pd.read_csv(file_name)
+@instrumentation.instrumented
+def remove_aftershocks(df):
+    """Removes foreshocks and aftershocks, keeping independent events and the mainshock of every cluster, with a
+    declustering method of declustering.METHODS."""
+    method = None
+    while method not in {"", *declustering.METHODS}:
+        method = input("Enter gk (Gardner-Knopoff) or reasenberg (Reasenberg) to decluster the catalog, or leave the "
+                       "input blank to keep all events: ")
+    if method == "":
+        return df
+    declustered = declustering.decluster(df, method)
+    print(len(df) - len(declustered), "of", len(df), "events were removed as foreshocks or aftershocks")
+    return declustered
+
+
+def _event_times(df):
+    """Returns the rows of a Pandas DataFrame with valid date and time components, see
+    time_conversion.get_epoch_nanoseconds, their times as a datetime64[ns] NumPy array and the number of rows
+    removed."""
+    nanoseconds, valid = time_conversion.get_epoch_nanoseconds(*(df[column].to_numpy() for column in TIME_COLUMNS))
+    if valid.all():
+        return df, time_conversion.to_datetime64(nanoseconds), 0
+    return df[valid], time_conversion.to_datetime64(nanoseconds[valid]), len(df) - np.count_nonzero(valid)
+
+
+@instrumentation.instrumented
+def load(file_name, mode="u", cache_dir=catalog_cache.DEFAULT_CACHE_DIR):
+    """Reads and converts data for statistical analysis without any filtering, see process. The result is cached in
+    cache_dir so that later runs on the same file load it in milliseconds, unless cache_dir is None.
+    Times are assembled from their components by time_conversion.get_epoch_nanoseconds, and events with invalid dates
+    or times, e.g. February 30th, are removed with a warning instead of failing the whole catalog."""
+    if cache_dir is not None:
+        return catalog_cache.cached(file_name, {"mode": mode}, lambda: load(file_name, mode, None), cache_dir)
+    with instrumentation.stage("process_input.load.read_csv"):
+        df = pd.read_csv(file_name)
     df = df.dropna()  # removing entries with no associated values
-    df["Time"] = pd.to_datetime(df[["Year", "Month", "Day", "Hour", "Minute", "Second"]], infer_datetime_format=True)
-    df = df.drop(columns=["Year", "Month", "Day", "Hour", "Minute", "Second"])  # dropping redundant columns
+    with instrumentation.stage("process_input.load.datetime", len(df)):
+        df, times, invalid = _event_times(df)
+    if invalid:
+        warnings.warn(f"{invalid} events with invalid dates or times were removed")
+    df = df.drop(columns=TIME_COLUMNS)  # dropping redundant columns
+    df["Time"] = times
     if mode == "e":  # earth mode
         df["X"], df["Y"], df["Z"] = geospatial_conversion.get_cartesian(
             df["Latitude"].to_numpy(), df["Longitude"].to_numpy(), df["Depth"].to_numpy())
     elif mode == "u":  # utm mode
+        zone = geospatial_conversion.get_utm_zone(df["Latitude"].to_numpy(), df["Longitude"].to_numpy())
         df["X"], df["Y"], df["Z"] = geospatial_conversion.get_utm(
-            df["Latitude"].to_numpy(), df["Longitude"].to_numpy(), df["Depth"].to_numpy())
+            df["Latitude"].to_numpy(), df["Longitude"].to_numpy(), df["Depth"].to_numpy(), zone)
+        df.attrs["utm_zone"] = None if zone is None else list(zone)  # see region_filter.geographic_polygon
     df = df.drop(columns=["Latitude", "Longitude", "Depth"])  # dropping redundant columns
+    return df
+
+
+@instrumentation.instrumented
+def load_chunked(file_name, mode="u", magnitude_of_completeness=None, bounds=None, chunk_size=10 ** 6, region=None):
+    """Reads, converts and filters data chunk by chunk, so that catalogs larger than memory can be reduced to the
+    events that are kept, with peak memory proportional to chunk_size rather than to the file. Events below the
+    magnitude of completeness are removed before any conversion, and events outside of bounds, see
+    region_filter.from_bounds, and of an optional region filter, see region_filter, after. Events with invalid dates
+    or times are removed, see load. Columns are stored compactly: float32 "Magnitude", "X", "Y" and "Z", and "Time"
+    as int64 epoch nanoseconds (datetime64[ns]). All chunks use the UTM zone of the first event, as load does."""
+    columns = {"Time": [], "Magnitude": [], "X": [], "Y": [], "Z": []}
+    zone, invalid = None, 0
+    region = region_filter.all_of(region_filter.from_bounds(bounds or {}), *([] if region is None else [region]))
+    for chunk in pd.read_csv(file_name, chunksize=chunk_size,
+                             usecols=[*TIME_COLUMNS, "Latitude", "Longitude", "Depth", "Magnitude"]):
+        chunk = chunk.dropna()  # removing entries with no associated values
+        chunk, times, chunk_invalid = _event_times(chunk)
+        invalid += chunk_invalid
+        if mode == "u" and zone is None and len(chunk):
+            zone = geospatial_conversion.get_utm_zone(chunk["Latitude"].to_numpy(), chunk["Longitude"].to_numpy())
+        if magnitude_of_completeness is not None:
+            complete = (chunk["Magnitude"] >= magnitude_of_completeness).to_numpy()
+            chunk, times = chunk[complete], times[complete]
+        latitude, longitude, depth = (chunk[column].to_numpy() for column in ["Latitude", "Longitude", "Depth"])
+        if mode == "e":  # earth mode
+            x, y, z = geospatial_conversion.get_cartesian(latitude, longitude, depth)
+        else:  # utm mode
+            x, y, z = geospatial_conversion.get_utm(latitude, longitude, depth, zone)
+        chunk = pd.DataFrame({"Time": times,
+                              "Magnitude": chunk["Magnitude"].to_numpy(dtype=np.float32),
+                              "X": x.astype(np.float32), "Y": y.astype(np.float32), "Z": z.astype(np.float32)})
+        if mode == "u":
+            chunk.attrs["utm_zone"] = None if zone is None else list(zone)
+        chunk = region_filter.apply(chunk, region)
+        for column, values in columns.items():
+            values.append(chunk[column].to_numpy())
+    if invalid:
+        warnings.warn(f"{invalid} events with invalid dates or times were removed")
+    df = pd.DataFrame({column: np.concatenate(values) if values else np.empty(0, dtype=np.float32)
+                       for column, values in columns.items()}).astype({"Time": "datetime64[ns]"})
+    if mode == "u":
+        df.attrs["utm_zone"] = None if zone is None else list(zone)
+    return df
+
+
+@instrumentation.instrumented
+def process(file_name, mode="u"):
+    """Converts data for statistical analysis as necessary. Expected file format is a csv file with the columns
+    "Year", "Month", "Day", "Hour", "Minute", "Second", "latitude", "Longitude", "Depth", and "Magnitude".
+    Depth is to be expressed in kilometres."""
+    df = load(file_name, mode)
     df = magnitude_of_completeness(df)
     df = remove_outliers_cropping(df)
+    df = remove_aftershocks(df)
     return df
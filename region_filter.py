@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+
+import json
+
+import numpy as np
+import pandas as pd
+
+import geospatial_conversion
+import instrumentation
+
+GRID_VERTICES = 32  # polygons with more vertices than this are tested through a grid, see polygon_mask
+MEMORY_LIMIT = 2 ** 24  # bytes of point by edge comparisons held at once
+
+# Region filters are JSON serialisable dictionaries, so that they can be saved, reused across runs and used as settings
+# of the processed catalog cache. Each has a "type" among:
+#   "range": rows whose "column" is from "minimum" to "maximum", either of which may be None for no bound, with times
+#            as ISO 8601 strings,
+#   "polygon": rows whose "columns", ["X", "Y"] by default, lie inside a polygon of "vertices", or for a "geographic"
+#              polygon rows whose position lies inside a polygon of (longitude, latitude) vertices, see
+#              geographic_polygon, and an optional "grid" of cells per axis, see polygon_mask,
+#   "all", "any": rows kept by all, or any, of a list of "filters",
+#   "not": rows not kept by a "filter".
+# They are best built with the functions below, e.g.
+# all_of(depth_range(0, 30), exclude(polygon([[0, 0], [10, 0], [10, 10]]))).
+
+
+def value_range(column, minimum=None, maximum=None):
+    """Returns a filter of rows whose column is from minimum to maximum inclusive, either of which may be None."""
+    if isinstance(minimum, (pd.Timestamp, np.datetime64)) or isinstance(maximum, (pd.Timestamp, np.datetime64)):
+        minimum, maximum = (None if value is None else pd.Timestamp(value).isoformat() for value in (minimum, maximum))
+    return {"type": "range", "column": column, "minimum": minimum, "maximum": maximum}
+
+
+def box(x_min=None, x_max=None, y_min=None, y_max=None):
+    """Returns a filter of rows inside a bounding box of X and Y, in km, any side of which may be None."""
+    return all_of(value_range("X", x_min, x_max), value_range("Y", y_min, y_max))
+
+
+def depth_range(minimum=None, maximum=None):
+    """Returns a filter of rows from minimum to maximum depth in km, as Z is the negative of depth."""
+    return value_range("Z", None if maximum is None else -maximum, None if minimum is None else -minimum)
+
+
+def magnitude_range(minimum=None, maximum=None):
+    """Returns a filter of rows from minimum to maximum magnitude."""
+    return value_range("Magnitude", minimum, maximum)
+
+
+def time_range(start=None, end=None):
+    """Returns a filter of rows from start to end time, given as anything pd.Timestamp reads, e.g. "2010-01-31"."""
+    return {"type": "range", "column": "Time", "minimum": None if start is None else pd.Timestamp(start).isoformat(),
+            "maximum": None if end is None else pd.Timestamp(end).isoformat()}
+
+
+def polygon(vertices, columns=("X", "Y")):
+    """Returns a filter of rows inside a polygon of projected coordinates, by default X and Y in km. Expected input is
+    a sequence of (x, y) vertices, the polygon being closed from the last vertex back to the first. Self intersecting
+    polygons follow the even-odd rule."""
+    return {"type": "polygon", "vertices": np.asarray(vertices, dtype=float).tolist(), "columns": list(columns)}
+
+
+def geographic_polygon(vertices, mode="u", zone=None):
+    """Returns a filter of rows inside a polygon of (longitude, latitude) vertices in degrees, for a catalog loaded
+    with the given mode, see process_input.load. In UTM mode vertices are projected into zone, a (number, letter)
+    pair, by default the zone of the catalog that process_input.load records in DataFrame.attrs["utm_zone"], and
+    edges are straight in projected coordinates. Filtering a catalog of another zone raises a ValueError, and only a
+    catalog without a recorded zone, e.g. built by hand, is projected into the zone of the first vertex. In Earth
+    centred mode the position of every event is converted back to longitude and latitude instead, see
+    geospatial_conversion.get_geographic."""
+    return {"type": "polygon", "vertices": np.asarray(vertices, dtype=float).tolist(), "geographic": mode,
+            "zone": None if zone is None else [int(zone[0]), str(zone[1])]}
+
+
+def all_of(*filters):
+    """Returns a filter of rows kept by every one of filters."""
+    return {"type": "all", "filters": list(filters)}
+
+
+def any_of(*filters):
+    """Returns a filter of rows kept by any of filters."""
+    return {"type": "any", "filters": list(filters)}
+
+
+def exclude(region):
+    """Returns a filter of rows not kept by region, e.g. to cut a polygon out."""
+    return {"type": "not", "filter": region}
+
+
+def from_bounds(bounds):
+    """Returns a filter of bounds, a dictionary of column names to (minimum, maximum) pairs, where None leaves that
+    side unbounded, e.g. {"Z": (-30, None)}."""
+    return all_of(*(value_range(column, minimum, maximum) for column, (minimum, maximum) in bounds.items()))
+
+
+def save(region, file_name):
+    """Writes a filter to a JSON file."""
+    with open(file_name, "w") as region_file:
+        json.dump(region, region_file, indent=2)
+
+
+def load(file_name):
+    """Reads a filter from a JSON file written by save."""
+    with open(file_name) as region_file:
+        return json.load(region_file)
+
+
+def _even_odd(x, y, x0, y0, x1, y1, memory_limit=MEMORY_LIMIT):
+    """Returns a boolean NumPy array of whether each point is inside the polygon with edges from (x0, y0) to (x1, y1),
+    by the parity of the number of edges crossed by a ray from the point towards increasing x. Points are compared
+    with all edges at once, in blocks so that no more than memory_limit bytes of comparisons are held."""
+    dy = y1 - y0
+    slope = (x1 - x0) / np.where(dy == 0, 1, dy)  # horizontal edges are never crossed
+    inside = np.zeros(len(x), dtype=bool)
+    block_size = max(memory_limit // (2 * max(len(x0), 1)), 1)
+    for start in range(0, len(x), block_size):
+        point_x, point_y = x[start:start + block_size, None], y[start:start + block_size, None]
+        crossed = ((y0 > point_y) != (y1 > point_y)) & (point_x < x0 + (point_y - y0) * slope)
+        inside[start:start + block_size] = np.count_nonzero(crossed, axis=1) % 2 == 1
+    return inside
+
+
+def _banded_even_odd(x, y, rows, x0, y0, x1, y1, edge_rows, edges):
+    """Returns whether each point is inside the polygon as _even_odd does, testing every point only against the edges
+    whose y extent overlaps its row of the grid, the only edges a ray along x from the point can cross. Expected input
+    is the row of every point and, sorted by row, the row and index of every edge overlapping each row."""
+    inside = np.zeros(len(x), dtype=bool)
+    order = np.argsort(rows, kind="stable")
+    row_values, row_starts = np.unique(rows[order], return_index=True)
+    point_bounds = np.append(row_starts, len(order))
+    for i, row in enumerate(row_values):
+        points = order[point_bounds[i]:point_bounds[i + 1]]
+        row_edges = edges[np.searchsorted(edge_rows, row):np.searchsorted(edge_rows, row, side="right")]
+        inside[points] = _even_odd(x[points], y[points], x0[row_edges], y0[row_edges], x1[row_edges], y1[row_edges])
+    return inside
+
+
+@instrumentation.instrumented
+def polygon_mask(x, y, vertices, grid=None):
+    """Returns a boolean NumPy array of whether each point is inside a polygon, by the even-odd rule. Expected input
+    is NumPy arrays of point coordinates and a 2D array of (x, y) vertices.
+    Points outside of the bounding box of the polygon are rejected first. Polygons of more than GRID_VERTICES
+    vertices, or with grid set to a number of cells per axis, are then tested through a grid over their bounding box:
+    points in cells that no edge passes through take the status of their cell, found by testing its centre, and the
+    remaining points are only tested against the edges of their row of cells, so the cost per point stays nearly
+    constant however many vertices there are."""
+    vertices = np.asarray(vertices, dtype=float)
+    x0, y0 = vertices[:, 0], vertices[:, 1]
+    x1, y1 = np.roll(x0, -1), np.roll(y0, -1)
+    (x_min, y_min), (x_max, y_max) = vertices.min(axis=0), vertices.max(axis=0)
+    inside = np.zeros(len(x), dtype=bool)
+    candidates = np.flatnonzero((x >= x_min) & (x <= x_max) & (y >= y_min) & (y <= y_max))
+    if grid is None:
+        grid = int(np.ceil(np.sqrt(len(vertices)))) if len(vertices) > GRID_VERTICES else 0
+    if grid <= 1 or not len(candidates):
+        inside[candidates] = _even_odd(x[candidates], y[candidates], x0, y0, x1, y1)
+        return inside
+
+    width, height = max(x_max - x_min, np.finfo(float).tiny) / grid, max(y_max - y_min, np.finfo(float).tiny) / grid
+    cell_x = lambda values: np.clip(((values - x_min) / width).astype(np.int64), 0, grid - 1)
+    cell_y = lambda values: np.clip(((values - y_min) / height).astype(np.int64), 0, grid - 1)
+    column_start, column_end = cell_x(np.minimum(x0, x1)), cell_x(np.maximum(x0, x1))
+    row_start, row_end = cell_y(np.minimum(y0, y1)), cell_y(np.maximum(y0, y1))
+    columns, rows = column_end - column_start + 1, row_end - row_start + 1
+    edges = np.repeat(np.arange(len(vertices)), columns * rows)  # every cell of the bounding box of every edge
+    offset = np.arange(len(edges)) - np.repeat(np.cumsum(columns * rows) - columns * rows, columns * rows)
+    boundary = np.zeros((grid, grid), dtype=bool)  # indexed [row, column]
+    boundary[row_start[edges] + offset // columns[edges], column_start[edges] + offset % columns[edges]] = True
+    edges = np.repeat(np.arange(len(vertices)), rows)  # every row of cells overlapped by every edge
+    edge_rows = row_start[edges] + np.arange(len(edges)) - np.repeat(np.cumsum(rows) - rows, rows)
+    order = np.argsort(edge_rows, kind="stable")
+    edge_rows, edges = edge_rows[order], edges[order]
+
+    cell_rows, cell_columns = np.nonzero(~boundary)
+    cells = np.zeros((grid, grid), dtype=bool)
+    cells[cell_rows, cell_columns] = _banded_even_odd(x_min + (cell_columns + 0.5) * width,
+                                                      y_min + (cell_rows + 0.5) * height, cell_rows,
+                                                      x0, y0, x1, y1, edge_rows, edges)
+    point_rows, point_columns = cell_y(y[candidates]), cell_x(x[candidates])
+    inside[candidates] = cells[point_rows, point_columns]
+    tested = boundary[point_rows, point_columns]
+    points = candidates[tested]
+    inside[points] = _banded_even_odd(x[points], y[points], point_rows[tested], x0, y0, x1, y1, edge_rows, edges)
+    return inside
+
+
+def _bound(values, bound):
+    """Returns a bound of a range filter in the type of the column it applies to."""
+    return np.datetime64(pd.Timestamp(bound).tz_localize(None), "ns") if values.dtype.kind == "M" else bound
+
+
+def _mask(df, region, candidates, columns):
+    """Returns the mask of the rows of candidates, a boolean NumPy array, that region keeps. Rows that aren't
+    candidates are never evaluated, so costly filters only see the rows that cheaper ones haven't removed yet.
+    Columns is a dictionary of the NumPy arrays of the columns read so far, so that each is read only once."""
+    if region["type"] in {"all", "any"}:
+        filters = sorted(region["filters"], key=lambda other: other["type"] != "range")  # cheapest first
+        if region["type"] == "all":
+            for other in filters:
+                candidates = _mask(df, other, candidates, columns)
+            return candidates
+        kept = np.zeros(len(candidates), dtype=bool)
+        for other in filters:
+            kept |= _mask(df, other, candidates & ~kept, columns)
+        return kept
+    if region["type"] == "not":
+        return candidates & ~_mask(df, region["filter"], candidates, columns)
+
+    def column(name):
+        if name not in columns:
+            columns[name] = df[name].to_numpy()
+        return columns[name]
+
+    if region["type"] == "range":
+        values, minimum, maximum = column(region["column"]), region["minimum"], region["maximum"]
+        kept = candidates.copy()
+        if minimum is not None:
+            kept &= values >= _bound(values, minimum)
+        if maximum is not None:
+            kept &= values <= _bound(values, maximum)
+        return kept
+    if region["type"] == "polygon":
+        rows = np.flatnonzero(candidates)
+        vertices = np.asarray(region["vertices"], dtype=float)
+        if region.get("geographic") == "e":
+            x, y = geospatial_conversion.get_geographic(column("X")[rows], column("Y")[rows], column("Z")[rows])[::-1]
+        elif region.get("geographic") is not None:
+            zone, catalog_zone = region.get("zone"), df.attrs.get("utm_zone")
+            projection = lambda zone: (int(zone[0]), zone[1].upper() >= "N")  # letters are only latitude bands
+            if zone is not None and catalog_zone is not None and projection(zone) != projection(catalog_zone):
+                raise ValueError(f"the polygon is projected into UTM zone {zone[0]}{zone[1]}, but the catalog is in "
+                                 f"zone {catalog_zone[0]}{catalog_zone[1]}")
+            zone = zone if zone is not None else catalog_zone
+            zone = None if zone is None else (zone[0], zone[1])
+            vertices = np.column_stack(geospatial_conversion.get_utm(vertices[:, 1], vertices[:, 0],
+                                                                     np.zeros(len(vertices)), zone)[:2])
+            x, y = column("X")[rows], column("Y")[rows]
+        else:
+            x, y = (column(name)[rows] for name in region.get("columns", ["X", "Y"]))
+        kept = np.zeros(len(candidates), dtype=bool)
+        kept[rows] = polygon_mask(np.asarray(x, dtype=float), np.asarray(y, dtype=float), vertices,
+                                  region.get("grid"))
+        return kept
+    raise ValueError(f"unknown region filter type {region['type']!r}")
+
+
+@instrumentation.instrumented
+def mask(df, region):
+    """Returns a boolean NumPy array of the rows of a Pandas DataFrame that a region filter keeps. Every column is read
+    once and polygons are only tested on the rows still kept by the range filters beside them."""
+    return _mask(df, region, np.ones(len(df), dtype=bool), {})
+
+
+@instrumentation.instrumented
+def apply(df, region):
+    """Removes the rows of a Pandas DataFrame outside of a region filter, with a single copy of the rows kept."""
+    return df[mask(df, region)]
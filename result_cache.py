@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+
+import collections
+import glob
+import hashlib
+import inspect
+import json
+import os
+import weakref
+
+import numpy as np
+import pandas as pd
+
+import catalog_cache
+import time_conversion
+
+RESULT_CACHE_VERSION = 6  # bump whenever the estimators or window analyses change, so that old results are never reused
+DEFAULT_CACHE_DIR = os.path.join(catalog_cache.DEFAULT_CACHE_DIR, "results")
+DEFAULT_MAX_BYTES = 512 * 1024 ** 2
+MEMORY_ENTRIES = 32
+IGNORED_PARAMETERS = {"chunk_windows", "chunk_nodes"}  # results don't depend on them
+
+_memory = collections.OrderedDict()  # entry name: (key, result), least recently used first
+_fingerprints = {}  # id of a DataFrame: (weak reference to it, fingerprint)
+
+
+def fingerprint(df):
+    """Returns the SHA-256 hash of the columns of a catalog used by window analyses. Hashes are remembered for as long
+    as the DataFrame exists, so catalogs must not be modified in place once analysed."""
+    known = _fingerprints.get(id(df))
+    if known is not None and known[0]() is df:
+        return known[1]
+    digest = hashlib.sha256()
+    for column in ["Time", "X", "Y", "Z", "Magnitude"]:
+        if column in df.columns:
+            values = df[column].to_numpy()
+            values = time_conversion.nanoseconds(values) if values.dtype.kind == "M" else values
+            digest.update(column.encode() + np.ascontiguousarray(values).tobytes())
+    digest.update(str(len(df)).encode())
+    _fingerprints[id(df)] = (weakref.ref(df, lambda _, key=id(df): _fingerprints.pop(key, None)), digest.hexdigest())
+    return digest.hexdigest()
+
+
+def _parameters(function, df, bin_size, parameters):
+    """Returns the parameters of a call of a window analysis by name, with defaults filled in, so that equivalent calls
+    have equal parameters."""
+    arguments = inspect.signature(function).bind(df, bin_size, **parameters)
+    arguments.apply_defaults()
+    names = list(inspect.signature(function).parameters)[2:]
+    return {name: arguments.arguments[name] for name in names if name not in IGNORED_PARAMETERS}
+
+
+def _store(entry, key, result, cache_dir, max_bytes):
+    """Writes a result to the disk store: every DataFrame as a columnar file, see catalog_cache.write_columns, and the
+    key and any other values in a JSON file, written last so that only complete entries are ever read."""
+    os.makedirs(cache_dir, exist_ok=True)
+    values = []
+    for i, value in enumerate(result):
+        if isinstance(value, pd.DataFrame):
+            catalog_cache.write_columns(os.path.join(cache_dir, f"{entry}_{i}.results"), value)
+            values.append(None)
+        else:
+            values.append(value)
+    with open(os.path.join(cache_dir, entry + ".json.tmp"), "w") as entry_file:
+        json.dump({"key": key, "values": values}, entry_file)
+    os.replace(os.path.join(cache_dir, entry + ".json.tmp"), os.path.join(cache_dir, entry + ".json"))
+    evict(cache_dir, max_bytes)
+
+
+def _load(entry, cache_dir):
+    """Returns a result of the disk store, marked as recently used, or None if it isn't there or is incomplete."""
+    try:
+        with open(os.path.join(cache_dir, entry + ".json")) as entry_file:
+            values = json.load(entry_file)["values"]
+        frame = lambda i: catalog_cache.read_columns(os.path.join(cache_dir, f"{entry}_{i}.results"))
+        result = tuple(frame(i).reset_index(drop=True) if value is None else value for i, value in enumerate(values))
+        os.utime(os.path.join(cache_dir, entry + ".json"))
+    except (OSError, ValueError, KeyError):
+        return None
+    return result
+
+
+def evict(cache_dir=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES):
+    """Deletes the least recently used results of the disk store until it takes at most max_bytes."""
+    entries = []
+    for name in glob.glob(os.path.join(cache_dir, "*.json")):
+        files = [name] + glob.glob(name[:-len(".json")] + "_*.results")
+        try:
+            entries.append((os.stat(name).st_mtime, sum(os.stat(file).st_size for file in files), files))
+        except OSError:  # removed by another process meanwhile
+            continue
+    total = sum(size for _, size, _ in entries)
+    for _, size, files in sorted(entries, key=lambda entry: entry[0]):
+        if total <= max_bytes:
+            break
+        for file in files:
+            try:
+                os.remove(file)
+            except OSError:  # already removed by another process
+                pass
+        total -= size
+
+
+def _remember(entry, key, result):
+    """Keeps a result in the in-memory LRU."""
+    _memory[entry] = (key, result)
+    _memory.move_to_end(entry)
+    while len(_memory) > MEMORY_ENTRIES:
+        _memory.popitem(last=False)
+
+
+def _fewer_windows(parameters, cached_parameters, load):
+    """Derives the result of spatial windows from that of the same windows with a lower minimum number of events,
+    loaded by calling load, by dropping the windows with too few events. Returns None if it can't be derived. Not for
+    bootstrap intervals, whose random streams follow the order of the windows with enough events."""
+    def minimum(values):
+        count = values["window_min_count"]
+        return values.get("neighbours") if count is None else count  # the default of neighbour windows
+
+    others = {name: value for name, value in parameters.items() if name != "window_min_count"}
+    cached_others = {name: value for name, value in cached_parameters.items() if name != "window_min_count"}
+    if others != cached_others or parameters["resamples"] or minimum(cached_parameters) > minimum(parameters):
+        return None
+    result = load()
+    if result is None:
+        return None
+    df_plot, df_export = result
+    df_plot = df_plot.copy()
+    df_plot.loc[~(df_plot["Event_count"] >= minimum(parameters)), ["B_lsr", "B_ml", "Event_count"]] = np.nan
+    return df_plot, df_export[df_export["Event_count"] >= minimum(parameters)].reset_index(drop=True)
+
+
+def _sparser_windows(parameters, cached_parameters, load):
+    """Derives the result of sliding temporal windows from that of windows of the same size with a step that divides
+    the requested one, by keeping every so many windows. Arguments and returned values are as for _fewer_windows."""
+    others = {name: value for name, value in parameters.items() if name != "window_step"}
+    cached_others = {name: value for name, value in cached_parameters.items() if name != "window_step"}
+    if others != cached_others or parameters["window_number"] is not None or parameters["resamples"] \
+            or parameters["window_step"] % cached_parameters["window_step"]:
+        return None
+    result = load()
+    if result is None:
+        return None
+    step = parameters["window_step"] // cached_parameters["window_step"]
+    return tuple(df.iloc[::step].reset_index(drop=True) for df in result)
+
+
+DERIVATIONS = {"spatial_window_analysis": _fewer_windows,
+               "neighbour_window_analysis": _fewer_windows,
+               "temporal_window_analysis": _sparser_windows}
+# analyses of moving_window, by name, whose results can be derived from those of related parameters, without
+# recomputing any window
+
+
+def _derived(key, cache_dir):
+    """Returns a result derived from a cached result of related parameters, see DERIVATIONS, or None."""
+    derivation = DERIVATIONS.get(key["function"])
+    if derivation is None:
+        return None
+    related = lambda other: all(other[name] == key[name] for name in ["version", "catalog", "function", "bin_size"])
+    for other, result in reversed(_memory.values()):
+        if related(other):
+            derived = derivation(key["parameters"], other["parameters"], lambda: result)
+            if derived is not None:
+                return derived
+    if cache_dir is None:
+        return None
+    for name in glob.glob(os.path.join(cache_dir, "*.json")):
+        try:
+            with open(name) as entry_file:
+                other = json.load(entry_file)["key"]
+        except (OSError, ValueError, KeyError):
+            continue
+        if related(other):
+            entry = os.path.basename(name)[:-len(".json")]
+            derived = derivation(key["parameters"], other["parameters"], lambda: _load(entry, cache_dir))
+            if derived is not None:
+                return derived
+    return None
+
+
+def cached(function, df, bin_size, cache_dir=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES, **parameters):
+    """Returns the result of function(df, bin_size, **parameters), a window analysis of moving_window, from the cache
+    when possible. Results are keyed by the catalog fingerprint, the name of the analysis and all its parameters,
+    e.g. the window geometry and bin_size, and RESULT_CACHE_VERSION. They are kept in an in-memory LRU of
+    MEMORY_ENTRIES results backed by a disk store in cache_dir, None for memory only, of at most max_bytes. Results
+    that can be derived from those of related parameters, see DERIVATIONS, are derived instead of recomputed.
+    Returned DataFrames may be shared with the cache and must not be modified in place."""
+    if parameters.get("writer") is not None:  # streamed results are never kept
+        return function(df, bin_size, **parameters)
+    name = function.__name__  # not its module, which is "__main__" when moving_window is run as a script
+    call_parameters = _parameters(function, df, bin_size, parameters)
+    call_parameters.pop("writer", None)
+    key = {"version": RESULT_CACHE_VERSION, "catalog": fingerprint(df), "function": name, "bin_size": bin_size,
+           "parameters": call_parameters}
+    key = json.loads(json.dumps(key, sort_keys=True))  # the same types as keys read back from the disk store
+    entry = hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+    if entry in _memory:
+        _memory.move_to_end(entry)
+        return _memory[entry][1]
+    result = _load(entry, cache_dir) if cache_dir is not None else None
+    if result is None:
+        result = _derived(key, cache_dir)
+    if result is None:
+        result = function(df, bin_size, **parameters)
+        if cache_dir is not None:
+            _store(entry, key, result, cache_dir, max_bytes)
+    _remember(entry, key, result)
+    return result
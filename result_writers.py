@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+
+import abc
+import os
+
+import numpy as np
+import pandas as pd
+
+
+class ResultWriter(abc.ABC):
+    """Writes the results of window analyses chunk by chunk as they are computed, so that memory stays flat however
+    many windows there are and the chunks written so far are kept if a run is interrupted. The columns and types of
+    the first chunk are kept for every later chunk. Writers are context managers that close their file on exit."""
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.dtypes = None
+        self.rows = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        self.close()
+
+    def write(self, df):
+        """Appends the rows of a Pandas DataFrame."""
+        if self.dtypes is None:
+            self.dtypes = df.dtypes
+        self._write(df.astype(self.dtypes))
+        self.rows += len(df)
+
+    @abc.abstractmethod
+    def _write(self, df):
+        """Appends the rows of a Pandas DataFrame with the types of the first chunk to the file."""
+
+    def close(self):
+        """Finishes the file, after which nothing more can be written."""
+
+
+class CsvWriter(ResultWriter):
+    """Appends chunks to a CSV file, flushed after every chunk so that an interrupted run leaves every row written."""
+
+    def __init__(self, file_name):
+        super().__init__(file_name)
+        self.file = open(file_name, "w", encoding="utf-8", newline="")
+
+    def _write(self, df):
+        df.to_csv(self.file, index=False, header=self.file.tell() == 0)
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class ParquetWriter(ResultWriter):
+    """Writes every chunk as a row group of a Parquet file with the typed schema of the first chunk. Requires pyarrow.
+    The file footer is written on close, which also happens when a run is interrupted within a with statement."""
+
+    def __init__(self, file_name):
+        super().__init__(file_name)
+        self.writer = None
+
+    def _write(self, df):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        if self.writer is None:
+            self.writer = pq.ParquetWriter(self.file_name, table.schema)
+        self.writer.write_table(table.cast(self.writer.schema))
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+class HdfWriter(ResultWriter):
+    """Appends chunks to a table of an HDF5 file, under the key "results", with typed columns that can be queried
+    while reading. Requires PyTables. Every chunk is flushed to disk once written."""
+
+    def __init__(self, file_name, key="results"):
+        super().__init__(file_name)
+        self.key = key
+        self.store = pd.HDFStore(file_name, mode="w")
+
+    def _write(self, df):
+        self.store.append(self.key, df, format="table", index=False)
+        self.store.flush()
+
+    def close(self):
+        self.store.close()
+
+
+FORMATS = {".csv": CsvWriter, ".parquet": ParquetWriter, ".h5": HdfWriter, ".hdf5": HdfWriter}
+
+
+def writer(file_name):
+    """Returns the ResultWriter of a file, chosen by its extension among FORMATS, CSV for any other extension."""
+    return FORMATS.get(os.path.splitext(file_name)[1].lower(), CsvWriter)(file_name)
+
+
+def _write_arrays(file_name, coordinates, arrays):
+    """Writes NumPy arrays to a NetCDF file for a .nc extension, readable by xarray and GIS software, or to a NumPy .npz
+    file otherwise. Expected input is a dictionary of coordinate arrays by dimension name, e.g. "x", in km, or "time",
+    datetime64 written to NetCDF as seconds since 1970, and a dictionary of (dimension names, array) pairs."""
+    if os.path.splitext(file_name)[1].lower() != ".nc":
+        np.savez(file_name, **coordinates, **{name: values for name, (_, values) in arrays.items()})
+        return
+    from scipy.io import netcdf_file
+    with netcdf_file(file_name, "w") as dataset:  # NetCDF classic format, written without the netCDF4 library
+        for name, values in coordinates.items():
+            dataset.createDimension(name, len(values))
+        for name, (dimensions, values) in [*((name, ((name,), values)) for name, values in coordinates.items()),
+                                           *arrays.items()]:
+            time = values.dtype.kind == "M"
+            if time:
+                values = (values - np.datetime64("1970-01-01")) / np.timedelta64(1, "s")
+            variable = dataset.createVariable(name, "f8", dimensions)
+            variable[:] = values
+            if time:
+                variable.units = "seconds since 1970-01-01 00:00:00"
+            elif name in coordinates:
+                variable.units = "km"
+            else:
+                variable._FillValue = np.nan
+
+
+def write_grid(file_name, df_plot, columns=("B_lsr", "B_ml", "Event_count")):
+    """Writes the values of windows on a regular xy grid as 2D arrays indexed [y, x] with their coordinates, to a
+    NetCDF or NumPy file, see _write_arrays. Expected input is a Pandas DataFrame as given to plot_b_value.graph_xy,
+    with columns "Window_x", "Window_y" and the columns to write, and grid cells without a window are nan."""
+    x, x_index = np.unique(df_plot["Window_x"].to_numpy(), return_inverse=True)
+    y, y_index = np.unique(df_plot["Window_y"].to_numpy(), return_inverse=True)
+    grids = {}
+    for column in columns:
+        grid = np.full((len(y), len(x)), np.nan)
+        grid[y_index, x_index] = df_plot[column].to_numpy(dtype=float)
+        grids[column] = ("y", "x"), grid
+    _write_arrays(file_name, {"y": y, "x": x}, grids)
+
+
+def write_cube(file_name, cube):
+    """Writes a stack of maps over time intervals, as returned by moving_window.spacetime_window_analysis, as 3D arrays
+    indexed [time, y, x] with the start and end of every interval and the coordinates of window centres, to a NetCDF
+    or NumPy file, see _write_arrays."""
+    arrays = {"time_end": (("time",), cube["time_end"])}
+    arrays.update({name: (("time", "y", "x"), values) for name, values in cube.items() if np.ndim(values) == 3})
+    _write_arrays(file_name, {"time": cube["time"], "y": cube["y"], "x": cube["x"]}, arrays)
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+
+import numpy as np
+
+import spatial_index
+import statistical_analysis
+
+
+class SpaceTimeIndex:
+    """Magnitude histograms of a fixed grid of windows, as in moving_window.spatial_window_analysis, of the events of
+    a time interval sliding forward through the catalog. As the interval moves, only the events that enter or leave
+    it are added to or removed from the histograms of the windows holding their cell, so a move costs work in
+    proportion to the events that change times the windows overlapping a cell, rather than to the number of cells and
+    magnitude levels, and the catalog is never filtered again. Window histograms are only kept this way if they hold
+    at most max_table_entries counts, otherwise only window event counts are, and histograms are counted from the
+    events of the interval when asked for, see histograms, so memory stays bounded. Event extents aren't
+    available."""
+
+    def __init__(self, x, y, times, magnitudes, x_edges, y_edges, x_windows, y_windows, max_table_entries=2 ** 26):
+        """Expected input is NumPy arrays of event coordinates, times and magnitudes, sorted NumPy arrays of cell
+        edges and, along each axis, the NumPy arrays of the first and last edge index of every window, all e.g. from
+        spatial_index.window_edges, and the number of entries of the largest histogram array or table. Windows are
+        every combination of an X and a Y window, in X major order. Events outside of the edges are ignored. The
+        interval starts out empty, see move."""
+        magnitudes = statistical_analysis.float64_magnitudes(magnitudes)
+        cell, inside = spatial_index.cell_indices(x, y, x_edges, y_edges)
+        self.levels, level = np.unique(magnitudes[inside], return_inverse=True)
+        order = np.argsort(times[inside], kind="stable")
+        self.times, self.cells, self.level = times[inside][order], cell[order], level[order]
+        self.dtype = np.int32 if len(self.times) < np.iinfo(np.int32).max else np.int64
+        self.cell_shape = len(x_edges) - 1, len(y_edges) - 1
+        self.x_cover = self._cover(*x_windows, self.cell_shape[0])
+        self.y_cover = self._cover(*y_windows, self.cell_shape[1])
+        self.shape = len(x_windows[0]), len(y_windows[0])
+        self.window_edges = (np.repeat(x_windows[0], self.shape[1]), np.repeat(x_windows[1], self.shape[1]),
+                             np.tile(y_windows[0], self.shape[0]), np.tile(y_windows[1], self.shape[0]))
+        # x_start, x_end, y_start and y_end of every window, as for spatial_index.SpatialIndex
+        self.max_table_entries = max_table_entries
+        self.tracked = self.shape[0] * self.shape[1] * len(self.levels) <= max_table_entries
+        self.tracked_levels = len(self.levels) if self.tracked else 1  # a single level when only counts are kept
+        self.tracked_level = self.level if self.tracked else np.zeros_like(self.level)
+        self.window_histograms = np.zeros((self.shape[0] * self.shape[1], self.tracked_levels), dtype=self.dtype)
+        self.window_counts = np.zeros(self.shape[0] * self.shape[1], dtype=self.dtype)
+        self.first, self.last = 0, 0  # the interval holds the events self.first:self.last in time order
+
+    @staticmethod
+    def _cover(starts, ends, cells):
+        """Returns the first and last (excluded) window holding each cell along one axis, a contiguous range as the
+        first and last edges of windows both increase."""
+        cell = np.arange(cells)
+        return np.searchsorted(ends, cell, side="right"), np.searchsorted(starts, cell, side="right")
+
+    def _windows_holding(self, cell):
+        """Returns, for NumPy arrays of flat cell indices, the index of every cell repeated once for every window
+        holding it, and the index of those windows, in X major order."""
+        x_cell, y_cell = np.divmod(cell, self.cell_shape[1])
+        x_low, y_low = self.x_cover[0][x_cell], self.y_cover[0][y_cell]
+        x_count, y_count = self.x_cover[1][x_cell] - x_low, self.y_cover[1][y_cell] - y_low
+        sizes = x_count * y_count
+        item = np.repeat(np.arange(len(cell)), sizes)
+        offset = np.arange(len(item)) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+        return item, (x_low[item] + offset // y_count[item]) * self.shape[1] + y_low[item] + offset % y_count[item]
+
+    def _window_sizes(self, cell):
+        """Returns the number of windows holding each of the given flat cell indices."""
+        x_cell, y_cell = np.divmod(cell, self.cell_shape[1])
+        return (self.x_cover[1][x_cell] - self.x_cover[0][x_cell]) * (self.y_cover[1][y_cell] - self.y_cover[0][y_cell])
+
+    def _rebuild(self):
+        """Recounts every kept window histogram from the events of the interval through summed-area tables, for moves
+        that change so many events that this is cheaper than updating windows event by event."""
+        interval = slice(self.first, self.last)
+        cell_histograms = spatial_index.CellHistograms(self.cells[interval], self.tracked_level[interval],
+                                                       self.cell_shape, self.tracked_levels, self.dtype,
+                                                       self.max_table_entries)
+        self.window_histograms = cell_histograms.histograms(*self.window_edges)
+        self.window_counts = self.window_histograms.sum(axis=1, dtype=self.dtype)
+
+    def move(self, start, end):
+        """Moves the interval to the events with times from start up to, but excluding, end. Intervals only move
+        forward in time, neither start nor end may be before those of the previous interval.
+        Returns the number of events that entered and left the interval."""
+        first, last = np.searchsorted(self.times, [start, end])
+        if first < self.first or last < self.last:
+            raise ValueError("time intervals must move forward")
+        leaving = slice(self.first, min(self.last, first))
+        entering = slice(max(self.last, first), last)  # events between intervals are skipped when they don't overlap
+        self.first, self.last = first, last
+        changed = np.concatenate((self.cells[entering], self.cells[leaving])) * self.tracked_levels \
+            + np.concatenate((self.tracked_level[entering], self.tracked_level[leaving]))
+        signs = np.repeat([1, -1], [entering.stop - entering.start, leaving.stop - leaving.start])
+        changed, inverse = np.unique(changed, return_inverse=True)
+        delta = np.bincount(inverse, weights=signs, minlength=len(changed)).astype(self.dtype)
+        # net change of every (cell, level) pair, events entering and leaving the same pair cancel out
+        changed, delta = changed[delta != 0], delta[delta != 0]
+
+        cell, level = np.divmod(changed, self.tracked_levels)
+        if self._window_sizes(cell).sum() > self.window_histograms.size:
+            self._rebuild()
+        elif len(changed):
+            change, window = self._windows_holding(cell)
+            np.add.at(self.window_histograms.ravel(), window * self.tracked_levels + level[change], delta[change])
+            np.add.at(self.window_counts, window, delta[change])
+        return entering.stop - entering.start, leaving.stop - leaving.start
+
+    def event_counts(self):
+        """Returns the number of events of each window in the interval."""
+        return self.window_counts.copy()
+
+    def histograms(self, windows, chunk_pairs=2 ** 22):
+        """Returns a 2D NumPy array with the number of events of each of the given windows (rows) in the interval at
+        each magnitude level (columns), as used by statistical_analysis.b_value_histogram_batch. When histograms
+        aren't kept, every event of the interval within the X range of the given windows is added to those of them
+        holding its cell, chunk_pairs events and windows at a time, which costs work in proportion to the events of
+        the windows, whatever the number of magnitude levels."""
+        if self.tracked:
+            return self.window_histograms[windows]
+        histograms = np.zeros((len(windows), len(self.levels)), dtype=self.dtype)
+        if not len(windows):
+            return histograms
+        rows = np.full(len(self.window_counts), -1)
+        rows[windows] = np.arange(len(windows))
+        x_first, x_last = self.window_edges[0][windows].min(), self.window_edges[1][windows].max()
+        events = np.arange(self.first, self.last)
+        events = events[(self.cells[events] >= x_first * self.cell_shape[1])
+                        & (self.cells[events] < x_last * self.cell_shape[1])]  # in the cells of the windows along X
+        pairs = np.cumsum(self._window_sizes(self.cells[events]))
+        bounds = np.searchsorted(pairs, np.arange(0, pairs[-1] if len(pairs) else 0, chunk_pairs), side="right")
+        for chunk in np.split(events, bounds[1:]):
+            event, window = self._windows_holding(self.cells[chunk])
+            row = rows[window]
+            np.add.at(histograms.ravel(), (row * len(self.levels) + self.level[chunk][event])[row >= 0], 1)
+        return histograms
@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+
+import numpy as np
+
+import statistical_analysis
+
+
+def window_edges(anchors, window_size):
+    """Returns the sorted cell edges needed for every window starting at the given anchors to line up exactly with
+    cells, along with the indices of the first and last edge of each window.
+    Expected input is a NumPy array of window anchors along one axis and a scalar window size.
+    Windows include both of their bounds, as Series.between(anchor, anchor + window_size) does, so the last edge of a
+    window is the next float after its upper bound, and events on the upper bound of one window and the lower bound
+    of the next, e.g. on a grid aligned with integer coordinates, belong to both."""
+    ends = np.nextafter(anchors + window_size, np.inf)
+    edges = np.unique(np.concatenate((anchors, ends)))
+    return edges, np.searchsorted(edges, anchors), np.searchsorted(edges, ends)
+
+
+def cell_indices(x, y, x_edges, y_edges):
+    """Returns the flat index, x_cell * (len(y_edges) - 1) + y_cell, of the grid cell of every event inside the cell
+    edges, and a boolean NumPy array of which events are inside. Events on the last edge of a cell belong to the next
+    cell."""
+    nx, ny = len(x_edges) - 1, len(y_edges) - 1
+    x_cell = np.searchsorted(x_edges, x, side="right") - 1
+    y_cell = np.searchsorted(y_edges, y, side="right") - 1
+    inside = (x_cell >= 0) & (x_cell < nx) & (y_cell >= 0) & (y_cell < ny)
+    return x_cell[inside] * ny + y_cell[inside], inside
+
+
+class CellHistograms:
+    """Magnitude histograms of rectangles of cells of an xy grid, from a summed-area table with a column for every
+    magnitude level. The table of the whole grid is built once if it holds at most max_table_entries counts.
+    Otherwise, as tables grow with the number of cells times that of levels, e.g. for magnitudes of fine precision,
+    a table of a band of cells along X is built for every group of windows within one, so memory stays bounded."""
+
+    def __init__(self, cell, level, cell_shape, num_levels, dtype=np.int32, max_table_entries=2 ** 26):
+        """Expected input is NumPy arrays of the flat cell index, see cell_indices, and the magnitude level index of
+        every event, the number of cells along X and Y, the number of magnitude levels, the dtype of counts and the
+        number of entries of the largest table to build."""
+        self.cell_shape, self.num_levels, self.dtype = cell_shape, num_levels, dtype
+        self.band = max(max_table_entries // ((cell_shape[1] + 1) * max(num_levels, 1)) - 1, 1)
+        # cells along X of a table within max_table_entries
+        self.table = self._table(cell, level, 0, cell_shape[0]) if self.band >= cell_shape[0] else None
+        if self.table is None:
+            order = np.argsort(cell, kind="stable")
+            self.cell, self.level = cell[order], level[order]
+            self.offsets = np.searchsorted(self.cell, np.arange(cell_shape[0] + 1) * cell_shape[1])
+            # the events of the cells x_first up to x_last along X are self.offsets[x_first]:self.offsets[x_last]
+            self.band_table = None  # first and last cell along X of the last table of a band, and the table itself,
+            # kept for the next windows, which are usually further along the same band
+
+    def _table(self, cell, level, x_first, x_last):
+        """Returns the summed-area table of the cells from x_first up to x_last along X, given the cell and level of
+        every event in them. Events are counted directly in the table and summed in place, a row and then a column
+        at a time, which is both faster than np.cumsum over its strided axes and needs no other array of its size."""
+        ny = self.cell_shape[1]
+        table = np.zeros((x_last - x_first + 1, ny + 1, self.num_levels), dtype=self.dtype)
+        keys, counts = np.unique((cell - x_first * ny) * self.num_levels + level, return_counts=True)
+        cell, level = np.divmod(keys, self.num_levels)
+        table[cell // ny + 1, cell % ny + 1, level] = counts
+        for row in range(1, table.shape[0]):
+            table[row] += table[row - 1]
+        for column in range(1, table.shape[1]):
+            table[:, column] += table[:, column - 1]
+        return table
+
+    def histograms(self, x_start, x_end, y_start, y_end):
+        """Returns a 2D NumPy array with the number of events of each window (rows) at each magnitude level
+        (columns)."""
+        if self.table is not None:
+            return SpatialIndex._rectangle(self.table, x_start, x_end, y_start, y_end)
+        histograms = np.empty((len(x_start), self.num_levels), dtype=self.dtype)
+        remaining = np.argsort(x_start, kind="stable")
+        width = max(self.band, np.max(x_end - x_start, initial=0))  # a band always holds at least one window
+        while len(remaining):
+            x_first = x_start[remaining[0]]
+            if self.band_table is None or not self.band_table[0] <= x_first <= x_end[remaining[0]] \
+                    <= self.band_table[1]:
+                self.band_table = None  # released before the next table is built
+                x_last = min(x_first + width, self.cell_shape[0])
+                events = slice(self.offsets[x_first], self.offsets[x_last])
+                self.band_table = x_first, x_last, self._table(self.cell[events], self.level[events], x_first, x_last)
+            band_first, band_last = self.band_table[:2]
+            inside = x_end[remaining] <= band_last
+            windows, remaining = remaining[inside], remaining[~inside]
+            histograms[windows] = SpatialIndex._rectangle(self.band_table[2], x_start[windows] - band_first,
+                                                          x_end[windows] - band_first, y_start[windows], y_end[windows])
+        return histograms
+
+
+class SpatialIndex:
+    """Summed-area tables of events binned into an xy grid of cells, with the magnitude histograms of cells in a
+    CellHistograms. The number of events, magnitude sums, minimum magnitudes and cumulative frequency-magnitude counts
+    of any rectangle of cells are then found in constant time, regardless of how many events it holds.
+    Windows are given as NumPy arrays of edge indices x_start, x_end, y_start, y_end, with a window spanning the cells
+    between its first and last edge. Events on the last edge of a window belong to the next cell, see window_edges
+    for windows that include their upper bound."""
+
+    def __init__(self, x, y, magnitudes, x_edges, y_edges, z=None, levels=None, max_table_entries=2 ** 26):
+        """Expected input is NumPy arrays of event coordinates and magnitudes, sorted NumPy arrays of cell edges, e.g.
+        from window_edges, and optionally a NumPy array of event depths used for window extents and the sorted
+        magnitude levels to bin events into, all their distinct magnitudes by default, e.g. the levels of a whole
+        catalog when indexing a part of it, and the number of entries of the largest histogram table, see
+        CellHistograms. Events outside of the edges are ignored."""
+        self.x_edges, self.y_edges = x_edges, y_edges
+        magnitudes = statistical_analysis.float64_magnitudes(magnitudes)
+        nx, ny = len(x_edges) - 1, len(y_edges) - 1
+        cell, inside = cell_indices(x, y, x_edges, y_edges)
+        x, y, magnitudes = x[inside], y[inside], magnitudes[inside]
+        if z is not None:
+            z = z[inside]
+
+        if levels is None:
+            self.levels, level = np.unique(magnitudes, return_inverse=True)
+        else:
+            self.levels = statistical_analysis.float64_magnitudes(levels)
+            level = np.searchsorted(self.levels, magnitudes)
+        dtype = np.int32 if len(magnitudes) < np.iinfo(np.int32).max else np.int64
+        self.cell_histograms = CellHistograms(cell, level, (nx, ny), len(self.levels), dtype, max_table_entries)
+        self.count_table = self._summed_area_table(np.bincount(cell, minlength=nx * ny).reshape(nx, ny), dtype)
+        self.sum_table = self._summed_area_table(
+            np.bincount(cell, weights=magnitudes, minlength=nx * ny).reshape(nx, ny), float)
+        self.square_table = self._summed_area_table(
+            np.bincount(cell, weights=magnitudes ** 2, minlength=nx * ny).reshape(nx, ny), float)
+
+        self.cell_extents = {}  # per cell minimum and maximum of each coordinate, infinite for empty cells
+        for name, values in (("X", x), ("Y", y), ("Z", z)):
+            if values is None:
+                continue
+            cell_min, cell_max = np.full(nx * ny, np.inf), np.full(nx * ny, -np.inf)
+            np.minimum.at(cell_min, cell, values)
+            np.maximum.at(cell_max, cell, values)
+            self.cell_extents[name] = cell_min.reshape(nx, ny), cell_max.reshape(nx, ny)
+
+    @staticmethod
+    def _summed_area_table(grid, dtype):
+        """Returns the 2D prefix sums of a grid over its first two axes, padded with a leading row and column of
+        zeros so that table[i, j] is the sum of grid[:i, :j]."""
+        table = np.zeros((grid.shape[0] + 1, grid.shape[1] + 1) + grid.shape[2:], dtype=dtype)
+        np.cumsum(grid, axis=0, out=table[1:, 1:])
+        np.cumsum(table[1:, 1:], axis=1, out=table[1:, 1:])
+        return table
+
+    @staticmethod
+    def _rectangle(table, x_start, x_end, y_start, y_end):
+        """Sums a summed-area table over rectangles of cells, one per window."""
+        return table[x_end, y_end] - table[x_start, y_end] - table[x_end, y_start] + table[x_start, y_start]
+
+    def event_counts(self, x_start, x_end, y_start, y_end):
+        """Returns the number of events of each window."""
+        return self._rectangle(self.count_table, x_start, x_end, y_start, y_end)
+
+    def magnitude_sums(self, x_start, x_end, y_start, y_end):
+        """Returns the sum of magnitudes of each window."""
+        return self._rectangle(self.sum_table, x_start, x_end, y_start, y_end)
+
+    def squared_magnitude_sums(self, x_start, x_end, y_start, y_end):
+        """Returns the sum of squared magnitudes of each window."""
+        return self._rectangle(self.square_table, x_start, x_end, y_start, y_end)
+
+    def histograms(self, x_start, x_end, y_start, y_end):
+        """Returns a 2D NumPy array with the number of events of each window (rows) at each magnitude level (columns),
+        as used by statistical_analysis.b_value_histogram_batch."""
+        return self.cell_histograms.histograms(x_start, x_end, y_start, y_end)
+
+    def cumulative_counts(self, x_start, x_end, y_start, y_end):
+        """Returns a 2D NumPy array with the number of events of each window at or above each magnitude level."""
+        return np.cumsum(self.histograms(x_start, x_end, y_start, y_end)[:, ::-1], axis=1)[:, ::-1]
+
+    def min_magnitudes(self, x_start, x_end, y_start, y_end):
+        """Returns the minimum magnitude of each window, nan for empty windows."""
+        histograms = self.histograms(x_start, x_end, y_start, y_end)
+        return np.where(histograms.any(axis=1), self.levels[(histograms > 0).argmax(axis=1)], np.nan)
+
+    def extents(self, name, x_start, x_end, y_start, y_end, chunk_cells=2 ** 22):
+        """Returns the minimum and maximum of the coordinate name ("X", "Y" or "Z") over the events of each window,
+        nan for empty windows. Unlike the other queries this takes time proportional to the cells of each window,
+        so windows are processed in chunks of at most chunk_cells cells."""
+        cell_min, cell_max = self.cell_extents[name]
+        x_span, y_span = np.max(x_end - x_start, initial=0), np.max(y_end - y_start, initial=0)
+        extent_min, extent_max = np.full(len(x_start), np.nan), np.full(len(x_start), np.nan)
+        chunk = max(chunk_cells // max(x_span * y_span, 1), 1)
+        for first in range(0, len(x_start), chunk):
+            part = slice(first, first + chunk)
+            x_cells = x_start[part, None] + np.arange(x_span)
+            y_cells = y_start[part, None] + np.arange(y_span)
+            inside = ((x_cells < x_end[part, None])[:, :, None] & (y_cells < y_end[part, None])[:, None, :])
+            x_cells = np.minimum(x_cells, cell_min.shape[0] - 1)[:, :, None]
+            y_cells = np.minimum(y_cells, cell_min.shape[1] - 1)[:, None, :]
+            # padding cells beyond each window are clipped into range and then masked out
+            window_min = np.where(inside, cell_min[x_cells, y_cells], np.inf).min(axis=(1, 2), initial=np.inf)
+            window_max = np.where(inside, cell_max[x_cells, y_cells], -np.inf).max(axis=(1, 2), initial=-np.inf)
+            extent_min[part] = np.where(np.isfinite(window_min), window_min, np.nan)
+            extent_max[part] = np.where(np.isfinite(window_max), window_max, np.nan)
+        return extent_min, extent_max
@@ -2,11 +2,25 @@
 
 import numpy as np
 
+import instrumentation
 
+
+def float64_magnitudes(magnitudes):
+    """Returns magnitudes as a float64 NumPy array. Magnitudes stored as float32, e.g. by
+    process_input.load_chunked, are rounded to 6 decimal places, which undoes the float32 rounding of magnitudes read
+    from text so that rescaling in b_value_least_squares_regression truncates them as it would the original values."""
+    magnitudes = np.asarray(magnitudes)
+    if magnitudes.dtype == np.float32:
+        return np.round(magnitudes.astype(np.float64), 6)
+    return magnitudes.astype(np.float64, copy=False)
+
+
+@instrumentation.instrumented
 def b_value_maximum_likelihood(magnitudes):
     """Calculates the b-value given earthquake magnitudes using the maximum likelihood method described by
     bval_maxlkh2.m
     Expected input is a NumPy array."""
+    magnitudes = float64_magnitudes(magnitudes)
     neq = len(magnitudes)
     mean_magnitude = np.mean(magnitudes)
     min_magnitude = np.min(magnitudes)
@@ -17,38 +31,173 @@ def b_value_maximum_likelihood(magnitudes):
     return b_value, a_value, std_err
 
 
+@instrumentation.instrumented
 def b_value_least_squares_regression(magnitudes, bin_size=0.2, precision=3):
     """Calculating the b-value given earthquake magnitudes using the least squares regression fit method described by
     bval_lsqreg
     Expected input is a NumPy array and, optionally, two scalars: the bin size and decimal place precision."""
     scaling_factor = 10 ** precision
-    magnitudes = (scaling_factor * magnitudes).astype(int)
+    magnitudes = np.sort((scaling_factor * float64_magnitudes(magnitudes)).astype(int))
     bin_size = int(scaling_factor * bin_size)
     # Rescaling and integer conversion to avoid float precision problems
-    max_magnitude = np.max(magnitudes)
-    min_magnitude = np.min(magnitudes)
-    sx, sy, sxy, sxx = 0, 0, 0, 0
-    x, y = np.array([]), np.array([])
-    count_range = np.arange(min_magnitude, max_magnitude + bin_size, bin_size)
-    if count_range[-1] > max_magnitude:
-        count_range = count_range[:-1]
+    max_magnitude = magnitudes[-1]
+    min_magnitude = magnitudes[0]
+    x = np.arange(min_magnitude, max_magnitude + bin_size, bin_size)
+    if x[-1] > max_magnitude:
+        x = x[:-1]
     # Exactly match Matlab's count=mmin:bin:mmax
-    for i in count_range:
-        x = np.append(x, i)
-        y_lin = np.sum(magnitudes >= i)  # bool count
-        if y_lin > 0:
-            y = np.append(y, np.log10(y_lin))
-        else:
-            y = np.append(y, 0)
-        sx += x[-1]
-        sy += y[-1]
-        sxy += x[-1] * y[-1]
-        sxx += x[-1] ** 2
-    num_bins = len(x)
-    numerator, denominator = 0, 0
-    for i, j in enumerate(count_range):
-        numerator += (x[i] - sx / num_bins) * (y[i] - sy / num_bins)
-        denominator += (x[i] - sx / num_bins) ** 2
+    y = np.log10(len(magnitudes) - np.searchsorted(magnitudes, x, side="left"))
+    # number of magnitudes greater than or equal to each bin, never zero since every bin is at most the maximum
+    x = x.astype(float)
+    numerator = np.sum((x - np.mean(x)) * (y - np.mean(y)))
+    denominator = np.sum((x - np.mean(x)) ** 2)
     b_value = -numerator / denominator
-    a_value = sy / num_bins + sx / num_bins * b_value
+    a_value = np.mean(y) + np.mean(x) * b_value
     return b_value * scaling_factor,  a_value  # rescale back the b-value
+
+
+def _least_squares_regression_batch(x, counts, valid, scaling_factor):
+    """Fits log10 of cumulative counts against magnitude bins for many windows at once. Expected inputs are 2D NumPy
+    arrays of shape (windows, bins): rescaled integer bins, cumulative counts at each bin and a mask of the bins
+    belonging to each window (padding is ignored), and the scaling factor used for rescaling."""
+    num_bins = valid.sum(axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        y = np.where(valid, np.log10(np.where(valid, counts, 1)), 0)
+        x = np.where(valid, x, 0).astype(float)
+        x_mean = x.sum(axis=1) / num_bins
+        y_mean = y.sum(axis=1) / num_bins
+        x_centred = np.where(valid, x - x_mean[:, None], 0)
+        numerator = np.sum(x_centred * (y - y_mean[:, None]), axis=1)
+        denominator = np.sum(x_centred ** 2, axis=1)
+        b_value = -numerator / denominator  # a single bin gives nan, as with the per window function
+    a_value = y_mean + x_mean * b_value
+    return b_value * scaling_factor, a_value
+
+
+def _maximum_likelihood_batch(neq, mean_magnitude, min_magnitude, sum_squared_deviations):
+    """Maximum likelihood b-values from per window summary statistics, see b_value_maximum_likelihood.
+    Expected inputs are 1D NumPy arrays of equal length."""
+    with np.errstate(divide="ignore", invalid="ignore"):
+        b_value = (1/(mean_magnitude-min_magnitude))*np.log10(np.exp(1))
+        a_value = np.log10(neq) + b_value * min_magnitude
+        std_dev = sum_squared_deviations / (neq * (neq - 1))
+        std_err = 2.30 * np.sqrt(std_dev) * b_value ** 2
+    return b_value, a_value, std_err
+
+
+@instrumentation.instrumented
+def b_value_batch(magnitudes, offsets, bin_size=0.2, precision=3):
+    """Calculates least squares regression and maximum likelihood b-values of many windows in one call.
+    Expected input is a NumPy array of the magnitudes of all windows concatenated together and a NumPy array of
+    CSR-style offsets, so that window i is magnitudes[offsets[i]:offsets[i + 1]], and optionally the bin size and
+    decimal place precision of b_value_least_squares_regression.
+    Returns NumPy arrays of LSR b-values, LSR a-values, ML b-values, ML a-values and ML standard errors, with nan
+    for empty windows."""
+    magnitudes = float64_magnitudes(magnitudes)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    scaling_factor = 10 ** precision
+    bin_size = int(scaling_factor * bin_size)
+    num_windows = len(offsets) - 1
+    neq = np.diff(offsets)
+    occupied = neq > 0
+    window_ids = np.repeat(np.arange(num_windows), neq)
+
+    result = tuple(np.full(num_windows, np.nan) for _ in range(5))
+    if not occupied.any():
+        return result
+
+    rescaled = (scaling_factor * magnitudes).astype(int)  # same truncation as the per window function
+    rescaled_min = rescaled.min()
+    span = int(rescaled.max() - rescaled_min) + 1
+    keys = np.sort(window_ids * span + (rescaled - rescaled_min))
+    # sorting by window, then by magnitude, with a single integer key
+    starts, ends = offsets[:-1][occupied], offsets[1:][occupied]
+    window_offset = np.flatnonzero(occupied) * span - rescaled_min  # key of a rescaled magnitude of zero
+    min_rescaled = keys[starts] - window_offset
+    max_rescaled = keys[ends - 1] - window_offset
+
+    num_bins = (max_rescaled - min_rescaled) // bin_size + 1  # count=mmin:bin:mmax
+    x = min_rescaled[:, None] + np.arange(num_bins.max()) * bin_size
+    valid = np.arange(num_bins.max()) < num_bins[:, None]
+    query = np.where(valid, x, min_rescaled[:, None]) + window_offset[:, None]
+    counts = ends[:, None] - np.searchsorted(keys, query, side="left")
+    b_lsr, a_lsr = _least_squares_regression_batch(x, counts, valid, scaling_factor)
+
+    mean_magnitude = np.bincount(window_ids, weights=magnitudes, minlength=num_windows) / np.maximum(neq, 1)
+    deviations = magnitudes - np.repeat(mean_magnitude, neq)
+    sum_squared_deviations = np.bincount(window_ids, weights=deviations ** 2, minlength=num_windows)[occupied]
+    min_magnitude = np.minimum.reduceat(magnitudes, starts)
+    b_ml, a_ml, std_err_ml = _maximum_likelihood_batch(neq[occupied], mean_magnitude[occupied], min_magnitude,
+                                                       sum_squared_deviations)
+
+    for array, values in zip(result, (b_lsr, a_lsr, b_ml, a_ml, std_err_ml)):
+        array[occupied] = values
+    return result
+
+
+@instrumentation.instrumented
+def b_value_histogram_batch(counts, magnitude_levels, bin_size=0.2, precision=3):
+    """Calculates least squares regression and maximum likelihood b-values of many windows from their magnitude
+    histograms. Expected input is a 2D NumPy array of shape (windows, levels) with the number of events of each window
+    at each magnitude level, a sorted NumPy array of the distinct magnitude levels, e.g. from np.unique, and
+    optionally the bin size and decimal place precision of b_value_least_squares_regression.
+    Returns the same arrays as b_value_batch."""
+    counts = np.asarray(counts)
+    magnitude_levels = float64_magnitudes(magnitude_levels)
+    scaling_factor = 10 ** precision
+    bin_size = int(scaling_factor * bin_size)
+    num_windows = counts.shape[0]
+    neq = counts.sum(axis=1)
+    occupied = neq > 0
+
+    result = tuple(np.full(num_windows, np.nan) for _ in range(5))
+    if not occupied.any():
+        return result
+    counts, neq = counts[occupied], neq[occupied]
+
+    rescaled_levels = (scaling_factor * magnitude_levels).astype(int)
+    cumulative = np.zeros((counts.shape[0], counts.shape[1] + 1), dtype=np.int64)
+    cumulative[:, :-1] = np.cumsum(counts[:, ::-1], axis=1)[:, ::-1]
+    # number of events at or above each level, with a trailing zero for bins past the last level
+    nonzero = counts > 0
+    first_level = nonzero.argmax(axis=1)
+    last_level = counts.shape[1] - 1 - nonzero[:, ::-1].argmax(axis=1)
+    min_rescaled, max_rescaled = rescaled_levels[first_level], rescaled_levels[last_level]
+
+    num_bins = (max_rescaled - min_rescaled) // bin_size + 1
+    x = min_rescaled[:, None] + np.arange(num_bins.max()) * bin_size
+    valid = np.arange(num_bins.max()) < num_bins[:, None]
+    bin_counts = np.take_along_axis(cumulative, np.searchsorted(rescaled_levels, x, side="left"), axis=1)
+    b_lsr, a_lsr = _least_squares_regression_batch(x, bin_counts, valid, scaling_factor)
+
+    mean_magnitude = counts @ magnitude_levels / neq
+    min_magnitude = magnitude_levels[first_level]
+    sum_squared_deviations = np.sum(counts * (magnitude_levels - mean_magnitude[:, None]) ** 2, axis=1)
+    b_ml, a_ml, std_err_ml = _maximum_likelihood_batch(neq, mean_magnitude, min_magnitude, sum_squared_deviations)
+
+    for array, values in zip(result, (b_lsr, a_lsr, b_ml, a_ml, std_err_ml)):
+        array[occupied] = values
+    return result
+
+
+@instrumentation.instrumented
+def window_histograms(magnitudes, starts, ends, levels=None):
+    """Returns a 2D NumPy array with the number of events of each window (rows) at each magnitude level (columns) and
+    the sorted NumPy array of magnitude levels, as used by b_value_histogram_batch.
+    Expected input is a NumPy array of magnitudes, NumPy arrays of the first and one past the last index of each
+    window, which may overlap, and optionally the magnitude levels, which must include every magnitude, e.g. to give
+    every chunk of windows of a larger catalog the same columns. By default they are the distinct magnitudes.
+    Histograms are differences of cumulative histograms at the window boundaries, so the cost doesn't grow with the
+    overlap of windows."""
+    magnitudes = float64_magnitudes(magnitudes)
+    if levels is None:
+        levels, level = np.unique(magnitudes, return_inverse=True)
+    else:
+        level = np.searchsorted(levels, magnitudes)
+    boundaries, boundary = np.unique(np.concatenate((starts, ends)), return_inverse=True)
+    segment = np.searchsorted(boundaries, np.arange(len(magnitudes)), side="right")
+    # events of segment s lie before every boundary from s on
+    histograms = np.bincount(segment * len(levels) + level, minlength=(len(boundaries) + 1) * len(levels))
+    cumulative = np.cumsum(histograms.reshape(len(boundaries) + 1, len(levels)), axis=0)
+    start_boundary, end_boundary = boundary[:len(starts)], boundary[len(starts):]
+    return cumulative[end_boundary] - cumulative[start_boundary], levels
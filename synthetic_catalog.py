@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+
+import argparse
+
+import numpy as np
+import pandas as pd
+
+KM_PER_DEGREE = 111.2  # kilometres per degree of latitude, near enough for placing synthetic events
+
+
+def generate(size, b_value=1.0, magnitude_min=1.0, clusters=50, background=0.3, centre=(40.0, -120.0), extent=2.0,
+             start="2010-01-01", years=10, seed=0):
+    """Returns a Pandas DataFrame of size synthetic earthquakes in the CSV schema read by process_input.process, i.e.
+    columns "Year", "Month", "Day", "Hour", "Minute", "Second", "Latitude", "Longitude", "Depth" and "Magnitude",
+    sorted by time. The same arguments always give the same catalog.
+    Magnitudes follow the Gutenberg-Richter law with the given b-value from magnitude_min, rounded to 0.1.
+    A background fraction of events is spread uniformly in time and over a square of extent degrees around the centre
+    (latitude, longitude), the rest belong to clusters of different sizes, each with a normally scattered epicentre,
+    a main shock time and aftershock delays decaying as in Omori's law. Depths are gamma distributed, mostly above
+    30 km."""
+    rng = np.random.default_rng(seed)
+    magnitudes = np.round(magnitude_min - 0.05 + rng.exponential(1 / (b_value * np.log(10)), size), 1)
+    # rounding to bins of 0.1 centred on magnitude_min and above
+    magnitudes = np.maximum(magnitudes, magnitude_min)
+
+    weights = 1 / np.arange(1, clusters + 1)  # a few large clusters and many small ones
+    cluster = rng.choice(clusters, size, p=weights / weights.sum())
+    clustered = rng.random(size) >= background
+    cluster_latitude = centre[0] + rng.uniform(-extent / 2, extent / 2, clusters)
+    cluster_longitude = centre[1] + rng.uniform(-extent / 2, extent / 2, clusters)
+    cluster_radius = rng.uniform(2, 15, clusters) / KM_PER_DEGREE  # kilometres to degrees
+    cluster_depth = rng.uniform(3, 15, clusters)
+
+    scatter = rng.normal(size=(size, 2)) * cluster_radius[cluster, None]
+    latitude = np.where(clustered, cluster_latitude[cluster] + scatter[:, 0],
+                        centre[0] + rng.uniform(-extent / 2, extent / 2, size))
+    longitude = np.where(clustered, cluster_longitude[cluster] + scatter[:, 1] / np.cos(np.radians(centre[0])),
+                         centre[1] + rng.uniform(-extent / 2, extent / 2, size))
+    depth = np.where(clustered, cluster_depth[cluster], 8) * rng.gamma(4, 0.25, size)
+
+    span = years * 365.25 * 86400  # in seconds
+    main_shock = rng.uniform(0, span, clusters)
+    delay = 10 ** rng.uniform(1, 7.5, size)  # log uniform delays, i.e. rates decaying as 1 / t from 10 s to ~1 year
+    seconds = np.where(clustered, (main_shock[cluster] + delay) % span, rng.uniform(0, span, size))
+    order = np.argsort(seconds, kind="stable")
+    times = pd.Timestamp(start) + pd.to_timedelta(np.round(seconds[order], 2), unit="s")
+
+    return pd.DataFrame({"Year": times.year, "Month": times.month, "Day": times.day, "Hour": times.hour,
+                         "Minute": times.minute, "Second": np.round(times.second + times.microsecond / 1e6, 2),
+                         "Latitude": latitude[order], "Longitude": longitude[order], "Depth": depth[order],
+                         "Magnitude": magnitudes[order]})
+
+
+def write(file_name, size, **settings):
+    """Generates a catalog of size events with the keyword arguments of generate and writes it to a CSV file."""
+    generate(size, **settings).to_csv(file_name, index=False, float_format="%.7g")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Writes a seeded synthetic earthquake catalog as a CSV file.")
+    parser.add_argument("file_name")
+    parser.add_argument("size", type=int)
+    parser.add_argument("--b-value", type=float, default=1.0)
+    parser.add_argument("--magnitude-min", type=float, default=1.0)
+    parser.add_argument("--seed", type=int, default=0)
+    arguments = parser.parse_args()
+    write(arguments.file_name, arguments.size, b_value=arguments.b_value, magnitude_min=arguments.magnitude_min,
+          seed=arguments.seed)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+
+import concurrent.futures
+import os
+
+import numpy as np
+import pandas as pd
+
+import instrumentation
+import moving_window
+import statistical_analysis
+
+
+class SerialExecutor(concurrent.futures.Executor):
+    """A concurrent.futures.Executor running every task in the calling process as soon as it is submitted, e.g. on a
+    single core or for debugging."""
+
+    def submit(self, function, *args, **kwargs):
+        future = concurrent.futures.Future()
+        try:
+            future.set_result(function(*args, **kwargs))
+        except Exception as error:
+            future.set_exception(error)
+        return future
+
+
+BACKENDS = {"serial": lambda workers: SerialExecutor(),
+            "process": lambda workers: concurrent.futures.ProcessPoolExecutor(workers)}
+# name: function of the number of workers returning a concurrent.futures.Executor, shut down after the analysis
+# any other executor, e.g. an mpi4py.futures.MPIPoolExecutor or the get_executor() of a dask.distributed Client for
+# several nodes, can be passed to tiled_window_analysis instead, and is left running for the caller to shut down
+
+
+def tile_ranges(anchor_count, tile_anchors):
+    """Returns the first and last (excluded) anchor indices of consecutive tiles of tile_anchors anchors along an
+    axis of anchor_count anchors."""
+    return [(first, min(first + tile_anchors, anchor_count)) for first in range(0, anchor_count, tile_anchors)]
+
+
+def _tiles(df, x_array, y_array, window_size, tile_anchors):
+    """Yields the band, i.e. the tile index along X, and the anchor index ranges of every tile, by X and then Y, with
+    a dictionary of the columns of the events of the tile and its halo, the window_size km beyond its last anchors
+    that its windows reach. Events are sorted along X once and along Y once per band of tiles, so the events of every
+    tile are found with binary searches, and they are given to the tile in catalog order."""
+    x, y = df["X"].to_numpy(), df["Y"].to_numpy()
+    x_order = np.argsort(x, kind="stable")
+    x_sorted = x[x_order]
+    for band, (x_first, x_last) in enumerate(tile_ranges(len(x_array), tile_anchors)):
+        in_band = x_order[np.searchsorted(x_sorted, x_array[x_first]):
+                          np.searchsorted(x_sorted, x_array[x_last - 1] + window_size, side="right")]
+        in_band = in_band[np.argsort(y[in_band], kind="stable")]
+        y_sorted = y[in_band]
+        for y_first, y_last in tile_ranges(len(y_array), tile_anchors):
+            events = np.sort(in_band[np.searchsorted(y_sorted, y_array[y_first]):
+                                     np.searchsorted(y_sorted, y_array[y_last - 1] + window_size, side="right")])
+            columns = {column: df[column].to_numpy()[events] for column in ["X", "Y", "Z", "Magnitude"]}
+            yield band, (x_first, x_last), (y_first, y_last), columns
+
+
+def _analyse_tile(columns, x_anchors, y_anchors, window_numbers, bin_size, window_size, window_min_count, resamples,
+                  mc_method, levels):
+    """Runs moving_window.anchored_window_analysis on the events of one tile, in a worker. Returns a NumPy array of
+    the plotted "B_lsr", "B_ml" and "Event_count" of every window of the tile and the Pandas DataFrame of exported
+    data of its windows with enough events."""
+    df_plot, df_export = moving_window.anchored_window_analysis(
+        pd.DataFrame(columns), bin_size, x_anchors, y_anchors, window_size, window_min_count, resamples, mc_method,
+        levels=levels, window_numbers=window_numbers)
+    return df_plot[["B_lsr", "B_ml", "Event_count"]].to_numpy(), df_export
+
+
+@instrumentation.instrumented
+def tiled_window_analysis(df, bin_size, window_size, window_step, window_min_count=500, resamples=0, mc_method=None,
+                          writer=None, tile_size=500.0, backend="process", workers=None, max_pending=None):
+    """Calculates the windows of moving_window.spatial_window_analysis tile by tile. The grid of window anchors is
+    split into square tiles of about tile_size km, a whole number of window steps, and every tile is analysed on its
+    own, by a task given only the events of the tile and of its halo, see _tiles, with the magnitude levels of the
+    whole catalog, so a worker needs memory in proportion to its tile rather than to the catalog.
+    Tasks run on a backend, a name of BACKENDS with a number of workers, all available cores by default, or any
+    concurrent.futures.Executor, with at most max_pending tiles, twice the workers by default, submitted at a time.
+    Every anchor belongs to exactly one tile, so the merged map has the same windows as an untiled analysis, with
+    the same estimates up to floating point rounding, and exported data follows the same order, written band by band
+    of tiles with a writer. Bootstrap resamples are seeded by the position of every window in the grid, so intervals
+    don't depend on the tiling, but are drawn from other random streams than those of spatial_window_analysis.
+    Returns the same as moving_window.spatial_window_analysis."""
+    x_array = np.arange(df["X"].min(), df["X"].max(), window_step)
+    y_array = np.arange(df["Y"].min(), df["Y"].max(), window_step)
+    if not len(x_array) or not len(y_array):  # nothing to split
+        return moving_window.anchored_window_analysis(df, bin_size, x_array, y_array, window_size, window_min_count,
+                                                      resamples, mc_method, writer)
+    tile_anchors = max(int(tile_size // window_step), 1)
+    levels = np.unique(statistical_analysis.float64_magnitudes(df["Magnitude"].to_numpy()))
+    plotted_data = np.full((len(x_array) * len(y_array), 3), np.nan)
+    bands = len(tile_ranges(len(x_array), tile_anchors))
+    remaining = [len(tile_ranges(len(y_array), tile_anchors))] * bands  # tiles of each band still to be collected
+    band_exports = [[] for _ in range(bands)]
+    chunks, written, pending = [], 0, {}
+
+    def collect(future):
+        """Places the results of a finished tile in the map, and exports every band of tiles whose tiles are all
+        finished, in order, with the rows of its tiles merged in the order of their windows in the grid."""
+        nonlocal written
+        band, window_numbers = pending.pop(future)
+        plotted, df_export = future.result()
+        plotted_data[window_numbers] = plotted
+        band_exports[band].append((window_numbers[~np.isnan(plotted[:, 2])], df_export))
+        # the event count is only plotted for windows with enough events, the rows of the exported data
+        remaining[band] -= 1
+        while written < bands and not remaining[written]:
+            numbers, exports = zip(*band_exports[written])
+            df_band = pd.concat(exports, ignore_index=True)
+            df_band = df_band.iloc[np.argsort(np.concatenate(numbers), kind="stable")].reset_index(drop=True)
+            if writer is not None:
+                writer.write(df_band)
+            else:
+                chunks.append(df_band)
+            band_exports[written] = None
+            written += 1
+
+    executor = BACKENDS[backend](workers) if isinstance(backend, str) else backend
+    max_pending = max_pending or 2 * (workers or os.cpu_count())
+    try:
+        for band, (x_first, x_last), (y_first, y_last), columns in _tiles(df, x_array, y_array, window_size,
+                                                                          tile_anchors):
+            window_numbers = (np.arange(x_first, x_last)[:, None] * len(y_array) + np.arange(y_first, y_last)).ravel()
+            # index of every window of the tile in the whole grid, X major as in spatial_window_analysis
+            future = executor.submit(_analyse_tile, columns, x_array[x_first:x_last], y_array[y_first:y_last],
+                                     window_numbers, bin_size, window_size, window_min_count, resamples, mc_method,
+                                     levels)
+            pending[future] = band, window_numbers
+            while len(pending) >= max_pending:
+                done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    collect(future)
+        for future in concurrent.futures.as_completed(list(pending)):
+            collect(future)
+    finally:
+        if isinstance(backend, str):
+            executor.shutdown(cancel_futures=True)
+
+    coordinates = np.column_stack((np.repeat(x_array, len(y_array)), np.tile(y_array, len(x_array))))
+    plotted_data = np.column_stack((coordinates + 0.5 * window_size, plotted_data))
+    df_plot = pd.DataFrame(plotted_data, columns=["Window_x", "Window_y", "B_lsr", "B_ml", "Event_count"])
+    return df_plot, None if writer is not None else pd.concat(chunks, ignore_index=True)
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+
+import numpy as np
+
+import instrumentation
+
+NAT = np.iinfo(np.int64).min  # the int64 value of NaT, given to invalid times
+FIRST_YEAR, LAST_YEAR = 1678, 2261  # whole years representable as datetime64[ns]
+NANOSECONDS = {"day": 86400 * 10 ** 9, "hour": 3600 * 10 ** 9, "minute": 60 * 10 ** 9, "second": 10 ** 9}
+
+
+def is_leap_year(year):
+    """Returns a boolean NumPy array of whether each year of the Gregorian calendar is a leap year."""
+    year = np.asarray(year)
+    return (year % 4 == 0) & ((year % 100 != 0) | (year % 400 == 0))
+
+
+def days_in_month(year, month):
+    """Returns a NumPy array of the number of days of each month, from 1 to 12, of the Gregorian calendar."""
+    month_days = np.array([31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31])
+    return month_days[np.clip(month, 1, 12) - 1] + ((month == 2) & is_leap_year(year))
+
+
+def days_from_civil(year, month, day):
+    """Returns an int64 NumPy array of the number of days since 1970-01-01 of each date of the proleptic Gregorian
+    calendar, counting years from March so that the leap day is the last day of its year, see
+    https://howardhinnant.github.io/date_algorithms.html#days_from_civil. Expected inputs are int64 NumPy arrays."""
+    year = year - (month <= 2)
+    era = year // 400  # floor division, so also correct before year 0
+    year_of_era = year - era * 400
+    day_of_year = (153 * ((month + 9) % 12) + 2) // 5 + day - 1
+    day_of_era = year_of_era * 365 + year_of_era // 4 - year_of_era // 100 + day_of_year
+    return era * 146097 + day_of_era - 719468
+
+
+@instrumentation.instrumented
+def get_epoch_nanoseconds(year, month, day, hour, minute, second):
+    """Converts date and time components to int64 nanoseconds since 1970-01-01, the representation of datetime64[ns],
+    without parsing or per row Python objects. Expected inputs are NumPy arrays, integral or float, e.g. columns of a
+    catalog, with fractional seconds, which are rounded to the nearest nanosecond.
+    Hours, minutes and seconds roll over into the next day, hour or minute as pd.to_datetime does, e.g. for leap
+    seconds given as second 60, but dates must exist. Rows with missing or non-integral dates, dates that don't exist,
+    e.g. 2019-02-29, or years outside of FIRST_YEAR to LAST_YEAR are flagged instead of raising.
+    Returns an int64 NumPy array of nanoseconds, NAT for invalid rows, and a boolean NumPy array of valid rows."""
+    year, month, day = (np.asarray(values, dtype=float) for values in (year, month, day))
+    hour, minute, second = (np.asarray(values, dtype=float) for values in (hour, minute, second))
+    valid = np.isfinite(hour) & np.isfinite(minute) & np.isfinite(second)
+    for values in (year, month, day):
+        valid &= np.isfinite(values) & (values == np.floor(values))
+    valid &= (year >= FIRST_YEAR) & (year <= LAST_YEAR) & (month >= 1) & (month <= 12) & (day >= 1)
+    year, month, day = (np.where(valid, values, 1).astype(np.int64) for values in (year, month, day))
+    valid &= day <= days_in_month(year, month)
+    time_of_day = np.rint(hour * NANOSECONDS["hour"]) + np.rint(minute * NANOSECONDS["minute"]) \
+        + np.rint(second * NANOSECONDS["second"])
+    valid &= np.abs(time_of_day) < 2 ** 53  # exact in float64 up to 2 ** 53 nanoseconds, over 100 days
+    nanoseconds = days_from_civil(year, month, day) * NANOSECONDS["day"]
+    nanoseconds += np.where(valid, time_of_day, 0).astype(np.int64)
+    nanoseconds[~valid] = NAT
+    return nanoseconds, valid
+
+
+def nanoseconds(times):
+    """Returns the int64 NumPy array of epoch nanoseconds of datetime64 times, e.g. a "Time" column, without a copy
+    when they are already datetime64[ns]. Sorting, searching and normalizing these is done on plain integers, without
+    any datetime or Timedelta arithmetic."""
+    return np.asarray(times).astype("datetime64[ns]", copy=False).view(np.int64)
+
+
+def to_datetime64(nanoseconds):
+    """Returns a datetime64[ns] view of an int64 NumPy array of epoch nanoseconds, without a copy."""
+    return np.asarray(nanoseconds, dtype=np.int64).view("datetime64[ns]")